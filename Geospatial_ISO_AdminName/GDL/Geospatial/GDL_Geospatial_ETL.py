@@ -4,6 +4,7 @@ project_root = os.environ.get('PROJECT_ROOT') # run this in terminal before exec
 print(project_root)
 sys.path.append(str(project_root))
 from config_loader import CONFIG
+from Geospatial_Lat_Long.db_loader import copy_upsert
 
 import pandas as pd
 import os
@@ -273,7 +274,9 @@ def prepare_data_for_insertion(df):
 
 def insert_data_to_db(cur, data):
     """
-    Insert data into the database.
+    Insert data into the database with COPY and a single set-based upsert,
+    which also fills the dimension tables if geospatial_data_gdl is encoded
+    (see Geospatial_Lat_Long/dimensions.py).
     
     Args:
     cur (psycopg2.cursor): Database cursor.
@@ -282,16 +285,8 @@ def insert_data_to_db(cur, data):
     Returns:
     int: Number of rows inserted.
     """
-    insert_query = """
-    INSERT INTO geospatial_data_gdl (gid, admin_level, date, variable, raw_value, note, source, metadata)
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-    ON CONFLICT (gid, admin_level, date, variable) DO UPDATE
-    SET raw_value = EXCLUDED.raw_value,
-        note = EXCLUDED.note,
-        source = EXCLUDED.source,
-        metadata = EXCLUDED.metadata
-    """
-    cur.executemany(insert_query, data)
+    columns = ('gid', 'admin_level', 'date', 'variable', 'raw_value', 'note', 'source', 'metadata')
+    copy_upsert(cur.connection, 'geospatial_data_gdl', columns, data, commit=False)
     return len(data)
 
 def main(gdl_folder, db_config):
@@ -2,7 +2,7 @@ import gc
 import glob
 import logging
 import os
-import shutil
+import sys
 import time
 from functools import partial
 from getpass import getpass
@@ -16,63 +16,106 @@ import rioxarray
 import xarray as xr
 from dask.diagnostics import ProgressBar
 from dask.distributed import Client
-from psycopg2.extras import execute_batch
 
 # from tqdm import tqdm
 from tqdm.auto import tqdm
 
+project_root = os.environ.get(
+    "PROJECT_ROOT",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")),
+)
+sys.path.append(project_root)
+from Geospatial_Lat_Long.cell_area import latitude_cell_area  # noqa: E402
+from Geospatial_Lat_Long.db_loader import copy_upsert  # noqa: E402
+from Geospatial_Lat_Long.ledger import (  # noqa: E402
+    finish_entries,
+    record_rows,
+    start_entry,
+)
+from Geospatial_Lat_Long.mask_cache import (  # noqa: E402
+    default_cache_dir,
+    touched_cell_count,
+)
+from Geospatial_Lat_Long.result_writer import (  # noqa: E402
+    ResultWriter,
+    bounded_imap_unordered,
+)
+from Geospatial_Lat_Long.scheduling import (  # noqa: E402
+    cost_ordered_batches,
+    pool_size,
+)
+from Geospatial_Lat_Long.shared_raster import (  # noqa: E402
+    attach,
+    share_dataarray,
+)
+from Geospatial_Lat_Long.simplified_gadm import (  # noqa: E402
+    SOURCE_RESOLUTIONS,
+    simplified_geopackage,
+)
+from Geospatial_Lat_Long.weight_matrix import (  # noqa: E402
+    get_level_weights,
+    grid_values,
+    level_zonal_stats,
+    stats_row_batches,
+)
+from Geospatial_Lat_Long.zarr_store import (  # noqa: E402
+    default_zarr_dir,
+    find_store,
+    open_store,
+    store_windows,
+    time_blocks,
+)
+
 logging.basicConfig(level=logging.INFO)
 
 
-def insert_data_to_db(data, conn, chunk_size=100000):
+COLUMNS = (
+    "gid",
+    "admin_level",
+    "date",
+    "variable",
+    "mean",
+    "min",
+    "max",
+    "missing_value_percentage",
+    "source",
+    "unit",
+    "weight_sum",
+    "weighted_sum",
+    "sum_sq",
+    "valid_count",
+)
+
+
+def insert_data_to_db(data, conn, entries=()):
     """
-    Insert data into the PostgreSQL database in chunks.
+    Load data into the database with COPY and a single set-based upsert.
 
-    :param data: List of tuples containing the data to be inserted
+    :param data: List of tuples in ``COLUMNS`` order
     :param conn: Database connection object
-    :param chunk_size: Number of rows to insert in each batch
+    :param entries: Processing ledger entries the rows belong to, recorded
+        in the same transaction
     """
-    cursor = conn.cursor()
-
-    for i in range(0, len(data), chunk_size):
-        data_chunk = data[i : i + chunk_size]
-        query = """
-        INSERT INTO geospatial_data_era5 (gid, admin_level, date, variable, mean, min, max, missing_value_percentage, source, unit)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (gid, admin_level, date, variable) 
-        DO UPDATE SET mean = EXCLUDED.mean, min = EXCLUDED.min, max = EXCLUDED.max, 
-                      missing_value_percentage = EXCLUDED.missing_value_percentage, source = EXCLUDED.source, unit = EXCLUDED.unit
-        """
-        execute_batch(cursor, query, data_chunk)
-        conn.commit()
-        print(f"Inserted chunk of {len(data_chunk)} rows.")
-
+    copy_upsert(
+        conn,
+        "geospatial_data_era5",
+        COLUMNS,
+        data,
+        commit=False,
+        track_periods=True,
+    )
+    record_rows(conn, entries, data)
     conn.commit()
 
 
 def calculate_cell_area(da):
     """
-    Calculate the area of each cell in the DataArray.
-    """
-    res_x, res_y = da.rio.resolution()
-    area_sq_degrees = np.abs(res_x * res_y)
+    Calculate the area of the cells of each row of the DataArray.
 
-    earth_radius = 6371000  # meters
-    lat_radians = np.deg2rad(da.latitude)
-
-    area = (
-        area_sq_degrees
-        * (np.pi / 180) ** 2
-        * earth_radius**2
-        * np.cos(lat_radians)
-    )
-    area_2d = np.tile(area, (da.sizes["longitude"], 1)).T
-
-    return xr.DataArray(
-        area_2d,
-        dims=("latitude", "longitude"),
-        coords={"latitude": da.latitude, "longitude": da.longitude},
-    )
+    The area only depends on the latitude, so a 1-D array along the
+    latitude is returned and broadcast against the data when weighting.
+    """
+    return latitude_cell_area(da)
 
 
 def calculate_daily_stats(da, geometry, cell_area, buffer_size=2):
@@ -81,9 +124,12 @@ def calculate_daily_stats(da, geometry, cell_area, buffer_size=2):
 
     :param da: xarray DataArray
     :param geometry: Shapely geometry object
-    :param cell_area: xarray DataArray with cell areas
+    :param cell_area: xarray DataArray with cell areas, or its shared handle
     :param buffer_size: Buffer size for calculating cell fractions (not used in this version)
-    :return: Tuple of daily mean, min, max, and missing value percentage
+    :return: Tuple of (daily statistics, missing value percentage). The daily statistics are the
+        mean, min, max, weight sum, weighted sum, weighted sum of squares and valid cell count,
+        or None when the geometry has no data. The missing value percentage is the share of the
+        touched cells that are NaN at each timestep, as in the weight matrix path
     """
     try:
         # Get the bounds of the geometry
@@ -102,17 +148,13 @@ def calculate_daily_stats(da, geometry, cell_area, buffer_size=2):
         # Check if there's any data in the clipped region
         if da_clipped.isnull().all():
             print(f"No data found in the geometry bounds: {geometry.bounds}")
-            return None, None, None, 100.0
+            return None, 100.0
 
         # Perform the precise clipping operation
         clipped = da_clipped.rio.clip([geometry], all_touched=True)
 
-        missing_value_percentage = (
-            clipped.isnull().sum() / clipped.size * 100
-        ).values
-
         if clipped.isnull().all():
-            return None, None, None, 100.0
+            return None, 100.0
 
         # Calculate weights (cell area for cells that intersect with the geometry)
         weights = cell_area.where(clipped.notnull())
@@ -120,116 +162,223 @@ def calculate_daily_stats(da, geometry, cell_area, buffer_size=2):
         # Calculate statistics
         weighted_sum = (clipped * weights).sum(dim=["latitude", "longitude"])
         weight_sum = weights.sum(dim=["latitude", "longitude"])
-        daily_mean = weighted_sum / weight_sum
-        daily_min = clipped.min(dim=["latitude", "longitude"], skipna=True)
-        daily_max = clipped.max(dim=["latitude", "longitude"], skipna=True)
+        valid_count = clipped.notnull().sum(dim=["latitude", "longitude"])
+        daily_stats = (
+            weighted_sum / weight_sum,
+            clipped.min(dim=["latitude", "longitude"], skipna=True),
+            clipped.max(dim=["latitude", "longitude"], skipna=True),
+            weight_sum,
+            weighted_sum,
+            (clipped * clipped * weights).sum(dim=["latitude", "longitude"]),
+            valid_count,
+        )
 
-        return daily_mean, daily_min, daily_max, missing_value_percentage
+        # Cells outside the geometry are NaN after the clip, so only the
+        # touched cells are counted
+        missing_value_percentage = 100.0 * (
+            1.0 - valid_count / touched_cell_count(clipped, geometry)
+        )
+
+        return daily_stats, missing_value_percentage
     except rioxarray.exceptions.NoDataInBounds:
         # If no data is found in bounds, return None values and 100% missing
         # logging.warning(f"No data found in bounds for geometry. Returning null values.")
-        return None, None, None, 100.0
+        return None, 100.0
 
 
-def process_geometry(
-    da_daily, variable_name, geometry, level, gid, cell_area, unit
+def geometry_rows(
+    gid,
+    level,
+    dates,
+    variable_name,
+    daily_stats,
+    missing_value_percentage,
+    unit,
 ):
     """
-    Process a single geometry to calculate daily statistics and prepare data for database insertion.
+    Build the database rows of one geometry and variable.
 
-    :param da_daily: xarray DataArray with daily data
+    :param gid: Geometry ID
+    :param level: Administrative level
+    :param dates: List of Python datetimes, one per timestep
     :param variable_name: Name of the variable
+    :param daily_stats: Tuple of computed daily statistics DataArrays (see
+        ``calculate_daily_stats``), or None when the geometry has no data
+    :param missing_value_percentage: Missing value percentages of the geometry, one per
+        timestep
+    :param unit: Unit of the variable
+    :return: List of tuples with processed data
+    """
+    if daily_stats is None:
+        return [
+            (
+                gid,
+                level,
+                date_py,
+                variable_name,
+                None,  # mean
+                None,  # min
+                None,  # max
+                100.0,  # missing_value_percentage (100% when no data)
+                "ERA5",
+                unit,
+                0.0,  # weight_sum
+                0.0,  # weighted_sum
+                0.0,  # sum_sq
+                0,  # valid_count
+            )
+            for date_py in dates
+        ]
+
+    (
+        mean_values,
+        min_values,
+        max_values,
+        weight_sums,
+        weighted_sums,
+        sums_sq,
+    ) = (
+        np.asarray(stat.values, dtype=float).tolist()
+        for stat in daily_stats[:6]
+    )
+    valid_counts = np.asarray(daily_stats[6].values, dtype=np.int64).tolist()
+    missing_values = np.round(
+        np.asarray(missing_value_percentage, dtype=float), 2
+    ).tolist()
+
+    return [
+        (
+            gid,
+            level,
+            date_py,
+            variable_name,
+            mean_val,
+            min_val,
+            max_val,
+            missing_val,
+            "ERA5",
+            unit,
+            weight_sum,
+            weighted_sum,
+            sum_sq,
+            valid_count,
+        )
+        for (
+            date_py,
+            mean_val,
+            min_val,
+            max_val,
+            missing_val,
+            weight_sum,
+            weighted_sum,
+            sum_sq,
+            valid_count,
+        ) in zip(
+            dates,
+            mean_values,
+            min_values,
+            max_values,
+            missing_values,
+            weight_sums,
+            weighted_sums,
+            sums_sq,
+            valid_counts,
+        )
+    ]
+
+
+def process_geometry(
+    da_stack, variables, geometry, level, gid, cell_area, units
+):
+    """
+    Process a single geometry for the variables of a stack with one clip.
+
+    :param da_stack: xarray DataArray with a leading "variable" dimension
+        (see ``open_variables``), or its shared handle
+    :param variables: Dictionary of variable codes to variable names
     :param geometry: Shapely geometry object
     :param level: Administrative level
     :param gid: Geometry ID
     :param cell_area: xarray DataArray with cell areas
-    :param unit: Unit of the variable
-    :return: List of tuples with processed data
+    :param units: Dictionary of variable codes to units
+    :return: List of tuples with processed data for all variables
     """
-    daily_mean, daily_min, daily_max, missing_value_percentage = (
-        calculate_daily_stats(da_daily, geometry, cell_area)
+    stack_stats, missing_value_percentage = calculate_daily_stats(
+        da_stack, geometry, cell_area
     )
 
+    dates = da_stack.time.values.astype("M8[ms]").astype("O").tolist()
+
+    if stack_stats is not None:
+        stack_stats, missing_value_percentage = dask.compute(
+            stack_stats, missing_value_percentage
+        )
+
     results = []
-    for date in da_daily.time.values:
-        date_py = date.astype("M8[ms]").astype("O")
-        if daily_mean is None:
-            results.append(
-                (
-                    gid,
-                    level,
-                    date_py,
-                    variable_name,
-                    None,  # mean
-                    None,  # min
-                    None,  # max
-                    100.0,  # missing_value_percentage (100% when no data)
-                    "ERA5",
-                    unit,
-                )
-            )
-        else:
-            mean_val = daily_mean.sel(time=date).values
-            min_val = daily_min.sel(time=date).values
-            max_val = daily_max.sel(time=date).values
-            results.append(
-                (
-                    gid,
-                    level,
-                    date_py,
-                    variable_name,
-                    float(mean_val),
-                    float(min_val),
-                    float(max_val),
-                    round(float(missing_value_percentage), 2),
-                    "ERA5",
-                    unit,
+    for index, var_code in enumerate(da_stack["variable"].values.tolist()):
+        daily_stats = None
+        missing = 100.0
+        if stack_stats is not None:
+            missing = missing_value_percentage.isel(variable=index)
+            if (missing < 100.0).any():
+                daily_stats = tuple(
+                    stat.isel(variable=index) for stat in stack_stats
                 )
+        results.extend(
+            geometry_rows(
+                gid,
+                level,
+                dates,
+                variables[var_code],
+                daily_stats,
+                missing,
+                units[var_code],
             )
-
+        )
     return results
 
 
-def process_batch(batch, da_daily, var_name, level, cell_area, unit):
+def process_batch(batch, da_stack, variables, level, cell_area, units):
     """
-    Process a batch of geometries to calculate daily statistics and prepare data for database insertion.
+    Process a batch of geometries for the variables of a stack, one clip per geometry.
 
     :param batch: GeoDataFrame with geometries
-    :param da_daily: xarray DataArray with daily data
-    :param var_name: Variable name
+    :param da_stack: Stacked xarray DataArray, or its shared handle
+    :param variables: Dictionary of variable codes to variable names
     :param level: Administrative level
-    :param cell_area: xarray DataArray with cell areas
-    :param unit: Unit of the variable
+    :param cell_area: xarray DataArray with cell areas, or its shared handle
+    :param units: Dictionary of variable codes to units
     :return: List of tuples with processed data
     """
+    da_stack = attach(da_stack)
+    cell_area = attach(cell_area)
+
     results = []
     gid_column = f"GID_{level}"
-    # Create a progress bar for this batch
     with tqdm(
         total=len(batch),
-        desc=f"Processing batch - {var_name} - level {level}",
+        desc=f"Processing batch - {len(variables)} variables - level {level}",
         leave=False,
     ) as pbar:
         for _, row in batch.iterrows():
-            result = process_geometry(
-                da_daily,
-                var_name,
-                row["geometry"],
-                level,
-                row[gid_column],
-                cell_area,
-                unit,
-            )
             results.extend(
-                result
-            )  # Always extend results, even if they contain null values
-            pbar.update(1)  # Update progress bar for each row
+                process_geometry(
+                    da_stack,
+                    variables,
+                    row["geometry"],
+                    level,
+                    row[gid_column],
+                    cell_area,
+                    units,
+                )
+            )
+            pbar.update(1)
     return results
 
 
 def find_files(data_directory, variable_name):
     """
-    Find all relevant files for a given variable, including those in processed folders.
+    Find all relevant files for a given variable, including those moved into processed folders by earlier versions.
 
     :param data_directory: Base directory for data files
     :param variable_name: Name of the variable to process
@@ -258,7 +407,9 @@ def find_files(data_directory, variable_name):
 
 def get_processed_level(file_path, data_directory):
     """
-    Determine the highest level at which a file has been processed.
+    Determine the highest level at which a file has been processed, from
+    the processed/level_N folder earlier versions moved it to. Progress is
+    now tracked in the processing ledger.
 
     :param file_path: Path to the file
     :param data_directory: Base directory for data files
@@ -276,145 +427,428 @@ def get_processed_level(file_path, data_directory):
     return -1
 
 
-def move_processed_file(file_path, data_directory, level):
+def group_files_by_period(data_directory, variables, level):
     """
-    Move the processed file to a nested folder structure reflecting the processed level.
+    Group the daily files of all variables by the period they cover.
+
+    The period is the part of the file name before the variable name, so
+    ``era5_2020_01_total_precipitation_daily_aggregated_sum.nc`` and
+    ``era5_2020_01_2m_temperature_daily_aggregated_mean.nc`` share the period
+    ``era5_2020_01``. Files moved into ``processed/level_N`` by earlier
+    versions at ``level`` are left out.
 
-    :param file_path: Path to the file to be moved
     :param data_directory: Base directory for data files
-    :param level: Administrative level that was processed
+    :param variables: Dictionary of variable codes to variable names
+    :param level: Administrative level
+    :return: Dictionary of period -> {variable code: file path}, sorted by period
     """
-    processed_folder = os.path.join(
-        data_directory, "processed", f"level_{level}"
-    )
-    os.makedirs(processed_folder, exist_ok=True)
+    groups = {}
+    for var_code, var_name in variables.items():
+        for file_path in find_files(data_directory, var_name):
+            processed_level = get_processed_level(file_path, data_directory)
+            if processed_level >= level:
+                print(
+                    f"Skipping {file_path} as it has already been processed at level {processed_level}"
+                )
+                continue
+            period = os.path.basename(file_path).split(
+                f"_{var_name}_daily_aggregated"
+            )[0]
+            groups.setdefault(period, {})[var_code] = file_path
+    return dict(sorted(groups.items()))
 
-    new_file_path = os.path.join(processed_folder, os.path.basename(file_path))
-    shutil.move(file_path, new_file_path)
 
-    print(f"Moved processed file {file_path} to {new_file_path}")
+def group_files(
+    data_directory, variables, level, zarr_dir=None, multi_variable=True
+):
+    """
+    Group the inputs of all variables into the units processed in one pass.
+
+    A variable with a Zarr store is a group of its own, since the store
+    already holds every period of the variable. The daily files of the
+    other variables are grouped by period (see ``group_files_by_period``),
+    or one file per group with ``multi_variable=False``.
+
+    :param data_directory: Base directory for data files
+    :param variables: Dictionary of variable codes to variable names
+    :param level: Administrative level
+    :param zarr_dir: Directory of the Zarr stores
+    :param multi_variable: Group the files of all variables of a period
+    :return: Dictionary of group label -> {variable code: file or store path}
+    """
+    groups = {}
+    file_variables = {}
+    for var_code, var_name in variables.items():
+        store = find_store(zarr_dir, "ERA5", var_name)
+        if store:
+            groups[var_name] = {var_code: store}
+        else:
+            file_variables[var_code] = var_name
+
+    for period, period_files in group_files_by_period(
+        data_directory, file_variables, level
+    ).items():
+        if multi_variable:
+            groups[period] = period_files
+            continue
+        for var_code, file_path in period_files.items():
+            groups[f"{period} {variables[var_code]}"] = {var_code: file_path}
+    return groups
+
+
+def group_windows(groups):
+    """
+    Split the groups into the time windows they are processed in.
+
+    A group of NetCDF files is processed whole. A Zarr store is processed
+    one time chunk at a time (see ``store_windows``), each chunk with its
+    own ledger entry, so days appended to the store only add work for the
+    chunks they were written to.
+
+    :param groups: Dictionary of group label -> {variable code: path}, see
+        ``group_files``
+    :return: List of (label, {variable code: path}, window, time slice,
+        checksum) tuples; window and checksum are None for NetCDF files
+    """
+    windows = []
+    for label, paths in groups.items():
+        stores = [
+            (var_code, path)
+            for var_code, path in paths.items()
+            if os.path.isdir(path)
+        ]
+        if not stores:
+            windows.append((label, paths, None, slice(None), None))
+            continue
+
+        # A store is a group of its own
+        ((var_code, store),) = stores
+        windows.extend(
+            (f"{label} {window}", paths, window, time_slice, checksum)
+            for window, time_slice, checksum in store_windows(store, var_code)
+        )
+    return windows
+
+
+def open_variables(files, use_dask=False, time_slice=slice(None)):
+    """
+    Open the files of one group and stack their variables along a
+    "variable" dimension.
+
+    Variables are only stacked when their grids and time axes match exactly;
+    otherwise every variable is returned as its own group. A single variable
+    is a stack of one.
+
+    :param files: Dictionary of variable codes to file or Zarr store paths
+    :param use_dask: Open the files lazily in Dask chunks (stores are always
+        opened lazily, in the chunks they were written with)
+    :param time_slice: Timesteps to stack
+    :return: List of (files, datasets, stacked DataArray, units) tuples
+    """
+    chunks = None
+    if use_dask:
+        chunks = {"time": 1, "latitude": 500, "longitude": 500}
+
+    datasets = {}
+    for var_code, file_path in files.items():
+        if os.path.isdir(file_path):
+            datasets[var_code] = open_store(file_path)
+        elif use_dask:
+            with dask.config.set(**{"array.slicing.split_large_chunks": True}):
+                datasets[var_code] = xr.open_dataset(file_path, chunks=chunks)
+        else:
+            datasets[var_code] = xr.open_dataset(file_path)
+    units = {
+        var_code: ds[var_code].attrs.get("units", "unknown")
+        for var_code, ds in datasets.items()
+    }
+
+    def stack(var_codes):
+        da_stack = (
+            xr.merge(
+                [datasets[var_code][var_code] for var_code in var_codes],
+                join="exact",
+            )[list(var_codes)]
+            .isel(time=time_slice)
+            .to_dataarray("variable")
+            .transpose("variable", "time", "latitude", "longitude")
+        )
+        da_stack = da_stack.rio.set_spatial_dims(
+            x_dim="longitude", y_dim="latitude"
+        )
+        return da_stack.rio.write_crs("EPSG:4326")
+
+    try:
+        return [(files, list(datasets.values()), stack(list(files)), units)]
+    except ValueError as e:
+        print(f"Grids differ, processing variables one at a time: {e}")
+        return [
+            (
+                {var_code: files[var_code]},
+                [datasets[var_code]],
+                stack([var_code]),
+                {var_code: units[var_code]},
+            )
+            for var_code in files
+        ]
 
 
 def process_level(
-    geopackage_path, level, data_directory, variables, db_conn, use_dask=False
+    geopackage_path,
+    level,
+    data_directory,
+    variables,
+    db_conn,
+    use_dask=False,
+    use_weight_matrix=False,
+    cache_dir=None,
+    zarr_dir=None,
+    output_levels=None,
+    multi_variable=True,
 ):
     """
     Process a specific administrative level to calculate daily statistics and insert data into the database.
+
+    The files of all variables covering the same period are opened together
+    and stacked, so every polygon is clipped (or its weights applied) once
+    for all variables instead of once per variable. A variable read from its
+    Zarr store, or from its own file with ``multi_variable=False``, is a
+    stack of one.
+
+    :param use_weight_matrix: Compute all polygons at once from a persisted sparse weight matrix
+        instead of clipping each polygon
+    :param cache_dir: Mask cache directory holding the persisted rasterizations
+    :param zarr_dir: Directory of the Zarr stores; a variable with a store is
+        read from it instead of its NetCDF files
+    :param output_levels: Levels to insert, rolled up from the statistics of ``level``
+        through the GID hierarchy (weight matrix only); defaults to ``[level]``
+    :param multi_variable: Stack the files of all variables of a period
     """
-    print(f"Processing level {level}")
+    output_levels = output_levels or [level]
+    if output_levels != [level] and not use_weight_matrix:
+        raise ValueError("Rolling levels up requires the weight matrix")
+    levels_label = ", ".join(map(str, output_levels))
+    print(f"Processing level {level} (inserting level {levels_label})")
 
     gdf = gpd.read_file(geopackage_path, layer=f"ADM_{level}")
     gdf = gdf.to_crs("EPSG:4326")
 
     gid_column = f"GID_{level}"
-    gdf = gdf[[gid_column, "geometry"]]
+    gdf = gdf[
+        [f"GID_{n}" for n in sorted(set(output_levels) | {level})]
+        + ["geometry"]
+    ]
 
     all_results_len = 0
 
-    # Determine the optimal batch size and number of processes
-    num_rows = len(gdf)
-    num_processes = min(6, num_rows)
-    batch_size = max(1, num_rows // num_processes)
+    # Weight matrices and roll-ups, built once per grid for all files
+    plans = {}
 
-    with Pool(processes=num_processes) as pool:
-        for var_code, var_name in variables.items():
-            matching_files = find_files(data_directory, var_name)
+    groups = group_files(
+        data_directory,
+        variables,
+        max(output_levels),
+        zarr_dir=zarr_dir,
+        multi_variable=multi_variable,
+    )
+    if not groups:
+        print(f"No files to process at level {levels_label}")
+        return all_results_len
 
-            if not matching_files:
-                print(f"No file found for {var_name}")
-                continue
+    # Size the pool from the available cores and memory
+    num_processes = pool_size(len(gdf))
 
-            for file_path in matching_files:
-                processed_level = get_processed_level(
-                    file_path, data_directory
+    with Pool(processes=num_processes) as pool:
+        for (
+            label,
+            group_paths,
+            window,
+            time_slice,
+            checksum,
+        ) in group_windows(groups):
+            entries = {
+                (var_code, output_level): start_entry(
+                    db_conn,
+                    "ERA5",
+                    file_path,
+                    variables[var_code],
+                    output_level,
+                    "all_touched",
+                    window=window,
+                    checksum=checksum,
                 )
-                if processed_level >= level:
-                    print(
-                        f"Skipping {file_path} as it has already been processed at level {processed_level}"
-                    )
-                    continue
+                for var_code, file_path in group_paths.items()
+                for output_level in output_levels
+            }
+            group_paths = {
+                var_code: file_path
+                for var_code, file_path in group_paths.items()
+                if not all(
+                    entries[var_code, output_level].done
+                    for output_level in output_levels
+                )
+            }
+            if not group_paths:
+                print(
+                    f"Skipping {label} as it has already been processed at level {levels_label}"
+                )
+                continue
 
-                print(f"Processing {var_name} from file: {file_path}")
+            for files, datasets, da_stack, units in open_variables(
+                group_paths, use_dask, time_slice
+            ):
+                group_variables = {
+                    var_code: variables[var_code] for var_code in files
+                }
+                group_entries = [
+                    entries[var_code, output_level]
+                    for var_code in files
+                    for output_level in output_levels
+                ]
+                print(
+                    f"Processing {', '.join(group_variables.values())} for {label}"
+                )
 
                 start_time = time.time()
 
-                if use_dask:
-                    with dask.config.set(
-                        **{"array.slicing.split_large_chunks": True}
-                    ):
-                        ds_daily = xr.open_dataset(
-                            file_path,
-                            chunks={
-                                "time": 1,
-                                "latitude": 500,
-                                "longitude": 500,
-                            },
-                        )
-                        da_daily = ds_daily[var_code]
-                else:
-                    ds_daily = xr.open_dataset(file_path)
-                    da_daily = ds_daily[var_code]
-
-                da_daily = da_daily.rio.set_spatial_dims(
-                    x_dim="longitude", y_dim="latitude", inplace=True
-                )
-                da_daily = da_daily.rio.write_crs("EPSG:4326", inplace=True)
+                # A store is read one time chunk at a time
+                stored = any(os.path.isdir(path) for path in files.values())
 
-                cell_area = calculate_cell_area(da_daily)
-                unit = da_daily.attrs.get("units", "unknown")
+                cell_area = calculate_cell_area(da_stack)
 
                 try:
-                    batches = [
-                        gdf.iloc[i : i + batch_size]
-                        for i in range(0, len(gdf), batch_size)
-                    ]
-
-                    process_batch_partial = partial(
-                        process_batch,
-                        da_daily=da_daily,
-                        var_name=var_name,
-                        level=level,
-                        cell_area=cell_area,
-                        unit=unit,
+                    # Rows are loaded on a writer thread while the next
+                    # ones are computed
+                    with ResultWriter(insert_data_to_db) as writer:
+                        if use_weight_matrix:
+                            plan = get_level_weights(
+                                gdf,
+                                gid_column,
+                                da_stack,
+                                cell_area.values,
+                                cache_dir,
+                                geopackage_path,
+                                level,
+                                output_levels,
+                                plans=plans,
+                            )
+                            blocks = (
+                                time_blocks(da_stack) if stored else [da_stack]
+                            )
+                            for block in blocks:
+                                for (
+                                    var_code,
+                                    var_name,
+                                ) in group_variables.items():
+                                    for (
+                                        output_level,
+                                        gids,
+                                        stats,
+                                    ) in level_zonal_stats(
+                                        plan,
+                                        grid_values(
+                                            block.sel(variable=var_code)
+                                        ),
+                                    ):
+                                        for rows in stats_row_batches(
+                                            gids,
+                                            output_level,
+                                            block.time.values,
+                                            var_name,
+                                            stats,
+                                            "ERA5",
+                                            units[var_code],
+                                        ):
+                                            all_results_len += len(rows)
+                                            writer.put(
+                                                rows,
+                                                db_conn,
+                                                [
+                                                    entries[
+                                                        var_code, output_level
+                                                    ]
+                                                ],
+                                            )
+                        else:
+                            # Polygons loaded for every variable of the group by
+                            # an interrupted run are skipped
+                            completed_gids = set.intersection(
+                                *(
+                                    entry.completed_gids
+                                    for entry in group_entries
+                                )
+                            )
+                            pending = gdf[
+                                ~gdf[gid_column].isin(completed_gids)
+                            ]
+
+                            # Most expensive polygons first, in chunks of
+                            # similar cost that idle workers pick up in turn
+                            batches = cost_ordered_batches(
+                                pending,
+                                num_processes,
+                                da_stack.rio.resolution(),
+                            )
+
+                            # Workers attach to one shared copy of the grids
+                            # instead of unpickling them for every batch
+                            with share_dataarray(
+                                da_stack
+                            ) as shared_da, share_dataarray(
+                                cell_area
+                            ) as shared_area:
+                                process_batch_partial = partial(
+                                    process_batch,
+                                    da_stack=shared_da,
+                                    variables=group_variables,
+                                    level=level,
+                                    cell_area=shared_area,
+                                    units=units,
+                                )
+
+                                with tqdm(
+                                    total=len(pending),
+                                    desc=f"Overall progress: {label} - level {level}",
+                                ) as overall_pbar:
+                                    # Every batch is loaded and recorded in
+                                    # the ledger as soon as it arrives; at
+                                    # most two batches per worker are in
+                                    # flight while the writer catches up
+                                    for batch_rows in bounded_imap_unordered(
+                                        pool,
+                                        process_batch_partial,
+                                        batches,
+                                        2 * num_processes,
+                                    ):
+                                        all_results_len += len(batch_rows)
+                                        writer.put(
+                                            batch_rows, db_conn, group_entries
+                                        )
+                                        overall_pbar.update(
+                                            len(batch_rows)
+                                            // (
+                                                len(group_variables)
+                                                * da_stack.sizes["time"]
+                                            )
+                                        )
+
+                    finish_entries(
+                        db_conn, group_entries, time.time() - start_time
                     )
 
-                    with tqdm(
-                        total=len(gdf),
-                        desc=f"Overall progress: {var_name} - level {level}",
-                    ) as overall_pbar:
-                        results = []
-                        for batch_result in pool.imap(
-                            process_batch_partial, batches
-                        ):
-                            results.extend(batch_result)
-                            overall_pbar.update(len(batch_result))
-
-                    flat_results = [item for item in results if item]
-
-                    if flat_results:
-                        all_results_len += len(flat_results)
-                        insert_data_to_db(flat_results, db_conn)
-                        print(
-                            f"Inserted {len(flat_results)} rows for {var_name} at level {level}"
-                        )
-
-                        # Move the processed file to the nested folder structure
-                        move_processed_file(file_path, data_directory, level)
-
                 finally:
-                    ds_daily.close()
+                    for ds in datasets:
+                        ds.close()
                     gc.collect()
 
                 end_time = time.time()
 
-                print(
-                    f"\n{var_name} from file: {file_path} - Level {level} Results:"
-                )
+                print(f"\n{label} - Level {levels_label} Results:")
                 print(
                     f"Processed {all_results_len} rows in {end_time - start_time:.2f} seconds"
                 )
 
-    print(f"\nProcessing complete for level {level}")
+    print(f"\nProcessing complete for level {levels_label}")
     return all_results_len
 
 
@@ -448,11 +882,34 @@ def main():
 
     levels = [0, 1]
 
+    # Persisted polygon-to-cell weight matrices, shared by every file on the same grid
+    use_weight_matrix = True
+    cache_directory = default_cache_dir(geopackage_file_path)
+
+    # Polygons simplified for the grid by simplified_gadm.py, when built
+    geopackage_file_path = simplified_geopackage(
+        geopackage_file_path, SOURCE_RESOLUTIONS["ERA5"], cache_directory
+    )
+
+    # Derive the levels from the level 2 statistics in one pass over the
+    # files instead of one pass per level (weight matrix only)
+    rollup_base_level = 2
+    if use_weight_matrix and rollup_base_level is not None:
+        level_runs = [(rollup_base_level, levels)]
+    else:
+        level_runs = [(level, [level]) for level in levels]
+
+    # Time-chunked Zarr stores written by zarr_store.py, used when present
+    zarr_directory = default_zarr_dir(data_directory)
+
+    # Process all variables of a period together (one clip per polygon)
+    multi_variable = True
+
     # Set up Dask client
     client = Client(processes=False, threads_per_worker=6, n_workers=1)
 
     try:
-        for level in levels:
+        for level, output_levels in level_runs:
             start_time = time.time()
 
             if level < 2:
@@ -464,6 +921,11 @@ def main():
                     variables,
                     conn,
                     use_dask=False,
+                    use_weight_matrix=use_weight_matrix,
+                    cache_dir=cache_directory,
+                    zarr_dir=zarr_directory,
+                    output_levels=output_levels,
+                    multi_variable=multi_variable,
                 )
             else:
                 print("Using Dask")
@@ -475,11 +937,16 @@ def main():
                         variables,
                         conn,
                         use_dask=True,
+                        use_weight_matrix=use_weight_matrix,
+                        cache_dir=cache_directory,
+                        zarr_dir=zarr_directory,
+                        output_levels=output_levels,
+                        multi_variable=multi_variable,
                     )
 
             end_time = time.time()
 
-            print(f"\nLevel {level} Results:")
+            print(f"\nLevel {', '.join(map(str, output_levels))} Results:")
             print(
                 f"Processed {all_results_len} rows in {end_time - start_time:.2f} seconds"
             )
@@ -2,6 +2,7 @@ import gc
 import glob
 import logging
 import os  # Import os module to handle file operations
+import sys
 import time
 from functools import partial
 from getpass import getpass
@@ -11,169 +12,276 @@ import dask
 import geopandas as gpd
 import numpy as np
 import psycopg2
+import shapely
 import xarray as xr
 from dask.diagnostics import ProgressBar
 from dask.distributed import Client
-from psycopg2.extras import execute_batch
-from rasterio import features
-from shapely.geometry import box
+from rasterio import features, windows
 
 # from tqdm import tqdm
 from tqdm.auto import tqdm
 
+project_root = os.environ.get(
+    "PROJECT_ROOT",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")),
+)
+sys.path.append(project_root)
+from Geospatial_Lat_Long.cell_area import latitude_cell_area  # noqa: E402
+from Geospatial_Lat_Long.db_loader import copy_upsert  # noqa: E402
+from Geospatial_Lat_Long.ledger import (  # noqa: E402
+    finish_entries,
+    record_rows,
+    start_entry,
+)
+from Geospatial_Lat_Long.mask_cache import (  # noqa: E402
+    coverage_cells,
+    default_cache_dir,
+    geometry_window,
+    get_coverage_matrix,
+)
+from Geospatial_Lat_Long.scheduling import (  # noqa: E402
+    cost_ordered_batches,
+    pool_size,
+)
+from Geospatial_Lat_Long.shared_raster import (  # noqa: E402
+    attach,
+    share_dataarray,
+)
+
 logging.basicConfig(level=logging.INFO)
 
 
-def insert_data_to_db(data, conn, chunk_size=100000):
+COLUMNS = (
+    "gid",
+    "admin_level",
+    "date",
+    "variable",
+    "mean",
+    "min",
+    "max",
+    "missing_value_percentage",
+    "source",
+    "unit",
+    "weight_sum",
+    "weighted_sum",
+    "sum_sq",
+    "valid_count",
+)
+
+
+def insert_data_to_db(data, conn, entries=()):
     """
-    Insert data into the PostgreSQL database in chunks.
+    Load data into the database with COPY and a single set-based upsert.
 
-    :param data: List of tuples containing the data to be inserted
+    :param data: List of tuples in ``COLUMNS`` order
     :param conn: Database connection object
-    :param chunk_size: Number of rows to insert in each batch
+    :param entries: Processing ledger entries the rows belong to, recorded
+        in the same transaction
     """
-    cursor = conn.cursor()
-
-    for i in range(0, len(data), chunk_size):
-        data_chunk = data[i : i + chunk_size]
-        query = """
-        INSERT INTO geospatial_data_era5 (gid, admin_level, date, variable, mean, min, max, missing_value_percentage, source, unit)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (gid, admin_level, date, variable) 
-        DO UPDATE SET mean = EXCLUDED.mean, min = EXCLUDED.min, max = EXCLUDED.max, 
-                      missing_value_percentage = EXCLUDED.missing_value_percentage, source = EXCLUDED.source, unit = EXCLUDED.unit
-        """
-        execute_batch(cursor, query, data_chunk)
-        conn.commit()
-        print(f"Inserted chunk of {len(data_chunk)} rows.")
-
+    copy_upsert(
+        conn,
+        "geospatial_data_era5",
+        COLUMNS,
+        data,
+        commit=False,
+        track_periods=True,
+    )
+    record_rows(conn, entries, data)
     conn.commit()
 
 
 def calculate_cell_area(da):
     """
-    Calculate the area of each cell in the DataArray.
+    Calculate the area of the cells of each row of the DataArray.
+
+    The area only depends on the latitude, so a 1-D array along the
+    latitude is returned and broadcast against the data when weighting.
+    """
+    return latitude_cell_area(da)
+
+
+def window_cell_fractions(geometry, transform, raster_shape):
     """
-    res_x, res_y = da.rio.resolution()
-    area_sq_degrees = np.abs(res_x * res_y)
+    Calculate the fraction of the cells of the geometry's cell window covered by the geometry.
 
-    earth_radius = 6371000  # meters
-    lat_radians = np.deg2rad(da.latitude)
+    Only the window around the geometry bounds is rasterized. Touched cells
+    that lie inside the geometry get 1, the cells crossed by its boundary get
+    their exact coverage from vectorized Shapely intersections, computed one
+    row of the window at a time against the part of the geometry in that row.
 
-    area = (
-        area_sq_degrees
-        * (np.pi / 180) ** 2
-        * earth_radius**2
-        * np.cos(lat_radians)
+    :param geometry: Shapely geometry object
+    :param transform: Affine transform of the full grid
+    :param raster_shape: Tuple of (height, width) of the full grid
+    :return: Tuple of ((row_start, row_stop, col_start, col_stop), fractions)
+        with the fractions of the window cells, or None when the geometry is
+        outside the grid
+    """
+    row_start, row_stop, col_start, col_stop = geometry_window(
+        geometry, transform, raster_shape
     )
-    area_2d = np.tile(area, (da.sizes["longitude"], 1)).T
+    if row_start >= row_stop or col_start >= col_stop:
+        return None
 
-    return xr.DataArray(
-        area_2d,
-        dims=("latitude", "longitude"),
-        coords={"latitude": da.latitude, "longitude": da.longitude},
+    window = windows.Window(
+        col_start, row_start, col_stop - col_start, row_stop - row_start
+    )
+    touched = features.geometry_mask(
+        [geometry],
+        out_shape=(row_stop - row_start, col_stop - col_start),
+        transform=windows.transform(window, transform),
+        all_touched=True,
+        invert=True,
+    )
+    fractions = touched.astype(np.float64)
+    bounds = (row_start, row_stop, col_start, col_stop)
+
+    rows, cols = np.nonzero(touched)
+    if rows.size == 0:
+        return bounds, fractions
+
+    # Cell boxes from the corners in full grid coordinates
+    x1, y1 = transform * (cols + col_start, rows + row_start)
+    x2, y2 = transform * (cols + col_start + 1, rows + row_start + 1)
+    cells = shapely.box(
+        np.minimum(x1, x2),
+        np.minimum(y1, y2),
+        np.maximum(x1, x2),
+        np.maximum(y1, y2),
     )
 
+    shapely.prepare(geometry)
+    boundary = ~shapely.contains_properly(geometry, cells)
+
+    for row in np.unique(rows[boundary]):
+        in_row = boundary & (rows == row)
+        row_cells = cells[in_row]
+        # Part of the geometry in this row, so each cell is intersected with
+        # a small polygon instead of the whole geometry
+        xmin, ymin, xmax, ymax = shapely.total_bounds(row_cells)
+        strip = shapely.intersection(
+            geometry, shapely.box(xmin, ymin, xmax, ymax)
+        )
+        fractions[row, cols[in_row]] = shapely.area(
+            shapely.intersection(row_cells, strip)
+        ) / shapely.area(row_cells)
+
+    return bounds, fractions
+
+
+def calculate_cell_fraction_array(geometry, transform, raster_shape):
+    """
+    Calculate the fraction of each grid cell covered by the geometry as a NumPy array.
+    """
+    fractions = np.zeros(raster_shape)
+    result = window_cell_fractions(geometry, transform, raster_shape)
+    if result is not None:
+        (row_start, row_stop, col_start, col_stop), window = result
+        fractions[row_start:row_stop, col_start:col_stop] = window
+    return fractions
+
+
+def cell_fraction_coverage(geometry, transform, raster_shape):
+    """
+    Return the (rows, cols, fractions) of the cells covered by the geometry, for the mask cache.
+    """
+    result = window_cell_fractions(geometry, transform, raster_shape)
+    if result is None:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=np.float64)
+
+    (row_start, _, col_start, _), fractions = result
+    rows, cols = np.nonzero(fractions)
+    return rows + row_start, cols + col_start, fractions[rows, cols]
+
 
-def calculate_cell_fractions(da, geometry, buffer_size=2):
+def calculate_cell_fractions(da, geometry):
     """
-    Calculate cell fractions for the given DataArray and geometry.
+    Calculate cell fractions for the given DataArray and geometry, over the
+    cell window of the geometry only.
     """
     transform = da.rio.transform()
     raster_shape = (da.sizes["latitude"], da.sizes["longitude"])
 
-    rasterized = features.rasterize(
-        [geometry],
-        out_shape=raster_shape,
-        transform=transform,
-        all_touched=True,
-        dtype=float,
+    result = window_cell_fractions(geometry, transform, raster_shape)
+    if result is None:
+        row_start = row_stop = col_start = col_stop = 0
+        fractions = np.zeros((0, 0))
+    else:
+        (row_start, row_stop, col_start, col_stop), fractions = result
+
+    return xr.DataArray(
+        fractions,
+        dims=("latitude", "longitude"),
+        coords={
+            "latitude": da.latitude[row_start:row_stop],
+            "longitude": da.longitude[col_start:col_stop],
+        },
     )
 
-    boundary = np.zeros_like(rasterized, dtype=bool)
-    for i in range(-buffer_size, buffer_size + 1):
-        for j in range(-buffer_size, buffer_size + 1):
-            if i == 0 and j == 0:
-                continue
-            boundary = np.logical_or(
-                boundary,
-                np.logical_and(
-                    rasterized > 0,
-                    np.roll(np.roll(rasterized == 0, i, axis=0), j, axis=1),
-                ),
-            )
 
-    y_coords, x_coords = np.where(boundary)
-    for y, x in zip(y_coords, x_coords):
-        x1, y1 = transform * (x, y)
-        x2, y2 = transform * (x + 1, y + 1)
-        cell = box(min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
-        intersection = cell.intersection(geometry)
-        rasterized[y, x] = intersection.area / cell.area
+def cached_cell_fractions(da, coverage, index):
+    """
+    Expand one polygon row of a cached fractional coverage matrix into a cell
+    fraction DataArray over the window of its cells.
+    """
+    cells, values = coverage_cells(coverage, index)
+    rows, cols = np.divmod(cells, da.sizes["longitude"])
+    if cells.size == 0:
+        row_start = row_stop = col_start = col_stop = 0
+    else:
+        row_start, row_stop = rows.min(), rows.max() + 1
+        col_start, col_stop = cols.min(), cols.max() + 1
+
+    fractions = np.zeros((row_stop - row_start, col_stop - col_start))
+    fractions[rows - row_start, cols - col_start] = values
 
-    result = xr.DataArray(
-        rasterized,
+    return xr.DataArray(
+        fractions,
         dims=("latitude", "longitude"),
-        coords={"latitude": da.latitude, "longitude": da.longitude},
+        coords={
+            "latitude": da.latitude[row_start:row_stop],
+            "longitude": da.longitude[col_start:col_stop],
+        },
     )
 
-    # # Check for fractional values
-    # fractional_cells = ((result > 0) & (result < 1)).sum().item()
-    # non_zero_cells = (result != 0).sum().item()
-    # total_cells = result.size
-
-    # print(f"Fractional cells: {fractional_cells} out of {total_cells} ({fractional_cells/total_cells*100:.2f}%)")
-    # print(f"Non-zero cells: {non_zero_cells} out of {total_cells} ({non_zero_cells/total_cells*100:.2f}%)")
-
-    # # Zoom in on the area of interest
-    # lon_min, lat_min, lon_max, lat_max = geometry.bounds
-    # lon_buffer = 2  # Add 2 degrees buffer
-    # lat_buffer = 2
-    # def get_lat_order(da):
-    #     """Determine if latitude is in descending (North to South) or ascending (South to North) order."""
-    #     return 'descending' if (da.latitude.diff('latitude') < 0).all().item() else 'ascending'
-
-    # lat_order = get_lat_order(da)
-    # print("Latitude order:", lat_order, f'{'90:-90' if lat_order == 'descending' else '-90:90'}')
-    # zoomed_fractions = result.sel(
-    #     longitude=slice(lon_min - lon_buffer, lon_max + lon_buffer),
-    #     latitude=slice(lat_max + lat_buffer, lat_min - lat_buffer) if lat_order == 'descending' else slice(lat_min - lat_buffer, lat_max + lat_buffer)
-    # )
-
-    # # Plotting
-    # plt.figure(figsize=(12, 8))
-    # if zoomed_fractions.size > 0 and zoomed_fractions.notnull().any():
-    #     zoomed_fractions.plot()
-    #     plt.title('Zoomed Cell Fractions')
-    # else:
-    #     plt.text(0.5, 0.5, "No data to plot", ha='center', va='center')
-    #     plt.title('Zoomed Cell Fractions (Empty)')
-    # plt.show()
-
-    return result
 
-
-def calculate_daily_stats(da, geometry, cell_area, buffer_size=2):
+def calculate_daily_stats(
+    da, geometry, cell_area, buffer_size=2, cell_fractions=None
+):
     """
     Calculate daily statistics for the given DataArray and geometry.
 
     :param da: xarray DataArray
     :param geometry: Shapely geometry object
     :param cell_area: xarray DataArray with cell areas
-    :param buffer_size: Buffer size for calculating cell fractions
-    :return: Tuple of daily mean, min, max, and missing value percentage
+    :param buffer_size: Buffer size for calculating cell fractions (not used in this version)
+    :param cell_fractions: Precomputed cell fractions (e.g. from the mask cache), computed if None
+    :return: Tuple of (daily statistics, missing value percentage). The daily statistics are the
+        mean, min, max, weight sum, weighted sum, weighted sum of squares and valid cell count,
+        or None when the geometry has no data
     """
-    cell_fractions = calculate_cell_fractions(
-        da, geometry, buffer_size=buffer_size
+    if cell_fractions is None:
+        cell_fractions = calculate_cell_fractions(da, geometry)
+
+    # Clip inside the cell window of the geometry instead of the full grid
+    row_start, row_stop, col_start, col_stop = geometry_window(
+        geometry,
+        da.rio.transform(),
+        (da.sizes["latitude"], da.sizes["longitude"]),
     )
-    clipped = da.rio.clip([geometry], all_touched=True)
+    if row_start >= row_stop or col_start >= col_stop:
+        return None, 100.0
+    clipped = da.isel(
+        latitude=slice(row_start, row_stop),
+        longitude=slice(col_start, col_stop),
+    ).rio.clip([geometry], all_touched=True)
 
     missing_value_percentage = (
         clipped.isnull().sum() / clipped.size * 100
     ).values
 
     if clipped.isnull().all():
-        return None, None, None, missing_value_percentage
+        return None, missing_value_percentage
 
     weights = cell_area * cell_fractions
     weighted_sum = (clipped * weights).sum(dim=["latitude", "longitude"])
@@ -210,11 +318,29 @@ def calculate_daily_stats(da, geometry, cell_area, buffer_size=2):
     # else:
     #     print("No data available for plotting. The selected area might not have any valid data.")
 
-    return daily_mean, daily_min, daily_max, missing_value_percentage
+    daily_stats = (
+        daily_mean,
+        daily_min,
+        daily_max,
+        # The weight sum of the mean, so that weighted_sum / weight_sum
+        # reproduces it
+        weight_sum.broadcast_like(daily_mean),
+        weighted_sum,
+        (clipped * clipped * weights).sum(dim=["latitude", "longitude"]),
+        clipped.notnull().sum(dim=["latitude", "longitude"]),
+    )
+    return daily_stats, missing_value_percentage
 
 
 def process_geometry(
-    da_daily, variable_name, geometry, level, gid, cell_area, unit
+    da_daily,
+    variable_name,
+    geometry,
+    level,
+    gid,
+    cell_area,
+    unit,
+    cell_fractions=None,
 ):
     """
     Process a single geometry to calculate daily statistics and prepare data for database insertion.
@@ -226,64 +352,109 @@ def process_geometry(
     :param gid: Geometry ID
     :param cell_area: xarray DataArray with cell areas
     :param unit: Unit of the variable
+    :param cell_fractions: Precomputed cell fractions, computed if None
     :return: List of tuples with processed data
     """
-    daily_mean, daily_min, daily_max, missing_value_percentage = (
-        calculate_daily_stats(da_daily, geometry, cell_area)
+    daily_stats, missing_value_percentage = calculate_daily_stats(
+        da_daily, geometry, cell_area, cell_fractions=cell_fractions
     )
 
-    results = []
-    for date in da_daily.time.values:
-        date_py = date.astype("M8[ms]").astype("O")
-        if daily_mean is None:
-            results.append(
-                (
-                    gid,
-                    level,
-                    date_py,
-                    variable_name,
-                    None,  # mean
-                    None,  # min
-                    None,  # max
-                    100.0,  # missing_value_percentage (100% when no data)
-                    "ERA5",
-                    unit,
-                )
-            )
-        else:
-            mean_val = daily_mean.sel(time=date).values
-            min_val = daily_min.sel(time=date).values
-            max_val = daily_max.sel(time=date).values
-            results.append(
-                (
-                    gid,
-                    level,
-                    date_py,
-                    variable_name,
-                    float(mean_val),
-                    float(min_val),
-                    float(max_val),
-                    round(float(missing_value_percentage), 2),
-                    "ERA5",
-                    unit,
-                )
-            )
-
-    return results
-
+    dates = da_daily.time.values.astype("M8[ms]").astype("O").tolist()
 
-def process_batch(batch, da_daily, var_name, level, cell_area, unit):
+    if daily_stats is None:
+        return [
+            (
+                gid,
+                level,
+                date_py,
+                variable_name,
+                None,  # mean
+                None,  # min
+                None,  # max
+                100.0,  # missing_value_percentage (100% when no data)
+                "ERA5",
+                unit,
+                0.0,  # weight_sum
+                0.0,  # weighted_sum
+                0.0,  # sum_sq
+                0,  # valid_count
+            )
+            for date_py in dates
+        ]
+
+    # Materialize the whole time series once instead of indexing it per date
+    daily_stats = dask.compute(*daily_stats)
+    (
+        mean_values,
+        min_values,
+        max_values,
+        weight_sums,
+        weighted_sums,
+        sums_sq,
+    ) = (
+        np.asarray(stat.values, dtype=float).tolist()
+        for stat in daily_stats[:6]
+    )
+    valid_counts = np.asarray(daily_stats[6].values, dtype=np.int64).tolist()
+    missing_value_percentage = round(float(missing_value_percentage), 2)
+
+    return [
+        (
+            gid,
+            level,
+            date_py,
+            variable_name,
+            mean_val,
+            min_val,
+            max_val,
+            missing_value_percentage,
+            "ERA5",
+            unit,
+            weight_sum,
+            weighted_sum,
+            sum_sq,
+            valid_count,
+        )
+        for (
+            date_py,
+            mean_val,
+            min_val,
+            max_val,
+            weight_sum,
+            weighted_sum,
+            sum_sq,
+            valid_count,
+        ) in zip(
+            dates,
+            mean_values,
+            min_values,
+            max_values,
+            weight_sums,
+            weighted_sums,
+            sums_sq,
+            valid_counts,
+        )
+    ]
+
+
+def process_batch(
+    batch, da_daily, var_name, level, cell_area, unit, coverage=None
+):
     """
     Process a batch of geometries to calculate daily statistics and prepare data for database insertion.
 
     :param batch: GeoDataFrame with geometries
-    :param da_daily: xarray DataArray with daily data
+    :param da_daily: xarray DataArray with daily data, or its shared handle
     :param var_name: Variable name
     :param level: Administrative level
-    :param cell_area: xarray DataArray with cell areas
+    :param cell_area: xarray DataArray with cell areas, or its shared handle
     :param unit: Unit of the variable
+    :param coverage: Cached fractional coverage matrix, one row per position in the level's GeoDataFrame
     :return: List of tuples with processed data
     """
+    da_daily = attach(da_daily)
+    cell_area = attach(cell_area)
+
     results = []
     gid_column = f"GID_{level}"
     # Create a progress bar for this batch
@@ -292,7 +463,12 @@ def process_batch(batch, da_daily, var_name, level, cell_area, unit):
         desc=f"Processing batch - {var_name} - level {level}",
         leave=False,
     ) as pbar:
-        for _, row in batch.iterrows():
+        for index, row in batch.iterrows():
+            cell_fractions = None
+            if coverage is not None:
+                cell_fractions = cached_cell_fractions(
+                    da_daily, coverage, index
+                )
             result = process_geometry(
                 da_daily,
                 var_name,
@@ -301,6 +477,7 @@ def process_batch(batch, da_daily, var_name, level, cell_area, unit):
                 row[gid_column],
                 cell_area,
                 unit,
+                cell_fractions=cell_fractions,
             )
             results.extend(
                 result
@@ -310,29 +487,31 @@ def process_batch(batch, da_daily, var_name, level, cell_area, unit):
 
 
 def process_level(
-    geopackage_path, level, data_directory, variables, db_conn, use_dask=False
+    geopackage_path,
+    level,
+    data_directory,
+    variables,
+    db_conn,
+    use_dask=False,
+    cache_dir=None,
 ):
     """
     Process a specific administrative level to calculate daily statistics and insert data into the database.
+
+    :param cache_dir: Mask cache directory; cell fractions are rebuilt for every file if None
     """
     print(f"Processing level {level}")
 
     gdf = gpd.read_file(geopackage_path, layer=f"ADM_{level}")
-    gdf = gdf.to_crs("EPSG:4326")
+    gdf = gdf.to_crs("EPSG:4326").reset_index(drop=True)
 
     gid_column = f"GID_{level}"
     gdf = gdf[[gid_column, "geometry"]]
 
     all_results_len = 0
 
-    # Determine the optimal batch size and number of processes
-    num_rows = len(gdf)
-    num_processes = min(
-        6, num_rows
-    )  # Use at most 6 processes, but not more than the number of rows
-    batch_size = max(
-        1, num_rows // num_processes
-    )  # Ensure at least one item per batch
+    # Size the pool from the available cores and memory
+    num_processes = pool_size(len(gdf))
 
     # Create a single process pool outside the loops
     with Pool(processes=num_processes) as pool:
@@ -349,6 +528,20 @@ def process_level(
             matching_files.sort()
 
             for file_path in matching_files:
+                entry = start_entry(
+                    db_conn,
+                    "ERA5",
+                    file_path,
+                    var_name,
+                    level,
+                    "area_weighting",
+                )
+                if entry.done:
+                    print(
+                        f"Skipping {file_path} as {var_name} has already been processed at level {level}"
+                    )
+                    continue
+
                 print(f"Processing {var_name} from file: {file_path}")
 
                 start_time = time.time()
@@ -378,56 +571,67 @@ def process_level(
                 cell_area = calculate_cell_area(da_daily)
                 unit = da_daily.attrs.get("units", "unknown")
 
+                coverage = None
+                if cache_dir is not None:
+                    coverage, _ = get_coverage_matrix(
+                        gdf,
+                        gid_column,
+                        da_daily.rio.transform(),
+                        (da_daily.rio.height, da_daily.rio.width),
+                        da_daily.rio.crs,
+                        geopackage_path,
+                        level,
+                        cache_dir,
+                        mode="fractional",
+                        geometry_coverage=cell_fraction_coverage,
+                    )
+
                 try:
-                    batches = [
-                        gdf.iloc[i : i + batch_size]
-                        for i in range(0, len(gdf), batch_size)
-                    ]
-
-                    process_batch_partial = partial(
-                        process_batch,
-                        da_daily=da_daily,
-                        var_name=var_name,
-                        level=level,
-                        cell_area=cell_area,
-                        unit=unit,
+                    # Polygons loaded by an interrupted run are skipped
+                    pending = gdf[~gdf[gid_column].isin(entry.completed_gids)]
+
+                    # Most expensive polygons first, in chunks of similar
+                    # cost that idle workers pick up in turn
+                    batches = cost_ordered_batches(
+                        pending, num_processes, da_daily.rio.resolution()
                     )
 
-                    # Use tqdm to show overall progress for all batches
-                    with tqdm(
-                        total=len(gdf),
-                        desc=f"Overall progress: {var_name} - level {level}",
-                    ) as overall_pbar:
-                        results = []
-                        for batch_result in pool.imap(
-                            process_batch_partial, batches
-                        ):
-                            results.extend(batch_result)
-                            overall_pbar.update(len(batch_result))
-
-                    flat_results = [item for item in results if item]
-
-                    if flat_results:
-                        all_results_len += len(flat_results)
-                        insert_data_to_db(flat_results, db_conn)
-                        print(
-                            f"Inserted {len(flat_results)} rows for {var_name} at level {level}"
+                    # Workers attach to one shared copy of the grids
+                    # instead of unpickling them for every batch
+                    with share_dataarray(
+                        da_daily
+                    ) as shared_da, share_dataarray(cell_area) as shared_area:
+                        process_batch_partial = partial(
+                            process_batch,
+                            da_daily=shared_da,
+                            var_name=var_name,
+                            level=level,
+                            cell_area=shared_area,
+                            unit=unit,
+                            coverage=coverage,
                         )
 
-                        # Move the processed file to another folder
-                        processed_folder = os.path.join(
-                            data_directory, "processed"
-                        )
-                        os.makedirs(processed_folder, exist_ok=True)
-                        os.rename(
-                            file_path,
-                            os.path.join(
-                                processed_folder, os.path.basename(file_path)
-                            ),
-                        )
-                        print(
-                            f"Moved processed file {file_path} to {processed_folder}"
-                        )
+                        # Use tqdm to show overall progress for all batches
+                        with tqdm(
+                            total=len(pending),
+                            desc=f"Overall progress: {var_name} - level {level}",
+                        ) as overall_pbar:
+                            # Every batch is loaded and recorded in the
+                            # ledger as soon as it arrives
+                            for batch_result in pool.imap_unordered(
+                                process_batch_partial, batches
+                            ):
+                                batch_rows = [
+                                    item for item in batch_result if item
+                                ]
+                                if batch_rows:
+                                    all_results_len += len(batch_rows)
+                                    insert_data_to_db(
+                                        batch_rows, db_conn, [entry]
+                                    )
+                                overall_pbar.update(len(batch_result))
+
+                    finish_entries(db_conn, [entry], time.time() - start_time)
 
                 finally:
                     ds_daily.close()
@@ -476,6 +680,9 @@ def main():
 
     levels = [0, 1]
 
+    # Cell fractions are cached per grid and level, so only the first file pays for the geometry work
+    cache_directory = default_cache_dir(geopackage_file_path)
+
     # Set up Dask client
     client = Client(processes=False, threads_per_worker=6, n_workers=1)
 
@@ -492,6 +699,7 @@ def main():
                     variables,
                     conn,
                     use_dask=False,
+                    cache_dir=cache_directory,
                 )
             else:
                 print("Using Dask")
@@ -503,6 +711,7 @@ def main():
                         variables,
                         conn,
                         use_dask=True,
+                        cache_dir=cache_directory,
                     )
 
             end_time = time.time()
@@ -0,0 +1,219 @@
+"""
+Aggregate hourly ERA5 netCDF files to daily files.
+
+Every hourly file of a folder is resampled to daily sums, means, maxima or
+minima, depending on the variable, and written next to it as
+``{name}_daily_aggregated_{method}.nc``, the pattern the zonal scripts look
+for.
+
+Files are opened in Dask chunks of whole days and resampled lazily, so a
+worker only holds a few days of the grid at a time, and several files are
+aggregated in parallel, as many as the cores and the memory budget allow.
+The daily files are written compressed and chunked, through a temporary
+file, so an interrupted run never leaves a partial daily file behind. Files
+whose daily file already exists are skipped.
+"""
+
+import os
+import sys
+import time
+from multiprocessing import Pool
+from pathlib import Path
+
+import dask
+import numpy as np
+import pandas as pd
+import xarray as xr
+from tqdm.auto import tqdm
+
+project_root = os.environ.get(
+    "PROJECT_ROOT",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")),
+)
+sys.path.append(project_root)
+from Geospatial_Lat_Long.scheduling import pool_size  # noqa: E402
+
+# Days per input chunk. Chunks hold whole days, so no daily value needs
+# more than one chunk
+DAYS_PER_CHUNK = 4
+
+# Chunk shape and compression of the daily files
+OUTPUT_SPATIAL_CHUNK = 256
+COMPRESSION_LEVEL = 4
+
+
+def get_aggregation_method(file_name):
+    """
+    Return the daily aggregation method of an ERA5 variable from its file name.
+    """
+    if (
+        "evaporation" in file_name
+        or "total_precipitation" in file_name
+        or "surface_net_solar_radiation" in file_name
+    ):
+        return "sum"
+    elif (
+        "2m_temperature" in file_name
+        and "maximum" not in file_name
+        and "minimum" not in file_name
+    ):
+        return "mean"
+    elif "maximum_2m_temperature" in file_name:
+        return "max"
+    elif "minimum_2m_temperature" in file_name:
+        return "min"
+    else:
+        return "sum"  # Default to sum if the variable is not recognized
+
+
+def daily_file_path(file_path):
+    """
+    Return the path of the daily file of an hourly file.
+    """
+    agg_method = get_aggregation_method(file_path.name.lower())
+    return file_path.with_name(
+        f"{file_path.stem}_daily_aggregated_{agg_method}{file_path.suffix}"
+    )
+
+
+def open_hourly(file_path, days_per_chunk=DAYS_PER_CHUNK):
+    """
+    Open an hourly file lazily in chunks of whole days, with its time
+    coordinate named ``time``.
+    """
+    ds = xr.open_dataset(file_path, chunks={})
+    if "valid_time" in ds.coords:
+        ds = ds.rename({"valid_time": "time"})
+    if "time" not in ds.coords:
+        ds.close()
+        raise ValueError(f"No time coordinate in {file_path}")
+
+    ds["time"] = pd.to_datetime(ds["time"].values)
+    return ds.chunk({"time": 24 * days_per_chunk})
+
+
+def chunk_bytes(file_path, days_per_chunk=DAYS_PER_CHUNK):
+    """
+    Estimate the peak memory of aggregating a file: one input chunk and
+    its daily values per variable, twice for the temporaries.
+    """
+    with xr.open_dataset(file_path) as ds:
+        time_dim = "valid_time" if "valid_time" in ds.dims else "time"
+        step_bytes = sum(
+            da.nbytes // ds.sizes[time_dim]
+            for da in ds.data_vars.values()
+            if time_dim in da.dims
+        )
+    return 2 * step_bytes * (24 + 1) * days_per_chunk
+
+
+def output_encoding(ds_daily):
+    """
+    Return the compression and chunking of the data variables of a daily
+    dataset.
+    """
+    encoding = {}
+    for name, da in ds_daily.data_vars.items():
+        if not np.issubdtype(da.dtype, np.number):
+            continue
+        encoding[name] = {
+            "zlib": True,
+            "complevel": COMPRESSION_LEVEL,
+            "shuffle": True,
+            "chunksizes": tuple(
+                1 if dim == "time" else min(size, OUTPUT_SPATIAL_CHUNK)
+                for dim, size in zip(da.dims, da.shape)
+            ),
+        }
+    return encoding
+
+
+def process_nc_file(file_path):
+    """
+    Aggregate one hourly file to a daily file.
+
+    :param file_path: Path to the hourly netCDF file
+    :return: Tuple of (daily file path, aggregation method, seconds)
+    """
+    start_time = time.time()
+    agg_method = get_aggregation_method(file_path.name.lower())
+    output_file_path = daily_file_path(file_path)
+    temporary_path = output_file_path.with_name(
+        f".{output_file_path.name}.tmp"
+    )
+
+    # Each worker streams its file chunk by chunk; the files run in parallel
+    with dask.config.set(scheduler="synchronous"):
+        ds = open_hourly(file_path)
+        try:
+            ds_daily = getattr(ds.resample(time="1D"), agg_method)()
+            ds_daily.to_netcdf(
+                temporary_path,
+                engine="netcdf4",
+                encoding=output_encoding(ds_daily),
+            )
+        except BaseException:
+            if temporary_path.exists():
+                temporary_path.unlink()
+            raise
+        finally:
+            ds.close()
+
+    os.replace(temporary_path, output_file_path)
+    return output_file_path, agg_method, time.time() - start_time
+
+
+def find_hourly_files(folder):
+    """
+    Return the hourly files of a folder that have no daily file yet.
+    """
+    return sorted(
+        file_path
+        for file_path in folder.glob("*.nc")
+        if "_daily_aggregated" not in file_path.name
+        and not daily_file_path(file_path).exists()
+    )
+
+
+def main():
+    """
+    Aggregate all hourly netCDF files of a folder to daily files.
+    """
+    folder_path = input("Enter the path to the folder containing .nc files: ")
+    folder = Path(folder_path)
+
+    # Check if the folder exists
+    if not folder.is_dir():
+        print(f"The folder {folder_path} does not exist.")
+        return
+
+    nc_files = find_hourly_files(folder)
+
+    if not nc_files:
+        print(f"No .nc files to aggregate in {folder_path}")
+        return
+
+    # As many files at once as the cores and the memory allow
+    num_processes = pool_size(
+        len(nc_files), worker_bytes=max(map(chunk_bytes, nc_files))
+    )
+    print(f"Aggregating {len(nc_files)} files with {num_processes} processes")
+
+    start_time = time.time()
+    with Pool(processes=num_processes) as pool:
+        for output_file_path, agg_method, seconds in tqdm(
+            pool.imap_unordered(process_nc_file, nc_files),
+            total=len(nc_files),
+            desc="Aggregating hourly files",
+        ):
+            tqdm.write(
+                f"Daily aggregated data saved to {output_file_path} using {agg_method} method ({seconds:.1f} s)"
+            )
+
+    print(
+        f"All files processed successfully in {time.time() - start_time:.2f} seconds."
+    )
+
+
+if __name__ == "__main__":
+    main()
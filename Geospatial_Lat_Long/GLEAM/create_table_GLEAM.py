@@ -1,7 +1,5 @@
-SQL = """
--- Create a table for storing aggregated geospatial data
-CREATE TABLE IF NOT EXISTS geospatial_data_gleam (
-    id SERIAL PRIMARY KEY,
+# Column definitions, shared by the plain and the partitioned table
+COLUMNS = """\
     gid VARCHAR(15) NOT NULL,
     admin_level INTEGER NOT NULL,
     date DATE NOT NULL,
@@ -12,21 +10,46 @@ CREATE TABLE IF NOT EXISTS geospatial_data_gleam (
     max NUMERIC,
     raw_value NUMERIC,
     missing_value_percentage NUMERIC,
+    weight_sum DOUBLE PRECISION,
+    weighted_sum DOUBLE PRECISION,
+    sum_sq DOUBLE PRECISION,
+    valid_count INTEGER,
     note TEXT,
     source TEXT,
     unit TEXT,
     metadata JSONB
-);
+"""
+
+SQL = f"""
+-- Create a table for storing aggregated geospatial data
+CREATE TABLE IF NOT EXISTS geospatial_data_gleam (
+    id SERIAL PRIMARY KEY,
+{COLUMNS});
 
 -- Add a unique constraint to ensure no duplicate entries
 ALTER TABLE geospatial_data_gleam
 ADD CONSTRAINT unique_gleam_entry UNIQUE (gid, admin_level, date, variable);
 """
 
+import os
+import sys
 from getpass import getpass
 
 import psycopg2
 
+project_root = os.environ.get(
+    "PROJECT_ROOT",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")),
+)
+sys.path.append(project_root)
+from Geospatial_Lat_Long.compact_schema import (  # noqa: E402
+    compact_columns,
+    create_compact_table,
+)
+from Geospatial_Lat_Long.partitioning import (  # noqa: E402
+    create_partitioned_table,
+)
+
 
 def create_gleam_table():
     """
@@ -45,8 +68,30 @@ def create_gleam_table():
         # Create a cursor object
         cur = conn.cursor()
 
-        # Execute the SQL statement to create the table and add the constraint
-        cur.execute(SQL)
+        # Partition the table by year (and optionally by admin level) instead
+        # of creating one heap, see Geospatial_Lat_Long/partitioning.py
+        partitioned = True
+        partition_by_level = False
+
+        # Double precision measures, smallint admin_level and the natural key
+        # as primary key, see Geospatial_Lat_Long/compact_schema.py
+        compact = True
+        columns = compact_columns(COLUMNS) if compact else COLUMNS
+
+        if partitioned:
+            create_partitioned_table(
+                cur,
+                "geospatial_data_gleam",
+                columns,
+                "unique_gleam_entry",
+                by_level=partition_by_level,
+                primary_key=compact,
+            )
+        elif compact:
+            create_compact_table(cur, "geospatial_data_gleam", columns)
+        else:
+            # Execute the SQL statement to create the table and add the constraint
+            cur.execute(SQL)
 
         # Commit the changes
         conn.commit()
@@ -3,7 +3,7 @@ import glob
 import json
 import logging
 import os
-import shutil
+import sys
 import time
 from collections import OrderedDict
 from functools import partial
@@ -18,59 +18,69 @@ import rioxarray
 import xarray as xr
 from dask.diagnostics import ProgressBar
 from dask.distributed import Client
-from psycopg2.extras import execute_batch
 from tqdm.auto import tqdm
 
-logging.basicConfig(level=logging.INFO)
+project_root = os.environ.get(
+    "PROJECT_ROOT",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")),
+)
+sys.path.append(project_root)
+from Geospatial_Lat_Long.db_loader import copy_upsert  # noqa: E402
+from Geospatial_Lat_Long.label_raster import (  # noqa: E402
+    get_label_raster,
+    zonal_class_counts,
+)
+from Geospatial_Lat_Long.ledger import (  # noqa: E402
+    finish_entries,
+    record_rows,
+    start_entry,
+)
+from Geospatial_Lat_Long.mask_cache import default_cache_dir  # noqa: E402
+from Geospatial_Lat_Long.scheduling import (  # noqa: E402
+    cost_ordered_batches,
+    pool_size,
+)
+from Geospatial_Lat_Long.shared_raster import (  # noqa: E402
+    attach,
+    share_dataarray,
+)
+from Geospatial_Lat_Long.tiled_zonal import DEFAULT_TILE_SIZE  # noqa: E402
 
+logging.basicConfig(level=logging.INFO)
 
-def insert_data_to_db(data, conn, chunk_size=10000):
+# lccs_class holds unsigned byte class values
+N_CLASS_VALUES = 256
+
+
+COLUMNS = (
+    "gid",
+    "admin_level",
+    "date",
+    "variable",
+    "sum",
+    "mean",
+    "min",
+    "max",
+    "raw_value",
+    "missing_value_percentage",
+    "note",
+    "source",
+    "unit",
+    "metadata",
+)
+
+
+def insert_data_to_db(data, conn, entries=()):
     """
-    Insert data into the PostgreSQL database in chunks.
+    Load data into the database with COPY and a single set-based upsert.
 
-    :param data: List of tuples containing the data to be inserted
+    :param data: List of tuples in ``COLUMNS`` order
     :param conn: Database connection object
-    :param chunk_size: Number of rows to insert in each batch
+    :param entries: Processing ledger entries the rows belong to, recorded
+        in the same transaction
     """
-    cursor = conn.cursor()
-
-    for i in range(0, len(data), chunk_size):
-        data_chunk = data[i : i + chunk_size]
-
-        # Convert numpy types to Python types
-        converted_data_chunk = []
-        for row in data_chunk:
-            converted_row = [
-                float(val)
-                if isinstance(val, np.floating)
-                else int(val)
-                if isinstance(val, np.integer)
-                else val
-                for val in row
-            ]
-            converted_data_chunk.append(tuple(converted_row))
-
-        query = """
-        INSERT INTO geospatial_data_landcover 
-        (gid, admin_level, date, variable, sum, mean, min, max, raw_value, missing_value_percentage, note, source, unit, metadata)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (gid, admin_level, date, variable) 
-        DO UPDATE SET 
-        sum = EXCLUDED.sum, 
-        mean = EXCLUDED.mean, 
-        min = EXCLUDED.min, 
-        max = EXCLUDED.max, 
-        raw_value = EXCLUDED.raw_value, 
-        missing_value_percentage = EXCLUDED.missing_value_percentage, 
-        note = EXCLUDED.note, 
-        source = EXCLUDED.source, 
-        unit = EXCLUDED.unit, 
-        metadata = EXCLUDED.metadata
-        """
-        execute_batch(cursor, query, converted_data_chunk)
-        conn.commit()
-        print(f"Inserted chunk of {len(converted_data_chunk)} rows.")
-
+    copy_upsert(conn, "geospatial_data_landcover", COLUMNS, data, commit=False)
+    record_rows(conn, entries, data)
     conn.commit()
 
 
@@ -117,35 +127,48 @@ def calculate_land_cover_stats(da, geometry):
         values, counts = np.unique(
             clipped.values[~np.isnan(clipped.values)], return_counts=True
         )
-        total_pixels = counts.sum()
         missing_pixels = np.isnan(clipped.values).sum()
         total_area = clipped.size
         missing_value_percentage = (missing_pixels / total_area) * 100
 
         flag_meanings = get_flag_meanings_dict(da)
 
-        result = OrderedDict()
-        for value, count in zip(values, counts):
-            land_class = int(value)
-            class_name = flag_meanings.get(land_class, "Unknown")
-            percentage = float(count / total_pixels * 100)
-            result[f"{land_class}_{class_name}"] = {
-                "count": int(count),
-                "percentage": percentage,
-            }
-
-        # Sort the result dictionary by percentage in descending order
-        sorted_result = OrderedDict(
-            sorted(
-                result.items(), key=lambda x: x[1]["percentage"], reverse=True
-            )
+        return (
+            class_statistics(values, counts, flag_meanings),
+            missing_value_percentage,
         )
-
-        return sorted_result, missing_value_percentage
     except rioxarray.exceptions.NoDataInBounds:
         return {}, 100.0
 
 
+def class_statistics(values, counts, flag_meanings):
+    """
+    Build the land class statistics of one geometry from its class counts.
+
+    :param values: Class values, in ascending order
+    :param counts: Number of cells of each class
+    :param flag_meanings: Dictionary of class value -> class name
+    :return: Dictionary of "{value}_{name}" -> count and percentage, by
+        descending percentage
+    """
+    total_pixels = counts.sum()
+
+    result = OrderedDict()
+    for value, count in zip(values, counts):
+        land_class = int(value)
+        class_name = flag_meanings.get(land_class, "Unknown")
+        percentage = float(count / total_pixels * 100)
+        result[f"{land_class}_{class_name}"] = {
+            "count": int(count),
+            "percentage": percentage,
+        }
+
+    # Sort the result dictionary by percentage in descending order
+    return OrderedDict(
+        sorted(result.items(), key=lambda x: x[1]["percentage"], reverse=True)
+    )
+
+
 def process_geometry(da, geometry, level, gid, date):
     """
     Process a single geometry to calculate land cover statistics.
@@ -158,6 +181,16 @@ def process_geometry(da, geometry, level, gid, date):
     :return: List of tuples with processed data
     """
     stats, missing_value_percentage = calculate_land_cover_stats(da, geometry)
+    return stats_to_rows(stats, missing_value_percentage, level, gid, date)
+
+
+def stats_to_rows(stats, missing_value_percentage, level, gid, date):
+    """
+    Turn the land class statistics of one geometry into database rows, one
+    per class.
+
+    :return: List of tuples in ``COLUMNS`` order
+    """
     metadata = json.dumps(stats)
 
     results = []
@@ -193,11 +226,13 @@ def process_batch(batch, da, level, date):
     Process a batch of geometries to calculate land cover statistics.
 
     :param batch: GeoDataFrame with geometries
-    :param da: xarray DataArray with land cover data
+    :param da: xarray DataArray with land cover data, or its shared handle
     :param level: Administrative level
     :param date: Date of the data
     :return: List of tuples with processed data
     """
+    da = attach(da)
+
     results = []
     gid_column = f"GID_{level}"
     with tqdm(
@@ -214,7 +249,7 @@ def process_batch(batch, da, level, date):
 
 def find_files(data_directory, variable_name):
     """
-    Find all relevant files for a given variable, including those in processed folders.
+    Find all relevant files for a given variable, including those moved into processed folders by earlier versions.
 
     :param data_directory: Base directory for data files
     :param variable_name: Name of the variable to process
@@ -241,28 +276,11 @@ def find_files(data_directory, variable_name):
     return all_files
 
 
-def move_processed_file(file_path, data_directory, level):
-    """
-    Move the processed file to a nested folder structure reflecting the processed level.
-
-    :param file_path: Path to the file to be moved
-    :param data_directory: Base directory for data files
-    :param level: Administrative level that was processed
-    """
-    processed_folder = os.path.join(
-        data_directory, "processed", f"level_{level}"
-    )
-    os.makedirs(processed_folder, exist_ok=True)
-
-    new_file_path = os.path.join(processed_folder, os.path.basename(file_path))
-    shutil.move(file_path, new_file_path)
-
-    print(f"Moved processed file {file_path} to {new_file_path}")
-
-
 def get_processed_level(file_path, data_directory):
     """
-    Determine the highest level at which a file has been processed.
+    Determine the highest level at which a file has been processed, from
+    the processed/level_N folder earlier versions moved it to. Progress is
+    now tracked in the processing ledger.
 
     :param file_path: Path to the file
     :param data_directory: Base directory for data files
@@ -280,6 +298,150 @@ def get_processed_level(file_path, data_directory):
     return -1
 
 
+def open_land_cover(file_path, variable_name):
+    """
+    Open the land classes of a file lazily, as a 2-D DataArray.
+    """
+    ds = xr.open_dataset(file_path)
+    return ds[variable_name].isel(time=0)
+
+
+def process_level_labels(
+    geopackage_path,
+    level,
+    data_directory,
+    variable_name,
+    db_conn,
+    cache_dir,
+):
+    """
+    Compute the land class counts of all polygons of a level from its label
+    raster, one streaming pass per file.
+
+    The level is rasterized once into a polygon label raster (cached in
+    ``cache_dir``), and every file is read tile by tile against it; the
+    polygon x class counts of a tile are a single ``np.bincount``.
+
+    :return: Number of processed rows
+    """
+    print(f"Processing level {level}")
+    all_results_len = 0
+
+    matching_files = find_files(data_directory, variable_name)
+    if not matching_files:
+        print(f"No file found for {variable_name}")
+        return all_results_len
+
+    gid_column = f"GID_{level}"
+    gdf = gpd.read_file(geopackage_path, layer=f"ADM_{level}")
+    gdf = gdf.to_crs("EPSG:4326")[[gid_column, "geometry"]]
+
+    # A worker holds one tile (labels, classes and their bincount keys)
+    num_processes = pool_size(worker_bytes=DEFAULT_TILE_SIZE**2 * 32)
+
+    for file_path in matching_files:
+        # Files moved into processed/level_N by earlier versions
+        processed_level = get_processed_level(file_path, data_directory)
+        if processed_level >= level:
+            print(
+                f"Skipping {file_path} as it has already been processed at level {processed_level}"
+            )
+            continue
+
+        entry = start_entry(
+            db_conn,
+            "Copernicus_CDS_LandClass",
+            file_path,
+            variable_name,
+            level,
+            "all_touched",
+        )
+        if entry.done:
+            print(
+                f"Skipping {file_path} as it has already been processed at level {level}"
+            )
+            continue
+
+        print(f"Processing {variable_name} from file: {file_path}")
+
+        start_time = time.time()
+
+        da = open_land_cover(file_path, variable_name)
+        da = da.rio.set_spatial_dims(x_dim="lon", y_dim="lat", inplace=True)
+        transform = da.rio.transform()
+        shape = da.shape
+        flag_meanings = get_flag_meanings_dict(da)
+        date = da.time.values.astype("datetime64[D]").item()
+        da.close()
+
+        labels_path, boundary = get_label_raster(
+            gdf,
+            gid_column,
+            transform,
+            shape,
+            "EPSG:4326",
+            geopackage_path,
+            level,
+            cache_dir,
+            processes=num_processes,
+        )
+        counts, cell_counts = zonal_class_counts(
+            partial(open_land_cover, file_path, variable_name),
+            labels_path,
+            boundary,
+            gdf.geometry.values,
+            N_CLASS_VALUES,
+            processes=num_processes,
+            desc=f"Counting land classes - level {level}",
+        )
+
+        class_values = np.arange(N_CLASS_VALUES)
+        file_results_len = 0
+        results = []
+        for position, gid in enumerate(gdf[gid_column]):
+            # Polygons loaded by an interrupted run are skipped
+            if gid in entry.completed_gids or cell_counts[position] == 0:
+                continue
+
+            present = counts[position] > 0
+            stats = class_statistics(
+                class_values[present], counts[position][present], flag_meanings
+            )
+            missing_value_percentage = (
+                1 - counts[position].sum() / cell_counts[position]
+            ) * 100
+            results.extend(
+                stats_to_rows(
+                    stats, missing_value_percentage, level, gid, date
+                )
+            )
+
+            # Insert data in smaller batches to manage memory
+            if len(results) >= 10000:
+                insert_data_to_db(results, db_conn, [entry])
+                file_results_len += len(results)
+                results = []
+
+        if results:
+            insert_data_to_db(results, db_conn, [entry])
+            file_results_len += len(results)
+
+        end_time = time.time()
+
+        finish_entries(db_conn, [entry], end_time - start_time)
+        all_results_len += file_results_len
+
+        print(
+            f"\n{variable_name} from file: {file_path} - Level {level} Results:"
+        )
+        print(
+            f"Processed {file_results_len} rows in {end_time - start_time:.2f} seconds"
+        )
+
+    print(f"\nProcessing complete for level {level}")
+    return all_results_len
+
+
 def process_level(
     geopackage_path,
     level,
@@ -287,6 +449,8 @@ def process_level(
     variable_name,
     db_conn,
     use_dask=False,
+    use_label_raster=False,
+    cache_dir=None,
 ):
     """
     Process a specific administrative level to calculate land cover statistics and insert data into the database.
@@ -297,12 +461,28 @@ def process_level(
     :param variable_name: Name of the variable to process
     :param db_conn: Database connection object
     :param use_dask: Boolean flag to use Dask for processing
+    :param use_label_raster: Count the classes of all polygons in one
+        streaming pass over a cached polygon label raster instead of
+        clipping the raster per polygon
+    :param cache_dir: Mask cache directory holding the label rasters
     :return: Number of processed rows
     """
+    if use_label_raster:
+        return process_level_labels(
+            geopackage_path,
+            level,
+            data_directory,
+            variable_name,
+            db_conn,
+            cache_dir,
+        )
+
     print(f"Processing level {level}")
     all_results_len = 0
 
-    with Pool(processes=6) as pool:
+    # Size the pool from the available cores and memory
+    num_processes = pool_size()
+    with Pool(processes=num_processes) as pool:
         matching_files = find_files(data_directory, variable_name)
 
         if not matching_files:
@@ -311,6 +491,7 @@ def process_level(
 
         try:
             for file_path in matching_files:
+                # Files moved into processed/level_N by earlier versions
                 processed_level = get_processed_level(
                     file_path, data_directory
                 )
@@ -320,6 +501,20 @@ def process_level(
                     )
                     continue
 
+                entry = start_entry(
+                    db_conn,
+                    "Copernicus_CDS_LandClass",
+                    file_path,
+                    variable_name,
+                    level,
+                    "all_touched",
+                )
+                if entry.done:
+                    print(
+                        f"Skipping {file_path} as it has already been processed at level {level}"
+                    )
+                    continue
+
                 print(f"Processing {variable_name} from file: {file_path}")
 
                 start_time = time.time()
@@ -364,49 +559,52 @@ def process_level(
                     gid_column = f"GID_{level}"
                     gdf = gdf[[gid_column, "geometry"]]
 
-                    all_results_len = 0
-
-                    # Determine the optimal batch size and number of processes
-                    num_rows = len(gdf)
-                    num_processes = min(6, num_rows)
-                    batch_size = max(1, num_rows // num_processes)
+                    # Polygons loaded by an interrupted run are skipped
+                    gdf = gdf[~gdf[gid_column].isin(entry.completed_gids)]
+                    if gdf.empty:
+                        continue
 
-                    batches = [
-                        gdf.iloc[i : i + batch_size]
-                        for i in range(0, len(gdf), batch_size)
-                    ]
+                    all_results_len = 0
 
-                    process_batch_partial = partial(
-                        process_batch, da=da, level=level, date=date
+                    # Most expensive polygons first, in chunks of similar
+                    # cost that idle workers pick up in turn
+                    batches = cost_ordered_batches(
+                        gdf, num_processes, da.rio.resolution()
                     )
 
-                    with tqdm(
-                        total=len(gdf),
-                        desc=f"Overall progress - level {level}",
-                    ) as overall_pbar:
-                        results = []
-                        for batch_result in pool.imap(
-                            process_batch_partial, batches
-                        ):
-                            results.extend(batch_result)
-                            overall_pbar.update(
-                                len(batch_result)
-                                // len(da.attrs["flag_values"])
-                            )
+                    # Workers attach to one shared copy of the raster
+                    # instead of unpickling it for every batch
+                    with share_dataarray(da) as shared_da:
+                        process_batch_partial = partial(
+                            process_batch, da=shared_da, level=level, date=date
+                        )
+
+                        with tqdm(
+                            total=len(gdf),
+                            desc=f"Overall progress - level {level}",
+                        ) as overall_pbar:
+                            results = []
+                            for batch_result in pool.imap_unordered(
+                                process_batch_partial, batches
+                            ):
+                                results.extend(batch_result)
+                                overall_pbar.update(
+                                    len(batch_result)
+                                    // len(da.attrs["flag_values"])
+                                )
 
                     if results:
                         all_results_len += len(results)
-                        insert_data_to_db(results, db_conn)
+                        insert_data_to_db(results, db_conn, [entry])
                         print(
                             f"Inserted {len(results)} rows for {variable_name} at level {level}"
                         )
                         gc.collect()
 
-                # Move the processed file to the nested folder structure
-                move_processed_file(file_path, data_directory, level)
-
                 end_time = time.time()
 
+                finish_entries(db_conn, [entry], end_time - start_time)
+
                 print(
                     f"\n{variable_name} from file: {file_path} - Level {level} Results:"
                 )
@@ -444,6 +642,10 @@ def main():
     levels = [0, 1]
     variable_name = "lccs_class"  # Assuming the variable name to search for
 
+    # Polygon label rasters, built once per level and reused by every year
+    use_label_raster = True
+    cache_directory = default_cache_dir(geopackage_file_path)
+
     # Set up Dask client
     client = Client(processes=False, threads_per_worker=6, n_workers=1)
 
@@ -460,6 +662,8 @@ def main():
                     variable_name,
                     conn,
                     use_dask=True,
+                    use_label_raster=use_label_raster,
+                    cache_dir=cache_directory,
                 )
 
             end_time = time.time()
@@ -2,7 +2,7 @@ import gc
 import glob
 import logging
 import os
-import shutil
+import sys
 import time
 from functools import partial
 from getpass import getpass
@@ -16,61 +16,106 @@ import rioxarray
 import xarray as xr
 from dask.diagnostics import ProgressBar
 from dask.distributed import Client
-from psycopg2.extras import execute_batch
 
 # from tqdm import tqdm
 from tqdm.auto import tqdm
 
+project_root = os.environ.get(
+    "PROJECT_ROOT",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")),
+)
+sys.path.append(project_root)
+from Geospatial_Lat_Long.cell_area import latitude_cell_area  # noqa: E402
+from Geospatial_Lat_Long.db_loader import copy_upsert  # noqa: E402
+from Geospatial_Lat_Long.ledger import (  # noqa: E402
+    finish_entries,
+    record_rows,
+    start_entry,
+)
+from Geospatial_Lat_Long.mask_cache import (  # noqa: E402
+    default_cache_dir,
+    touched_cell_count,
+)
+from Geospatial_Lat_Long.result_writer import (  # noqa: E402
+    ResultWriter,
+    bounded_imap_unordered,
+)
+from Geospatial_Lat_Long.scheduling import (  # noqa: E402
+    cost_ordered_batches,
+    pool_size,
+)
+from Geospatial_Lat_Long.shared_raster import (  # noqa: E402
+    attach,
+    share_dataarray,
+)
+from Geospatial_Lat_Long.simplified_gadm import (  # noqa: E402
+    SOURCE_RESOLUTIONS,
+    simplified_geopackage,
+)
+from Geospatial_Lat_Long.weight_matrix import (  # noqa: E402
+    get_level_weights,
+    grid_values,
+    level_zonal_stats,
+    stats_row_batches,
+)
+from Geospatial_Lat_Long.zarr_store import (  # noqa: E402
+    default_zarr_dir,
+    find_store,
+    open_store,
+    store_windows,
+    time_blocks,
+)
+
 logging.basicConfig(level=logging.INFO)
 
 
-def insert_data_to_db(data, conn, chunk_size=100000):
+COLUMNS = (
+    "gid",
+    "admin_level",
+    "date",
+    "variable",
+    "mean",
+    "min",
+    "max",
+    "missing_value_percentage",
+    "source",
+    "unit",
+    "weight_sum",
+    "weighted_sum",
+    "sum_sq",
+    "valid_count",
+)
+
+
+def insert_data_to_db(data, conn, entries=()):
     """
-    Insert data into the PostgreSQL database in chunks.
+    Load data into the database with COPY and a single set-based upsert.
 
-    :param data: List of tuples containing the data to be inserted
+    :param data: List of tuples in ``COLUMNS`` order
     :param conn: Database connection object
-    :param chunk_size: Number of rows to insert in each batch
+    :param entries: Processing ledger entries the rows belong to, recorded
+        in the same transaction
     """
-    cursor = conn.cursor()
-
-    for i in range(0, len(data), chunk_size):
-        data_chunk = data[i : i + chunk_size]
-        query = """
-        INSERT INTO geospatial_data_merra2 (gid, admin_level, date, variable, mean, min, max, missing_value_percentage, source, unit)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (gid, admin_level, date, variable) 
-        DO UPDATE SET mean = EXCLUDED.mean, min = EXCLUDED.min, max = EXCLUDED.max, 
-                      missing_value_percentage = EXCLUDED.missing_value_percentage, source = EXCLUDED.source, unit = EXCLUDED.unit
-        """
-        execute_batch(cursor, query, data_chunk)
-        conn.commit()
-        print(f"Inserted chunk of {len(data_chunk)} rows.")
-
+    copy_upsert(
+        conn,
+        "geospatial_data_merra2",
+        COLUMNS,
+        data,
+        commit=False,
+        track_periods=True,
+    )
+    record_rows(conn, entries, data)
     conn.commit()
 
 
 def calculate_cell_area(da):
     """
-    Calculate the area of each cell in the DataArray.
-    """
-    res_x, res_y = da.rio.resolution()
-    area_sq_degrees = np.abs(res_x * res_y)
-
-    earth_radius = 6371000  # meters
-    lat_radians = np.deg2rad(da.lat)
-
-    area = (
-        area_sq_degrees
-        * (np.pi / 180) ** 2
-        * earth_radius**2
-        * np.cos(lat_radians)
-    )
-    area_2d = np.tile(area, (da.sizes["lon"], 1)).T
+    Calculate the area of the cells of each row of the DataArray.
 
-    return xr.DataArray(
-        area_2d, dims=("lat", "lon"), coords={"lat": da.lat, "lon": da.lon}
-    )
+    The area only depends on the latitude, so a 1-D array along the
+    latitude is returned and broadcast against the data when weighting.
+    """
+    return latitude_cell_area(da, "lat")
 
 
 def calculate_daily_stats(da, geometry, cell_area, buffer_size=2):
@@ -79,20 +124,19 @@ def calculate_daily_stats(da, geometry, cell_area, buffer_size=2):
 
     :param da: xarray DataArray
     :param geometry: Shapely geometry object
-    :param cell_area: xarray DataArray with cell areas
+    :param cell_area: xarray DataArray with cell areas, or its shared handle
     :param buffer_size: Buffer size for calculating cell fractions (not used in this version)
-    :return: Tuple of daily mean, min, max, and missing value percentage
+    :return: Tuple of (daily statistics, missing value percentage). The daily statistics are the
+        mean, min, max, weight sum, weighted sum, weighted sum of squares and valid cell count,
+        or None when the geometry has no data. The missing value percentage is the share of the
+        touched cells that are NaN at each timestep, as in the weight matrix path
     """
     try:
         # Clip the data using all_touched=True
         clipped = da.rio.clip([geometry], all_touched=True)
 
-        missing_value_percentage = (
-            clipped.isnull().sum() / clipped.size * 100
-        ).values
-
         if clipped.isnull().all():
-            return None, None, None, 100.0
+            return None, 100.0
 
         # Calculate weights (cell area for cells that intersect with the geometry)
         weights = cell_area.where(clipped.notnull())
@@ -100,15 +144,28 @@ def calculate_daily_stats(da, geometry, cell_area, buffer_size=2):
         # Calculate statistics
         weighted_sum = (clipped * weights).sum(dim=["lat", "lon"])
         weight_sum = weights.sum(dim=["lat", "lon"])
-        daily_mean = weighted_sum / weight_sum
-        daily_min = clipped.min(dim=["lat", "lon"], skipna=True)
-        daily_max = clipped.max(dim=["lat", "lon"], skipna=True)
+        valid_count = clipped.notnull().sum(dim=["lat", "lon"])
+        daily_stats = (
+            weighted_sum / weight_sum,
+            clipped.min(dim=["lat", "lon"], skipna=True),
+            clipped.max(dim=["lat", "lon"], skipna=True),
+            weight_sum,
+            weighted_sum,
+            (clipped * clipped * weights).sum(dim=["lat", "lon"]),
+            valid_count,
+        )
 
-        return daily_mean, daily_min, daily_max, missing_value_percentage
+        # Cells outside the geometry are NaN after the clip, so only the
+        # touched cells are counted
+        missing_value_percentage = 100.0 * (
+            1.0 - valid_count / touched_cell_count(clipped, geometry)
+        )
+
+        return daily_stats, missing_value_percentage
     except rioxarray.exceptions.NoDataInBounds:
         # If no data is found in bounds, return None values and 100% missing
         # logging.warning(f"No data found in bounds for geometry. Returning null values.")
-        return None, None, None, 100.0
+        return None, 100.0
 
 
 def process_geometry(
@@ -117,57 +174,101 @@ def process_geometry(
     """
     Process a single geometry to calculate daily statistics and prepare data for database insertion.
 
-    :param da_daily: xarray DataArray with daily data
+    :param da_daily: xarray DataArray with daily data, or its shared handle
     :param variable_name: Name of the variable
     :param geometry: Shapely geometry object
     :param level: Administrative level
     :param gid: Geometry ID
-    :param cell_area: xarray DataArray with cell areas
+    :param cell_area: xarray DataArray with cell areas, or its shared handle
     :param unit: Unit of the variable
     :return: List of tuples with processed data
     """
-    daily_mean, daily_min, daily_max, missing_value_percentage = (
-        calculate_daily_stats(da_daily, geometry, cell_area)
+    daily_stats, missing_value_percentage = calculate_daily_stats(
+        da_daily, geometry, cell_area
     )
 
-    results = []
-    for date in da_daily.time.values:
-        date_py = date.astype("M8[ms]").astype("O")
-        if daily_mean is None:
-            results.append(
-                (
-                    gid,
-                    level,
-                    date_py,
-                    variable_name,
-                    None,  # mean
-                    None,  # min
-                    None,  # max
-                    100.0,  # missing_value_percentage (100% when no data)
-                    "MERRA2",
-                    unit,
-                )
-            )
-        else:
-            mean_val = daily_mean.sel(time=date).values
-            min_val = daily_min.sel(time=date).values
-            max_val = daily_max.sel(time=date).values
-            results.append(
-                (
-                    gid,
-                    level,
-                    date_py,
-                    variable_name,
-                    float(mean_val),
-                    float(min_val),
-                    float(max_val),
-                    round(float(missing_value_percentage), 2),
-                    "MERRA2",
-                    unit,
-                )
+    dates = da_daily.time.values.astype("M8[ms]").astype("O").tolist()
+
+    if daily_stats is None:
+        return [
+            (
+                gid,
+                level,
+                date_py,
+                variable_name,
+                None,  # mean
+                None,  # min
+                None,  # max
+                100.0,  # missing_value_percentage (100% when no data)
+                "MERRA2",
+                unit,
+                0.0,  # weight_sum
+                0.0,  # weighted_sum
+                0.0,  # sum_sq
+                0,  # valid_count
             )
+            for date_py in dates
+        ]
 
-    return results
+    # Materialize the whole time series once instead of indexing it per date
+    daily_stats, missing_value_percentage = dask.compute(
+        daily_stats, missing_value_percentage
+    )
+    (
+        mean_values,
+        min_values,
+        max_values,
+        weight_sums,
+        weighted_sums,
+        sums_sq,
+    ) = (
+        np.asarray(stat.values, dtype=float).tolist()
+        for stat in daily_stats[:6]
+    )
+    valid_counts = np.asarray(daily_stats[6].values, dtype=np.int64).tolist()
+    missing_values = np.round(
+        np.asarray(missing_value_percentage, dtype=float), 2
+    ).tolist()
+
+    return [
+        (
+            gid,
+            level,
+            date_py,
+            variable_name,
+            mean_val,
+            min_val,
+            max_val,
+            missing_val,
+            "MERRA2",
+            unit,
+            weight_sum,
+            weighted_sum,
+            sum_sq,
+            valid_count,
+        )
+        for (
+            date_py,
+            mean_val,
+            min_val,
+            max_val,
+            missing_val,
+            weight_sum,
+            weighted_sum,
+            sum_sq,
+            valid_count,
+        ) in zip(
+            dates,
+            mean_values,
+            min_values,
+            max_values,
+            missing_values,
+            weight_sums,
+            weighted_sums,
+            sums_sq,
+            valid_counts,
+        )
+    ]
 
 
 def process_batch(batch, da_daily, var_name, level, cell_area, unit):
@@ -175,13 +276,16 @@ def process_batch(batch, da_daily, var_name, level, cell_area, unit):
     Process a batch of geometries to calculate daily statistics and prepare data for database insertion.
 
     :param batch: GeoDataFrame with geometries
-    :param da_daily: xarray DataArray with daily data
+    :param da_daily: xarray DataArray with daily data, or its shared handle
     :param var_name: Variable name
     :param level: Administrative level
-    :param cell_area: xarray DataArray with cell areas
+    :param cell_area: xarray DataArray with cell areas, or its shared handle
     :param unit: Unit of the variable
     :return: List of tuples with processed data
     """
+    da_daily = attach(da_daily)
+    cell_area = attach(cell_area)
+
     results = []
     gid_column = f"GID_{level}"
     # Create a progress bar for this batch
@@ -209,7 +313,7 @@ def process_batch(batch, da_daily, var_name, level, cell_area, unit):
 
 def find_files(data_directory, variable_name):
     """
-    Find all relevant files for a given variable, including those in processed folders.
+    Find all relevant files for a given variable, including those moved into processed folders by earlier versions.
 
     :param data_directory: Base directory for data files
     :param variable_name: Name of the variable to process
@@ -238,7 +342,9 @@ def find_files(data_directory, variable_name):
 
 def get_processed_level(file_path, data_directory):
     """
-    Determine the highest level at which a file has been processed.
+    Determine the highest level at which a file has been processed, from
+    the processed/level_N folder earlier versions moved it to. Progress is
+    now tracked in the processing ledger.
 
     :param file_path: Path to the file
     :param data_directory: Base directory for data files
@@ -256,69 +362,111 @@ def get_processed_level(file_path, data_directory):
     return -1
 
 
-def move_processed_file(file_path, data_directory, level):
-    """
-    Move the processed file to a nested folder structure reflecting the processed level.
-
-    :param file_path: Path to the file to be moved
-    :param data_directory: Base directory for data files
-    :param level: Administrative level that was processed
-    """
-    processed_folder = os.path.join(
-        data_directory, "processed", f"level_{level}"
-    )
-    os.makedirs(processed_folder, exist_ok=True)
-
-    new_file_path = os.path.join(processed_folder, os.path.basename(file_path))
-    shutil.move(file_path, new_file_path)
-
-    print(f"Moved processed file {file_path} to {new_file_path}")
-
-
 def process_level(
-    geopackage_path, level, data_directory, variables, db_conn, use_dask=False
+    geopackage_path,
+    level,
+    data_directory,
+    variables,
+    db_conn,
+    use_dask=False,
+    use_weight_matrix=False,
+    cache_dir=None,
+    zarr_dir=None,
+    output_levels=None,
 ):
     """
     Process a specific administrative level to calculate daily statistics and insert data into the database.
+
+    :param use_weight_matrix: Compute all polygons at once from a persisted sparse weight matrix
+        instead of clipping each polygon
+    :param cache_dir: Mask cache directory holding the persisted rasterizations
+    :param zarr_dir: Directory of the Zarr stores; a variable with a store is
+        read from it, one time chunk at a time, instead of its NetCDF files
+    :param output_levels: Levels to insert, rolled up from the statistics of ``level``
+        through the GID hierarchy (weight matrix only); defaults to ``[level]``
     """
-    print(f"Processing level {level}")
+    output_levels = output_levels or [level]
+    if output_levels != [level] and not use_weight_matrix:
+        raise ValueError("Rolling levels up requires the weight matrix")
+    levels_label = ", ".join(map(str, output_levels))
+    print(f"Processing level {level} (inserting level {levels_label})")
 
     gdf = gpd.read_file(geopackage_path, layer=f"ADM_{level}")
     gdf = gdf.to_crs("EPSG:4326")
 
     gid_column = f"GID_{level}"
-    gdf = gdf[[gid_column, "geometry"]]
+    gdf = gdf[
+        [f"GID_{n}" for n in sorted(set(output_levels) | {level})]
+        + ["geometry"]
+    ]
 
     all_results_len = 0
 
-    # Determine the optimal batch size and number of processes
-    num_rows = len(gdf)
-    num_processes = min(6, num_rows)
-    batch_size = max(1, num_rows // num_processes)
+    # Weight matrices and roll-ups, built once per grid for all files
+    plans = {}
+
+    # Size the pool from the available cores and memory
+    num_processes = pool_size(len(gdf))
 
     with Pool(processes=num_processes) as pool:
         for var_code, var_name in variables.items():
-            matching_files = find_files(data_directory, var_name)
+            # A converted Zarr store replaces the variable's NetCDF files;
+            # each of its time chunks has its own ledger entry
+            store = find_store(zarr_dir, "MERRA2", var_name)
+            matching_files = (
+                [(store, *window) for window in store_windows(store, var_code)]
+                if store
+                else [
+                    (file_path, None, slice(None), None)
+                    for file_path in find_files(data_directory, var_name)
+                ]
+            )
 
             if not matching_files:
                 print(f"No file found for {var_name}")
                 continue
 
-            for file_path in matching_files:
+            for file_path, window, time_slice, checksum in matching_files:
+                # Files moved into processed/level_N by earlier versions
                 processed_level = get_processed_level(
                     file_path, data_directory
                 )
-                if processed_level >= level:
+                if processed_level >= max(output_levels):
                     print(
                         f"Skipping {file_path} as it has already been processed at level {processed_level}"
                     )
                     continue
 
-                print(f"Processing {var_name} from file: {file_path}")
+                entries = {
+                    output_level: start_entry(
+                        db_conn,
+                        "MERRA2",
+                        file_path,
+                        var_name,
+                        output_level,
+                        "all_touched",
+                        window=window,
+                        checksum=checksum,
+                    )
+                    for output_level in output_levels
+                }
+                file_label = (
+                    file_path if window is None else f"{file_path} ({window})"
+                )
+                if all(entry.done for entry in entries.values()):
+                    print(
+                        f"Skipping {file_label} as {var_name} has already been processed at level {levels_label}"
+                    )
+                    continue
+
+                print(f"Processing {var_name} from file: {file_label}")
 
                 start_time = time.time()
 
-                if use_dask:
+                if store:
+                    ds_daily = open_store(store)
+                    da_daily = ds_daily[var_code].isel(time=time_slice)
+                elif use_dask:
                     with dask.config.set(
                         **{"array.slicing.split_large_chunks": True}
                     ):
@@ -340,43 +488,109 @@ def process_level(
                 unit = da_daily.attrs.get("units", "unknown")
 
                 try:
-                    batches = [
-                        gdf.iloc[i : i + batch_size]
-                        for i in range(0, len(gdf), batch_size)
-                    ]
-
-                    process_batch_partial = partial(
-                        process_batch,
-                        da_daily=da_daily,
-                        var_name=var_name,
-                        level=level,
-                        cell_area=cell_area,
-                        unit=unit,
+                    # Rows are loaded on a writer thread while the next
+                    # ones are computed
+                    with ResultWriter(insert_data_to_db) as writer:
+                        if use_weight_matrix:
+                            plan = get_level_weights(
+                                gdf,
+                                gid_column,
+                                da_daily,
+                                cell_area.values,
+                                cache_dir,
+                                geopackage_path,
+                                level,
+                                output_levels,
+                                plans=plans,
+                            )
+                            # A store is read one time chunk at a time
+                            blocks = (
+                                time_blocks(da_daily) if store else [da_daily]
+                            )
+                            for block in blocks:
+                                for (
+                                    output_level,
+                                    gids,
+                                    stats,
+                                ) in level_zonal_stats(
+                                    plan, grid_values(block)
+                                ):
+                                    for rows in stats_row_batches(
+                                        gids,
+                                        output_level,
+                                        block.time.values,
+                                        var_name,
+                                        stats,
+                                        "MERRA2",
+                                        unit,
+                                    ):
+                                        all_results_len += len(rows)
+                                        writer.put(
+                                            rows,
+                                            db_conn,
+                                            [entries[output_level]],
+                                        )
+                        else:
+                            entry = entries[level]
+
+                            # Polygons loaded by an interrupted run are skipped
+                            pending = gdf[
+                                ~gdf[gid_column].isin(entry.completed_gids)
+                            ]
+
+                            # Most expensive polygons first, in chunks of
+                            # similar cost that idle workers pick up in turn
+                            batches = cost_ordered_batches(
+                                pending,
+                                num_processes,
+                                da_daily.rio.resolution(),
+                            )
+
+                            # Workers attach to one shared copy of the grids
+                            # instead of unpickling them for every batch
+                            with share_dataarray(
+                                da_daily
+                            ) as shared_da, share_dataarray(
+                                cell_area
+                            ) as shared_area:
+                                process_batch_partial = partial(
+                                    process_batch,
+                                    da_daily=shared_da,
+                                    var_name=var_name,
+                                    level=level,
+                                    cell_area=shared_area,
+                                    unit=unit,
+                                )
+
+                                with tqdm(
+                                    total=len(pending),
+                                    desc=f"Overall progress: {var_name} - level {level}",
+                                ) as overall_pbar:
+                                    # Every batch is loaded and recorded in
+                                    # the ledger as soon as it arrives; at
+                                    # most two batches per worker are in
+                                    # flight while the writer catches up
+                                    for batch_rows in bounded_imap_unordered(
+                                        pool,
+                                        process_batch_partial,
+                                        batches,
+                                        2 * num_processes,
+                                    ):
+                                        all_results_len += len(batch_rows)
+                                        writer.put(
+                                            batch_rows, db_conn, [entry]
+                                        )
+                                        overall_pbar.update(
+                                            len(batch_rows)
+                                            // da_daily.sizes["time"]
+                                        )
+
+                    finish_entries(
+                        db_conn,
+                        list(entries.values()),
+                        time.time() - start_time,
                     )
 
-                    with tqdm(
-                        total=len(gdf),
-                        desc=f"Overall progress: {var_name} - level {level}",
-                    ) as overall_pbar:
-                        results = []
-                        for batch_result in pool.imap(
-                            process_batch_partial, batches
-                        ):
-                            results.extend(batch_result)
-                            overall_pbar.update(len(batch_result))
-
-                    flat_results = [item for item in results if item]
-
-                    if flat_results:
-                        all_results_len += len(flat_results)
-                        insert_data_to_db(flat_results, db_conn)
-                        print(
-                            f"Inserted {len(flat_results)} rows for {var_name} at level {level}"
-                        )
-
-                        # Move the processed file to the nested folder structure
-                        move_processed_file(file_path, data_directory, level)
-
                 finally:
                     ds_daily.close()
                     gc.collect()
@@ -384,13 +598,13 @@ def process_level(
                 end_time = time.time()
 
                 print(
-                    f"\n{var_name} from file: {file_path} - Level {level} Results:"
+                    f"\n{var_name} from file: {file_label} - Level {levels_label} Results:"
                 )
                 print(
                     f"Processed {all_results_len} rows in {end_time - start_time:.2f} seconds"
                 )
 
-    print(f"\nProcessing complete for level {level}")
+    print(f"\nProcessing complete for level {levels_label}")
     return all_results_len
 
 
@@ -421,11 +635,31 @@ def main():
 
     levels = [0, 1]
 
+    # Persisted polygon-to-cell weight matrices, shared by every file on the same grid
+    use_weight_matrix = True
+    cache_directory = default_cache_dir(geopackage_file_path)
+
+    # Polygons simplified for the grid by simplified_gadm.py, when built
+    geopackage_file_path = simplified_geopackage(
+        geopackage_file_path, SOURCE_RESOLUTIONS["MERRA2"], cache_directory
+    )
+
+    # Derive the levels from the level 2 statistics in one pass over the
+    # files instead of one pass per level (weight matrix only)
+    rollup_base_level = 2
+    if use_weight_matrix and rollup_base_level is not None:
+        level_runs = [(rollup_base_level, levels)]
+    else:
+        level_runs = [(level, [level]) for level in levels]
+
+    # Time-chunked Zarr stores written by zarr_store.py, used when present
+    zarr_directory = default_zarr_dir(data_directory)
+
     # Set up Dask client
     client = Client(processes=False, threads_per_worker=6, n_workers=1)
 
     try:
-        for level in levels:
+        for level, output_levels in level_runs:
             start_time = time.time()
 
             if level < 2:
@@ -437,6 +671,10 @@ def main():
                     variables,
                     conn,
                     use_dask=False,
+                    use_weight_matrix=use_weight_matrix,
+                    cache_dir=cache_directory,
+                    zarr_dir=zarr_directory,
+                    output_levels=output_levels,
                 )
             else:
                 print("Using Dask")
@@ -448,11 +686,15 @@ def main():
                         variables,
                         conn,
                         use_dask=True,
+                        use_weight_matrix=use_weight_matrix,
+                        cache_dir=cache_directory,
+                        zarr_dir=zarr_directory,
+                        output_levels=output_levels,
                     )
 
             end_time = time.time()
 
-            print(f"\nLevel {level} Results:")
+            print(f"\nLevel {', '.join(map(str, output_levels))} Results:")
             print(
                 f"Processed {all_results_len} rows in {end_time - start_time:.2f} seconds"
             )
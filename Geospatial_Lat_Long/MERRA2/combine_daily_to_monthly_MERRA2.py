@@ -0,0 +1,261 @@
+"""
+Combine daily MERRA-2 netCDF files into monthly files of daily values.
+
+MERRA-2 is distributed as one file per day with hourly timesteps. Every
+daily file is resampled to its daily value on its own and appended to the
+monthly file of each variable, ``MERRA2_{variable}_daily_{YYYYMM}.nc``, so
+only one day is held in memory at a time instead of the whole month. Months
+are combined in parallel, as many as the cores and the memory budget allow.
+
+Monthly files are written compressed, through temporary files, so an
+interrupted run never leaves a partial month behind. Months whose monthly
+files are newer than all of their daily files are skipped.
+"""
+
+import os
+import sys
+import time
+from datetime import datetime
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+
+import netCDF4
+import pandas as pd
+import xarray as xr
+from tqdm.auto import tqdm
+
+project_root = os.environ.get(
+    "PROJECT_ROOT",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")),
+)
+sys.path.append(project_root)
+from Geospatial_Lat_Long.scheduling import pool_size  # noqa: E402
+
+COMPRESSION_LEVEL = 4
+
+
+def get_aggregation_method(var_name):
+    # Updated for MERRA-2 variables
+    if var_name in ["BCSMASS", "DUSMASS25", "OCSMASS"]:
+        return "mean"
+    else:
+        raise ValueError(f"Unknown variable name: {var_name}")
+
+
+def group_by_month(file_paths):
+    """
+    Group daily files by month, from the date in their name
+    (e.g. ``MERRA2_400.tavg1_2d_aer_Nx.20200101.SUB.nc``).
+
+    :return: Dictionary of ``YYYYMM`` -> sorted list of file paths
+    """
+    monthly_files = {}
+    for file_path in file_paths:
+        date = datetime.strptime(file_path.stem.split(".")[-2], "%Y%m%d")
+        month_key = f"{date.year}{date.month:02d}"
+        monthly_files.setdefault(month_key, []).append(file_path)
+    return {
+        month_key: sorted(files)
+        for month_key, files in sorted(monthly_files.items())
+    }
+
+
+def monthly_file_path(output_folder, var_name, month_key):
+    """
+    Return the path of the monthly file of a variable.
+    """
+    return output_folder / f"MERRA2_{var_name}_daily_{month_key}.nc"
+
+
+def daily_values(file_path):
+    """
+    Resample the hourly values of one daily file to daily values.
+
+    :return: Dictionary of variable name -> DataArray held in memory
+    """
+    with xr.open_dataset(file_path) as ds:
+        ds["time"] = pd.to_datetime(ds["time"].values)
+        return {
+            var_name: getattr(
+                ds[var_name].resample(time="1D"),
+                get_aggregation_method(var_name),
+            )().load()
+            for var_name in ds.data_vars
+        }
+
+
+def create_monthly_file(path, da):
+    """
+    Write the first day of a monthly file, with an unlimited time dimension
+    so the following days can be appended.
+    """
+    da.to_netcdf(
+        path,
+        engine="netcdf4",
+        unlimited_dims=["time"],
+        encoding={
+            da.name: {
+                "zlib": True,
+                "complevel": COMPRESSION_LEVEL,
+                "shuffle": True,
+                "chunksizes": tuple(
+                    1 if dim == "time" else size
+                    for dim, size in zip(da.dims, da.shape)
+                ),
+            }
+        },
+    )
+
+
+def append_to_monthly_file(path, da):
+    """
+    Append the days of ``da`` to a monthly file.
+    """
+    with netCDF4.Dataset(path, "a") as nc:
+        time_var = nc.variables["time"]
+        start = len(time_var)
+        stop = start + da.sizes["time"]
+        time_var[start:stop] = netCDF4.date2num(
+            pd.to_datetime(da["time"].values).to_pydatetime(),
+            units=time_var.units,
+            calendar=getattr(time_var, "calendar", "standard"),
+        )
+        index = tuple(
+            slice(start, stop) if dim == "time" else slice(None)
+            for dim in da.dims
+        )
+        nc.variables[da.name][index] = da.values
+
+
+def month_is_done(files, output_folder, month_key):
+    """
+    Return True if every variable of a month has a monthly file newer than
+    all of the month's daily files.
+    """
+    with xr.open_dataset(files[0]) as ds:
+        var_names = list(ds.data_vars)
+    newest_input = max(os.path.getmtime(file_path) for file_path in files)
+    for var_name in var_names:
+        path = monthly_file_path(output_folder, var_name, month_key)
+        if not path.exists() or os.path.getmtime(path) < newest_input:
+            return False
+    return True
+
+
+def process_month(task, output_folder):
+    """
+    Combine the daily files of one month, one day at a time.
+
+    :param task: Tuple of (month key, list of daily file paths)
+    :param output_folder: Folder of the monthly files
+    :return: Tuple of (month key, list of monthly file paths, seconds)
+    """
+    month_key, files = task
+    start_time = time.time()
+
+    temporary_paths = {}
+    try:
+        for file_path in files:
+            for var_name, da in daily_values(file_path).items():
+                if var_name not in temporary_paths:
+                    final_path = monthly_file_path(
+                        output_folder, var_name, month_key
+                    )
+                    temporary_paths[var_name] = final_path.with_name(
+                        f".{final_path.name}.tmp"
+                    )
+                    create_monthly_file(temporary_paths[var_name], da)
+                else:
+                    append_to_monthly_file(temporary_paths[var_name], da)
+    except BaseException:
+        for path in temporary_paths.values():
+            if path.exists():
+                path.unlink()
+        raise
+
+    output_paths = []
+    for var_name, path in temporary_paths.items():
+        final_path = monthly_file_path(output_folder, var_name, month_key)
+        os.replace(path, final_path)
+        output_paths.append(final_path)
+    return month_key, output_paths, time.time() - start_time
+
+
+def daily_file_bytes(file_path):
+    """
+    Estimate the peak memory of combining a month: one daily file and its
+    daily values, twice for the temporaries.
+    """
+    with xr.open_dataset(file_path) as ds:
+        return 2 * sum(da.nbytes for da in ds.data_vars.values())
+
+
+def process_merra2_files(file_paths, output_folder):
+    """
+    Combine daily files into monthly files, months in parallel.
+    """
+    monthly_files = group_by_month(file_paths)
+    tasks = [
+        (month_key, files)
+        for month_key, files in monthly_files.items()
+        if not month_is_done(files, output_folder, month_key)
+    ]
+    skipped = len(monthly_files) - len(tasks)
+    if skipped:
+        print(f"Skipping {skipped} months that are already combined")
+    if not tasks:
+        return
+
+    # As many months at once as the cores and the memory allow
+    num_processes = pool_size(
+        len(tasks), worker_bytes=daily_file_bytes(tasks[0][1][0])
+    )
+    print(f"Combining {len(tasks)} months with {num_processes} processes")
+
+    with Pool(processes=num_processes) as pool:
+        for month_key, output_paths, seconds in tqdm(
+            pool.imap_unordered(
+                partial(process_month, output_folder=output_folder), tasks
+            ),
+            total=len(tasks),
+            desc="Combining months",
+        ):
+            for output_path in output_paths:
+                tqdm.write(
+                    f"Monthly aggregated data for {month_key} saved to {output_path} ({seconds:.1f} s)"
+                )
+
+
+def main():
+    input_folder = Path(
+        input("Enter the path to the folder containing MERRA-2 .nc files: ")
+    )
+    output_folder = Path(
+        input("Enter the path to the output folder for monthly files: ")
+    )
+
+    if not input_folder.is_dir():
+        print(f"The input folder {input_folder} does not exist.")
+        return
+
+    if not output_folder.is_dir():
+        output_folder.mkdir(parents=True, exist_ok=True)
+
+    nc_files = list(input_folder.glob("*.nc"))
+    nc_files.sort()
+
+    if not nc_files:
+        print(f"No .nc files found in {input_folder}")
+        return
+
+    start_time = time.time()
+    process_merra2_files(nc_files, output_folder)
+
+    print(
+        f"All files processed successfully in {time.time() - start_time:.2f} seconds."
+    )
+
+
+if __name__ == "__main__":
+    main()
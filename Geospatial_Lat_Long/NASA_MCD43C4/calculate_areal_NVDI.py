@@ -1,6 +1,7 @@
 import glob
 import os
-import shutil
+import sys
+import time
 from datetime import datetime
 from getpass import getpass
 from multiprocessing import Pool
@@ -9,50 +10,81 @@ import geopandas as gpd
 import numpy as np
 import psycopg2
 import rasterio
-from psycopg2.extras import execute_batch
 from pyhdf.SD import SD, SDC
+from rasterio import windows
 from rasterio.features import geometry_mask
 from tqdm import tqdm
 
+project_root = os.environ.get(
+    "PROJECT_ROOT",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")),
+)
+sys.path.append(project_root)
+from Geospatial_Lat_Long.cell_area import CELL_AREA_DTYPE  # noqa: E402
+from Geospatial_Lat_Long.db_loader import copy_upsert  # noqa: E402
+from Geospatial_Lat_Long.ledger import (  # noqa: E402
+    finish_entries,
+    record_rows,
+    start_entry,
+)
+from Geospatial_Lat_Long.mask_cache import (  # noqa: E402
+    coverage_cells,
+    default_cache_dir,
+    geometry_window,
+    get_coverage_matrix,
+)
+from Geospatial_Lat_Long.scheduling import (  # noqa: E402
+    cost_order,
+    pool_size,
+)
+from Geospatial_Lat_Long.simplified_gadm import (  # noqa: E402
+    SOURCE_RESOLUTIONS,
+    simplified_geopackage,
+)
+
+# Albedo_Quality values up to this are high quality
+QUALITY_THRESHOLD = 5
+
+# Fill value of the int16 reflectances
+FILL_VALUE = 32767
+
+# Tile edge length of the daily NDVI GeoTIFFs
+GEOTIFF_TILE_SIZE = 256
+
+# GeoTIFFs opened by this (worker) process
+_open_geotiffs = {}
 
-def calculate_ndvi(file_path):
-    """Calculate NDVI from HDF file using pyhdf."""
-    hdf = SD(file_path, SDC.READ)
-
-    # Read the quality data first
-    quality = hdf.select("Albedo_Quality").get()
-
-    # Create a mask for high-quality pixels
-    quality_mask = quality <= 5
-
-    # Read and pre-filter the reflectance data
-    red = hdf.select("Nadir_Reflectance_Band1").get().astype(float)
-    nir = hdf.select("Nadir_Reflectance_Band2").get().astype(float)
 
-    # Apply quality mask
-    red[~quality_mask] = np.nan
-    nir[~quality_mask] = np.nan
-
-    # Correct scale factor
-    scale_factor = 0.001
+def calculate_ndvi(file_path):
+    """
+    Calculate NDVI from HDF file using pyhdf.
 
-    # Apply scale factor and handle fill values
-    fill_value = 32767
-    red[red == fill_value] = np.nan
-    nir[nir == fill_value] = np.nan
+    The reflectances are kept as the int16 values they are stored in. The
+    quality, fill value and zero-sum masks are combined into one mask, and
+    NDVI is computed in float32 for the valid cells only, straight into the
+    output array. The 0.001 scale factor cancels out of the NDVI ratio, so
+    it is not applied.
+    """
+    hdf = SD(file_path, SDC.READ)
 
-    red *= scale_factor
-    nir *= scale_factor
+    # High-quality pixels that are not fill values
+    valid = hdf.select("Albedo_Quality").get() <= QUALITY_THRESHOLD
+    red = hdf.select("Nadir_Reflectance_Band1").get()
+    nir = hdf.select("Nadir_Reflectance_Band2").get()
+    valid &= red != FILL_VALUE
+    valid &= nir != FILL_VALUE
 
-    # Calculate NDVI
-    with np.errstate(divide="ignore", invalid="ignore"):
-        ndvi = (nir - red) / (nir + red)
+    denominator = np.empty(red.shape, dtype=np.float32)
+    np.add(nir, red, out=denominator, where=valid, dtype=np.float32)
+    valid &= denominator != 0
 
-    # Handle invalid values
-    ndvi = np.where((nir + red) != 0, ndvi, np.nan)
+    ndvi = np.full(red.shape, np.nan, dtype=np.float32)
+    np.subtract(nir, red, out=ndvi, where=valid, dtype=np.float32)
+    np.divide(ndvi, denominator, out=ndvi, where=valid)
+    del red, nir, denominator, valid
 
     # Clip NDVI to valid range
-    ndvi = np.clip(ndvi, -1, 1)
+    np.clip(ndvi, -1, 1, out=ndvi)
 
     # Get geotransform information
     metadata = hdf.attributes()["StructMetadata.0"]
@@ -74,8 +106,87 @@ def calculate_ndvi(file_path):
     return ndvi, transform
 
 
+def default_geotiff_dir(data_directory):
+    """
+    Return the directory of the daily NDVI GeoTIFFs, ``NDVI_GEOTIFF_DIR`` if
+    set, otherwise an ``ndvi_geotiff`` folder in the data directory.
+    """
+    return os.environ.get("NDVI_GEOTIFF_DIR") or os.path.join(
+        data_directory, "ndvi_geotiff"
+    )
+
+
+def ndvi_geotiff_path(file_path, geotiff_dir):
+    """
+    Return the path of the NDVI GeoTIFF of an HDF file.
+    """
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(geotiff_dir, f"{name}.NDVI.tif")
+
+
+def write_ndvi_geotiff(path, ndvi, transform):
+    """
+    Write an NDVI grid as a tiled, compressed GeoTIFF, through a temporary
+    file so an interrupted run never leaves a partial file behind.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = os.path.join(
+        os.path.dirname(path), f".{os.path.basename(path)}.tmp"
+    )
+    try:
+        with rasterio.open(
+            temporary_path,
+            "w",
+            driver="GTiff",
+            height=ndvi.shape[0],
+            width=ndvi.shape[1],
+            count=1,
+            dtype="float32",
+            crs="EPSG:4326",
+            transform=transform,
+            nodata=np.nan,
+            tiled=True,
+            blockxsize=GEOTIFF_TILE_SIZE,
+            blockysize=GEOTIFF_TILE_SIZE,
+            compress="deflate",
+            predictor=3,
+        ) as dst:
+            dst.write(ndvi, 1)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    os.replace(temporary_path, path)
+
+
+def get_ndvi_geotiff(file_path, geotiff_dir):
+    """
+    Return the NDVI GeoTIFF of an HDF file, calculating and writing it if it
+    does not exist or is older than the HDF file.
+    """
+    path = ndvi_geotiff_path(file_path, geotiff_dir)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(
+        file_path
+    ):
+        ndvi, transform = calculate_ndvi(file_path)
+        write_ndvi_geotiff(path, ndvi, transform)
+    return path
+
+
+def open_geotiff(path):
+    """
+    Open a GeoTIFF once per worker process and reuse it for every geometry.
+    """
+    if path not in _open_geotiffs:
+        for src in _open_geotiffs.values():
+            src.close()
+        _open_geotiffs.clear()
+        _open_geotiffs[path] = rasterio.open(path)
+    return _open_geotiffs[path]
+
+
 def calculate_cell_areas(transform, shape):
-    """Calculate the area of each cell in the raster using a simple spherical approximation."""
+    """Calculate the area of the cells of each row of the raster using a simple spherical approximation."""
     res_x = abs(transform[0])
     res_y = abs(transform[4])
     area_sq_degrees = res_x * res_y
@@ -99,30 +210,72 @@ def calculate_cell_areas(transform, shape):
         * np.cos(lat_radians)
     )
 
-    # Create 2D array of areas
-    area_2d = np.tile(areas[:, np.newaxis], (1, shape[1]))
+    # One area per row, indexed by the row of each cell
+    return areas.astype(CELL_AREA_DTYPE, copy=False)
+
+
+# Statistics of a geometry without valid cells
+NO_DATA_STATS = (None, None, None, 100.0, 0.0, 0.0, 0.0, 0)
+
 
-    return area_2d
+def calculate_zonal_stats(src, geometry, cells=None):
+    """
+    Calculate area-weighted zonal statistics for a given geometry.
+
+    Only the window of the GeoTIFF covering the geometry is read. If
+    ``cells`` (flat indices of the touched cells, from the mask cache) is
+    given, the geometry is not rasterized again.
 
+    :return: Tuple of (mean, min, max, missing_value_percentage, weight_sum,
+        weighted_sum, sum_sq, valid_count)
+    """
+    transform = src.transform
+    height, width = src.shape
 
-def calculate_zonal_stats(ndvi, transform, geometry):
-    """Calculate area-weighted zonal statistics for a given geometry."""
-    with rasterio.Env():
-        mask = geometry_mask(
-            [geometry], ndvi.shape, transform, invert=True, all_touched=True
+    if cells is None:
+        row_start, row_stop, col_start, col_stop = geometry_window(
+            geometry, transform, src.shape
         )
+        if row_start >= row_stop or col_start >= col_stop:
+            return NO_DATA_STATS
 
-    cell_areas = calculate_cell_areas(transform, ndvi.shape)
+        window = windows.Window(
+            col_start, row_start, col_stop - col_start, row_stop - row_start
+        )
+        with rasterio.Env():
+            mask = geometry_mask(
+                [geometry],
+                (row_stop - row_start, col_stop - col_start),
+                windows.transform(window, transform),
+                invert=True,
+                all_touched=True,
+            )
+        rows, cols = np.nonzero(mask)
+    else:
+        rows, cols = np.divmod(cells, width)
+        if rows.size == 0:
+            return NO_DATA_STATS
+
+        row_start, col_start = rows.min(), cols.min()
+        window = windows.Window(
+            col_start,
+            row_start,
+            cols.max() - col_start + 1,
+            rows.max() - row_start + 1,
+        )
+        rows = rows - row_start
+        cols = cols - col_start
 
-    masked_ndvi = np.where(mask, ndvi, np.nan)
-    masked_areas = np.where(mask, cell_areas, 0)
+    cell_areas = calculate_cell_areas(transform, (height, width))
 
-    valid_mask = ~np.isnan(masked_ndvi)
-    valid_ndvi = masked_ndvi[valid_mask]
-    valid_areas = masked_areas[valid_mask]
+    # Only the touched cells of the window are gathered
+    touched_ndvi = src.read(1, window=window)[rows, cols]
+    valid_mask = ~np.isnan(touched_ndvi)
+    valid_ndvi = touched_ndvi[valid_mask]
+    valid_areas = cell_areas[row_start + rows[valid_mask]]
 
     if valid_ndvi.size == 0:
-        return None, None, None, 100.0
+        return NO_DATA_STATS
 
     total_area = np.sum(valid_areas)
     weighted_sum = np.sum(valid_ndvi * valid_areas)
@@ -130,9 +283,10 @@ def calculate_zonal_stats(ndvi, transform, geometry):
 
     min_val = np.min(valid_ndvi)
     max_val = np.max(valid_ndvi)
+    sum_sq = np.sum(valid_ndvi * valid_ndvi * valid_areas)
     # sum_val = np.sum(valid_ndvi)
 
-    total_country_pixels = np.sum(mask)
+    total_country_pixels = rows.size
     valid_country_pixels = np.sum(valid_mask)
     missing_percentage = (
         (total_country_pixels - valid_country_pixels) / total_country_pixels
@@ -143,13 +297,18 @@ def calculate_zonal_stats(ndvi, transform, geometry):
         float(min_val),
         float(max_val),
         round(float(missing_percentage), 2),
+        float(total_area),
+        float(weighted_sum),
+        float(sum_sq),
+        int(valid_country_pixels),
     )
 
 
 def process_geometry(args):
     """Process a single geometry from the GeoDataFrame."""
-    ndvi, transform, row, level, date = args
-    stats = calculate_zonal_stats(ndvi, transform, row["geometry"])
+    geotiff_path, row, level, date, cells = args
+    src = open_geotiff(geotiff_path)
+    stats = calculate_zonal_stats(src, row["geometry"], cells)
     if stats:
         # if stats[0] is None:
         # print(f"{row['GID_0']} at level {level} NDVI calculation is None")
@@ -158,18 +317,55 @@ def process_geometry(args):
             level,
             date,
             "NDVI",
-            *stats,
+            *stats[:4],
             "NASA_MCD43C4",
             "unitless",
+            *stats[4:],
         )
     else:
         print("error with stats")
         return None
 
 
-def process_file(file_path, gdf, level, conn):
-    """Process a single HDF file for all geometries."""
-    ndvi, transform = calculate_ndvi(file_path)
+def process_file(
+    file_path,
+    gdf,
+    level,
+    conn,
+    geopackage_path=None,
+    cache_dir=None,
+    entry=None,
+    geotiff_dir=None,
+):
+    """
+    Process a single HDF file for all geometries.
+
+    NDVI is calculated once per file and written to a tiled GeoTIFF in
+    ``geotiff_dir`` (next to the HDF file by default), which every level
+    reuses; workers read only the window of each geometry from it. With a
+    ``cache_dir``, the all_touched masks of the level are read from the
+    mask cache instead of being rasterized for every file. With a processing
+    ledger ``entry``, geometries loaded by an interrupted run are skipped and
+    rows are loaded in batches as they arrive.
+    """
+    if geotiff_dir is None:
+        geotiff_dir = os.path.dirname(file_path)
+    geotiff_path = get_ndvi_geotiff(file_path, geotiff_dir)
+    with rasterio.open(geotiff_path) as src:
+        transform, shape = src.transform, src.shape
+
+    coverage = None
+    if cache_dir is not None:
+        coverage, _ = get_coverage_matrix(
+            gdf,
+            f"GID_{level}",
+            transform,
+            shape,
+            "EPSG:4326",
+            geopackage_path,
+            level,
+            cache_dir,
+        )
 
     # Extract date from filename and convert to YYYY-MM-DD
     date_str = os.path.basename(file_path).split(".")[1][
@@ -177,44 +373,110 @@ def process_file(file_path, gdf, level, conn):
     ]  # Extract YYYY001 format
     date = datetime.strptime(date_str, "%Y%j").strftime("%Y-%m-%d")
 
-    with Pool(processes=6) as pool:
+    # Each worker holds the window of one geometry at a time: its NDVI
+    # values, its mask and the indices of its touched cells
+    largest_window = max(
+        int(row_stop - row_start) * int(col_stop - col_start)
+        for row_start, row_stop, col_start, col_stop in (
+            geometry_window(geometry, transform, shape)
+            for geometry in gdf.geometry.values
+        )
+    )
+    num_processes = pool_size(len(gdf), worker_bytes=largest_window * 24)
+    # Largest geometries first so the tail is made of small ones
+    order = cost_order(gdf.geometry.values, (transform.a, transform.e))
+
+    entries = ()
+    if entry is not None:
+        # Geometries loaded by an interrupted run are skipped
+        loaded = gdf[f"GID_{level}"].isin(entry.completed_gids).values
+        order = order[~loaded[order]]
+        entries = [entry]
+
+    # Workers open the GeoTIFF themselves, so no grid is pickled or shared
+    with Pool(processes=num_processes) as pool:
         args = [
-            (ndvi, transform, row, level, date) for _, row in gdf.iterrows()
-        ]
-        results = list(
-            tqdm(
-                pool.imap(process_geometry, args),
-                total=len(args),
-                desc=f"Processing geometries for {file_path}",
+            (
+                geotiff_path,
+                gdf.iloc[index],
+                level,
+                date,
+                (
+                    coverage_cells(coverage, index)[0]
+                    if coverage is not None
+                    else None
+                ),
             )
-        )
-
-    results = [r for r in results if r is not None]
+            for index in order
+        ]
+        results = []
+        inserted = 0
+        for result in tqdm(
+            pool.imap_unordered(process_geometry, args),
+            total=len(args),
+            desc=f"Processing geometries for {file_path}",
+        ):
+            if result is not None:
+                results.append(result)
+
+            # Load in batches, so an interrupted run resumes from here
+            if len(results) >= 1000:
+                insert_data_to_db(results, conn, entries)
+                inserted += len(results)
+                results = []
 
     if results:
-        insert_data_to_db(results, conn)
-        print(f"Inserted {len(results)} rows for file {file_path}")
+        insert_data_to_db(results, conn, entries)
+        inserted += len(results)
+
+    if inserted:
+        print(f"Inserted {inserted} rows for file {file_path}")
 
     return file_path
 
 
-def insert_data_to_db(data, conn):
-    """Insert data into the PostgreSQL database."""
-    cursor = conn.cursor()
-    query = """
-    INSERT INTO geospatial_data_nvdi (gid, admin_level, date, variable, mean, min, max, missing_value_percentage, source, unit)
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    ON CONFLICT (gid, admin_level, date, variable) 
-    DO UPDATE SET mean = EXCLUDED.mean, min = EXCLUDED.min, max = EXCLUDED.max,
-                  missing_value_percentage = EXCLUDED.missing_value_percentage, source = EXCLUDED.source, unit = EXCLUDED.unit
+COLUMNS = (
+    "gid",
+    "admin_level",
+    "date",
+    "variable",
+    "mean",
+    "min",
+    "max",
+    "missing_value_percentage",
+    "source",
+    "unit",
+    "weight_sum",
+    "weighted_sum",
+    "sum_sq",
+    "valid_count",
+)
+
+
+def insert_data_to_db(data, conn, entries=()):
+    """
+    Load data into the database with COPY and a single set-based upsert.
+
+    :param data: List of tuples in ``COLUMNS`` order
+    :param conn: Database connection object
+    :param entries: Processing ledger entries the rows belong to, recorded
+        in the same transaction
     """
-    execute_batch(cursor, query, data)
+    copy_upsert(
+        conn,
+        "geospatial_data_nvdi",
+        COLUMNS,
+        data,
+        commit=False,
+        track_periods=True,
+    )
+    record_rows(conn, entries, data)
     conn.commit()
 
 
 def find_files(data_directory):
     """
-    Find all relevant HDF files, including those in processed folders.
+    Find all relevant HDF files, including those moved into processed folders by earlier versions.
 
     :param data_directory: Base directory for data files
     :return: List of file paths
@@ -242,7 +504,9 @@ def find_files(data_directory):
 
 def get_processed_level(file_path, data_directory):
     """
-    Determine the highest level at which a file has been processed.
+    Determine the highest level at which a file has been processed, from
+    the processed/level_N folder earlier versions moved it to. Progress is
+    now tracked in the processing ledger.
 
     :param file_path: Path to the file
     :param data_directory: Base directory for data files
@@ -260,25 +524,6 @@ def get_processed_level(file_path, data_directory):
     return -1
 
 
-def move_processed_file(file_path, data_directory, level):
-    """
-    Move the processed file to a nested folder structure reflecting the processed level.
-
-    :param file_path: Path to the file to be moved
-    :param data_directory: Base directory for data files
-    :param level: Administrative level that was processed
-    """
-    processed_folder = os.path.join(
-        data_directory, "processed", f"level_{level}"
-    )
-    os.makedirs(processed_folder, exist_ok=True)
-
-    new_file_path = os.path.join(processed_folder, os.path.basename(file_path))
-    shutil.move(file_path, new_file_path)
-
-    print(f"Moved processed file {file_path} to {new_file_path}")
-
-
 def main():
     data_directory = input(
         "Enter the path to the directory containing the HDF files: "
@@ -297,6 +542,19 @@ def main():
 
     levels = [0, 1]  # Process for admin levels 0, 1, and 2
 
+    # Masks are cached per grid and level, so only the first file pays for rasterization
+    cache_directory = default_cache_dir(geopackage_file_path)
+
+    # Polygons simplified for the grid by simplified_gadm.py, when built
+    geopackage_file_path = simplified_geopackage(
+        geopackage_file_path,
+        SOURCE_RESOLUTIONS["NASA_MCD43C4"],
+        cache_directory,
+    )
+
+    # Daily NDVI GeoTIFFs, calculated at the first level and reused by the next
+    geotiff_directory = default_geotiff_dir(data_directory)
+
     try:
         for level in levels:
             print(f"Processing level {level}")
@@ -308,9 +566,33 @@ def main():
             for file_path in tqdm(
                 file_list, desc=f"Processing files for level {level}"
             ):
-                if get_processed_level(file_path, data_directory) < level:
-                    processed_file = process_file(file_path, gdf, level, conn)
-                    move_processed_file(processed_file, data_directory, level)
+                # Files moved into processed/level_N by earlier versions
+                if get_processed_level(file_path, data_directory) >= level:
+                    continue
+
+                entry = start_entry(
+                    conn,
+                    "NASA_MCD43C4",
+                    file_path,
+                    "NDVI",
+                    level,
+                    "all_touched",
+                )
+                if entry.done:
+                    continue
+
+                start_time = time.time()
+                process_file(
+                    file_path,
+                    gdf,
+                    level,
+                    conn,
+                    geopackage_path=geopackage_file_path,
+                    cache_dir=cache_directory,
+                    entry=entry,
+                    geotiff_dir=geotiff_directory,
+                )
+                finish_entries(conn, [entry], time.time() - start_time)
 
     finally:
         conn.close()
@@ -1,66 +1,88 @@
 import glob
 import logging
 import os
-import shutil
+import sys
 import time
 from functools import partial
 from getpass import getpass
-from multiprocessing import Pool, cpu_count
+from itertools import repeat
+from multiprocessing import Pool
 
 import geopandas as gpd
 import numpy as np
 import psycopg2
 import rasterio
-from psycopg2.extras import execute_batch
 from rasterio.mask import mask
 from tqdm import tqdm
 
+project_root = os.environ.get(
+    "PROJECT_ROOT",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")),
+)
+sys.path.append(project_root)
+from Geospatial_Lat_Long.cell_area import latitude_areas  # noqa: E402
+from Geospatial_Lat_Long.db_loader import copy_upsert  # noqa: E402
+from Geospatial_Lat_Long.ledger import (  # noqa: E402
+    finish_entries,
+    record_rows,
+    start_entry,
+)
+from Geospatial_Lat_Long.scheduling import (  # noqa: E402
+    cost_ordered_batches,
+    geometry_cost,
+    pool_size,
+)
+from Geospatial_Lat_Long.tiled_zonal import (  # noqa: E402
+    DEFAULT_TILE_SIZE,
+    zonal_stats_tiled,
+)
+
 logging.basicConfig(level=logging.INFO)
 
 
-def insert_data_to_db(data, conn, chunk_size=100000):
-    """
-    Insert data into the PostgreSQL database in chunks.
+COLUMNS = (
+    "gid",
+    "admin_level",
+    "date",
+    "variable",
+    "sum",
+    "mean",
+    "min",
+    "max",
+    "missing_value_percentage",
+    "source",
+    "unit",
+)
+
+
+def insert_data_to_db(data, conn, entries=()):
     """
-    cursor = conn.cursor()
-
-    for i in range(0, len(data), chunk_size):
-        data_chunk = data[i : i + chunk_size]
-        query = """
-        INSERT INTO geospatial_data_worldpop_age_sex (gid, admin_level, date, variable, sum, mean, min, max, missing_value_percentage, source, unit)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (gid, admin_level, date, variable) 
-        DO UPDATE SET sum = EXCLUDED.sum, mean = EXCLUDED.mean, min = EXCLUDED.min, max = EXCLUDED.max, 
-                      missing_value_percentage = EXCLUDED.missing_value_percentage, source = EXCLUDED.source, unit = EXCLUDED.unit
-        """
-        execute_batch(cursor, query, data_chunk)
-        conn.commit()
-        print(f"Inserted chunk of {len(data_chunk)} rows.")
+    Load data into the database with COPY and a single set-based upsert.
 
+    :param data: List of tuples in ``COLUMNS`` order
+    :param conn: Database connection object
+    :param entries: Processing ledger entries the rows belong to, recorded
+        in the same transaction
+    """
+    copy_upsert(
+        conn, "geospatial_data_worldpop_age_sex", COLUMNS, data, commit=False
+    )
+    record_rows(conn, entries, data)
     conn.commit()
 
 
 def calculate_cell_area(src):
     """
-    Calculate the area of each cell in the raster.
+    Calculate the area of the cells of each row of the raster.
+
+    The area only depends on the latitude, so one value per row is returned
+    and broadcast over the columns of a polygon's window.
     """
     res_x, res_y = src.res
-    area_sq_degrees = np.abs(res_x * res_y)
-    earth_radius = 6371000  # meters
-    lat_radians = np.deg2rad(
-        src.xy(np.arange(src.height), np.zeros(src.height))[1]
-    )
-    area = (
-        area_sq_degrees
-        * (np.pi / 180) ** 2
-        * earth_radius**2
-        * np.cos(lat_radians)
+    return latitude_areas(
+        src.xy(np.arange(src.height), np.zeros(src.height))[1], res_x, res_y
     )
 
-    return area[:, np.newaxis] * np.ones(
-        src.width
-    )  # Broadcasting instead of np.tile
-
 
 def calculate_stats(src, geometry, cell_area):
     """
@@ -87,9 +109,12 @@ def calculate_stats(src, geometry, cell_area):
         window_start_col = int(window.col_off)
         window_end_col = min(int(window.col_off + window.width), src.width)
 
-        cell_area_slice = cell_area[
-            window_start_row:window_end_row, window_start_col:window_end_col
-        ]
+        # Row areas repeated over the window's columns without a copy
+        row_areas = cell_area[window_start_row:window_end_row]
+        n_cols = len(range(src.width)[window_start_col:window_end_col])
+        cell_area_slice = np.broadcast_to(
+            row_areas[:, np.newaxis], (row_areas.size, n_cols)
+        )
 
         min_height = min(cell_area_slice.shape[0], valid_mask.shape[0])
         min_width = min(cell_area_slice.shape[1], valid_mask.shape[1])
@@ -164,7 +189,7 @@ def process_chunk(chunk, geotiff_path, variable_name, level, date):
 
 def find_files(geotiff_folder, variable_name):
     """
-    Find all relevant files for a given variable, including those in processed folders.
+    Find all relevant files for a given variable, including those moved into processed folders by earlier versions.
 
     :param geotiff_folder: Base directory for GeoTIFF files
     :param variable_name: Name of the variable to process
@@ -193,7 +218,9 @@ def find_files(geotiff_folder, variable_name):
 
 def get_processed_level(file_path, geotiff_folder):
     """
-    Determine the highest level at which a file has been processed.
+    Determine the highest level at which a file has been processed, from
+    the processed/level_N folder earlier versions moved it to. Progress is
+    now tracked in the processing ledger.
 
     :param file_path: Path to the file
     :param geotiff_folder: Base directory for GeoTIFF files
@@ -211,30 +238,76 @@ def get_processed_level(file_path, geotiff_folder):
     return -1
 
 
-def move_processed_file(file_path, geotiff_folder, level):
+def process_level_tiled(
+    gdf, level, geotiff_path, variable_name, db_conn, date, entry=None
+):
     """
-    Move the processed file to a nested folder structure reflecting the processed level.
+    Compute the statistics of all polygons of a level with the tiled engine.
 
-    :param file_path: Path to the file to be moved
-    :param geotiff_folder: Base directory for GeoTIFF files
-    :param level: Administrative level that was processed
+    The GeoTIFF is read tile by tile, so memory is bounded by the tile size
+    instead of the raster size, and no full-raster cell area grid is built.
+
+    :param gdf: GeoDataFrame with the level's geometries in the raster CRS
+    :param entry: Processing ledger entry of the file and level
+    :return: Number of processed rows
     """
-    processed_folder = os.path.join(
-        geotiff_folder, "processed", f"level_{level}"
+    gid_column = f"GID_{level}"
+
+    with rasterio.open(geotiff_path) as src:
+        unit = src.tags().get("units", "unknown")
+
+    # A worker holds one tile (data, validity and polygon masks)
+    num_processes = pool_size(
+        worker_bytes=DEFAULT_TILE_SIZE**2 * 32,
+    )
+    data_sum, data_mean, data_min, data_max, missing = zonal_stats_tiled(
+        geotiff_path,
+        gdf.geometry.values,
+        processes=num_processes,
+        desc=f"Processing {variable_name} - level {level}",
     )
-    os.makedirs(processed_folder, exist_ok=True)
 
-    new_file_path = os.path.join(processed_folder, os.path.basename(file_path))
-    shutil.move(file_path, new_file_path)
+    valid = ~np.isnan(data_mean)
+    results = list(
+        zip(
+            gdf[gid_column].tolist(),
+            repeat(level),
+            repeat(date),
+            repeat(variable_name),
+            np.where(~np.isnan(data_sum), data_sum, None).tolist(),
+            np.where(valid, data_mean, None).tolist(),
+            np.where(~np.isnan(data_min), data_min, None).tolist(),
+            np.where(~np.isnan(data_max), data_max, None).tolist(),
+            np.round(missing, 2).tolist(),
+            repeat("WorldPop"),
+            repeat(unit),
+        )
+    )
 
-    print(f"Moved processed file {file_path} to {new_file_path}")
+    if results:
+        insert_data_to_db(results, db_conn, [entry] if entry else ())
+
+    print(f"\nProcessing complete for level {level}")
+    return len(results)
 
 
 def process_level(
-    geopackage_path, level, geotiff_path, variable_name, db_conn, date
+    geopackage_path,
+    level,
+    geotiff_path,
+    variable_name,
+    db_conn,
+    date,
+    use_tiled=True,
+    entry=None,
 ):
     """
     Process a specific administrative level to calculate statistics and insert data into the database.
+
+    :param use_tiled: Walk the GeoTIFF tile by tile (bounded memory) instead
+        of masking the raster per polygon
+    :param entry: Processing ledger entry of the file and level; polygons it
+        lists as loaded are skipped and new rows are recorded in it
     """
     print(f"Processing level {level}")
 
@@ -242,24 +315,37 @@ def process_level(
 
     with rasterio.open(geotiff_path) as src:
         gdf = gdf.to_crs(src.crs)
+        resolution = src.res
+        raster_rows = src.height
+        itemsize = np.dtype(src.dtypes[0]).itemsize
 
     gid_column = f"GID_{level}"
     gdf = gdf[[gid_column, "geometry"]]
 
+    entries = ()
+    if entry is not None:
+        # Polygons loaded by an interrupted run are skipped
+        gdf = gdf[~gdf[gid_column].isin(entry.completed_gids)]
+        entries = [entry]
+
     total_features = len(gdf)
     print(f"total_areal_features (ADM_{level}): {total_features}")
 
-    # Split the dataframe into chunks
-    num_processes = min(
-        cpu_count(), 2
-    )  # Use 2 processes or less if CPU count is lower
-    chunk_size = max(
-        1, total_features // (num_processes * 4)
-    )  # Adjust chunk size based on number of processes
-    chunks = [
-        gdf.iloc[i : i + chunk_size]
-        for i in range(0, total_features, chunk_size)
-    ]
+    if use_tiled:
+        return process_level_tiled(
+            gdf, level, geotiff_path, variable_name, db_conn, date, entry
+        )
+
+    # Each worker holds one cell area per row (float64) plus the masked
+    # window of the largest polygon (data, validity mask and weights)
+    largest_window = geometry_cost(gdf.geometry.values, resolution).max(
+        initial=0
+    )
+    worker_bytes = int(raster_rows * 8 + largest_window * (itemsize + 9))
+    num_processes = pool_size(total_features, worker_bytes)
+
+    # Most expensive polygons first, in chunks of similar cost
+    chunks = cost_ordered_batches(gdf, num_processes, resolution)
 
     # Process chunks in parallel
     with Pool(processes=num_processes) as pool:
@@ -272,7 +358,7 @@ def process_level(
         )
         all_results = []
         for chunk_result in tqdm(
-            pool.imap(process_chunk_partial, chunks),
+            pool.imap_unordered(process_chunk_partial, chunks),
             total=len(chunks),
             desc=f"Processing {variable_name} - level {level}",
         ):
@@ -280,12 +366,12 @@ def process_level(
 
             # Insert data in smaller batches to manage memory
             if len(all_results) >= 10000:
-                insert_data_to_db(all_results, db_conn)
+                insert_data_to_db(all_results, db_conn, entries)
                 all_results = []
 
     # Insert any remaining results
     if all_results:
-        insert_data_to_db(all_results, db_conn)
+        insert_data_to_db(all_results, db_conn, entries)
 
     print(f"\nProcessing complete for level {level}")
     return total_features
@@ -350,6 +436,7 @@ def main():
                 print(f"\nProcessing file: {filename}")
                 print(f"Variable name: {variable_name}")
 
+                # Files moved into processed/level_N by earlier versions
                 processed_level = get_processed_level(
                     file_path, geotiff_folder
                 )
@@ -359,6 +446,20 @@ def main():
                     )
                     continue
 
+                entry = start_entry(
+                    conn,
+                    "WorldPop",
+                    file_path,
+                    variable_name,
+                    level,
+                    "all_touched",
+                )
+                if entry.done:
+                    print(
+                        f"Skipping {file_path} as it has already been processed at level {level}"
+                    )
+                    continue
+
                 start_time = time.time()
 
                 processed_rows = process_level(
@@ -368,18 +469,18 @@ def main():
                     variable_name,
                     conn,
                     date,
+                    entry=entry,
                 )
 
                 end_time = time.time()
 
+                finish_entries(conn, [entry], end_time - start_time)
+
                 print(f"\nLevel {level} Results:")
                 print(
                     f"Processed {processed_rows} rows in {end_time - start_time:.2f} seconds"
                 )
 
-                # Move the processed file to the nested folder structure
-                move_processed_file(file_path, geotiff_folder, level)
-
             print(f"Completed processing all files for level {level}")
 
     finally:
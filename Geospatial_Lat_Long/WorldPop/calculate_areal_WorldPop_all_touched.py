@@ -4,8 +4,9 @@ import gc
 import glob
 import logging
 import os
-import shutil
+import sys
 import time
+from contextlib import nullcontext
 from functools import partial
 from getpass import getpass
 from multiprocessing import Pool
@@ -18,63 +19,75 @@ import rioxarray
 import xarray as xr
 from dask.diagnostics import ProgressBar
 from dask.distributed import Client
-from psycopg2.extras import execute_batch
 
 # from tqdm import tqdm
 from tqdm.auto import tqdm
 
+project_root = os.environ.get(
+    "PROJECT_ROOT",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")),
+)
+sys.path.append(project_root)
+from Geospatial_Lat_Long.cell_area import latitude_cell_area  # noqa: E402
+from Geospatial_Lat_Long.db_loader import copy_upsert  # noqa: E402
+from Geospatial_Lat_Long.ledger import (  # noqa: E402
+    finish_entries,
+    record_rows,
+    start_entry,
+)
+from Geospatial_Lat_Long.scheduling import (  # noqa: E402
+    cost_ordered_batches,
+    pool_size,
+)
+from Geospatial_Lat_Long.shared_raster import (  # noqa: E402
+    attach,
+    share_dataarray,
+)
+from Geospatial_Lat_Long.tiled_zonal import (  # noqa: E402
+    DEFAULT_TILE_SIZE,
+    zonal_stats_tiled,
+)
+
 logging.basicConfig(level=logging.INFO)
 
 
-def insert_data_to_db(data, conn, chunk_size=100000):
+COLUMNS = (
+    "gid",
+    "admin_level",
+    "date",
+    "variable",
+    "sum",
+    "mean",
+    "min",
+    "max",
+    "missing_value_percentage",
+    "source",
+    "unit",
+)
+
+
+def insert_data_to_db(data, conn, entries=()):
     """
-    Insert data into the PostgreSQL database in chunks.
+    Load data into the database with COPY and a single set-based upsert.
 
-    :param data: List of tuples containing the data to be inserted
+    :param data: List of tuples in ``COLUMNS`` order
     :param conn: Database connection object
-    :param chunk_size: Number of rows to insert in each batch
+    :param entries: Processing ledger entries the rows belong to, recorded
+        in the same transaction
     """
-    cursor = conn.cursor()
-
-    for i in range(0, len(data), chunk_size):
-        data_chunk = data[i : i + chunk_size]
-        query = """
-        INSERT INTO geospatial_data_worldpop (gid, admin_level, date, variable, sum, mean, min, max, missing_value_percentage, source, unit)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (gid, admin_level, date, variable) 
-        DO UPDATE SET sum = EXCLUDED.sum, mean = EXCLUDED.mean, min = EXCLUDED.min, max = EXCLUDED.max, 
-                      missing_value_percentage = EXCLUDED.missing_value_percentage, source = EXCLUDED.source, unit = EXCLUDED.unit
-        """
-        execute_batch(cursor, query, data_chunk)
-        conn.commit()
-        print(f"Inserted chunk of {len(data_chunk)} rows.")
-
+    copy_upsert(conn, "geospatial_data_worldpop", COLUMNS, data, commit=False)
+    record_rows(conn, entries, data)
     conn.commit()
 
 
 def calculate_cell_area(da):
     """
-    Calculate the area of each cell in the DataArray.
-    """
-    res_x, res_y = da.rio.resolution()
-    area_sq_degrees = np.abs(res_x * res_y)
-
-    earth_radius = 6371000  # meters
-    lat_radians = np.deg2rad(da.latitude)
-
-    area = (
-        area_sq_degrees
-        * (np.pi / 180) ** 2
-        * earth_radius**2
-        * np.cos(lat_radians)
-    )
-    area_2d = np.tile(area, (da.sizes["longitude"], 1)).T
+    Calculate the area of the cells of each row of the DataArray.
 
-    return xr.DataArray(
-        area_2d,
-        dims=("latitude", "longitude"),
-        coords={"latitude": da.latitude, "longitude": da.longitude},
-    )
+    The area only depends on the latitude, so a 1-D array along the
+    latitude is returned and broadcast against the data when weighting.
+    """
+    return latitude_cell_area(da)
 
 
 def calculate_daily_stats(da, geometry, cell_area, buffer_size=2):
@@ -156,47 +169,54 @@ def process_geometry(da, variable_name, geometry, level, gid, cell_area, unit):
         calculate_daily_stats(da, geometry, cell_area)
     )
 
-    results = []
-    for date in da.time.values:
-        date_py = date.astype("M8[ms]").astype("O")
-        if daily_sum is None:
-            results.append(
-                (
-                    gid,
-                    level,
-                    date_py,
-                    variable_name,
-                    None,  # sum
-                    None,  # mean
-                    None,  # min
-                    None,  # max
-                    100.0,  # missing_value_percentage (100% when no data)
-                    "WorldPop",
-                    unit,
-                )
-            )
-        else:
-            sum_val = daily_sum.sel(time=date).values
-            mean_val = daily_mean.sel(time=date).values
-            min_val = daily_min.sel(time=date).values
-            max_val = daily_max.sel(time=date).values
-            results.append(
-                (
-                    gid,
-                    level,
-                    date_py,
-                    variable_name,
-                    float(sum_val),
-                    float(mean_val),
-                    float(min_val),
-                    float(max_val),
-                    round(float(missing_value_percentage), 2),
-                    "WorldPop",
-                    unit,
-                )
+    dates = da.time.values.astype("M8[ms]").astype("O").tolist()
+
+    if daily_sum is None:
+        return [
+            (
+                gid,
+                level,
+                date_py,
+                variable_name,
+                None,  # sum
+                None,  # mean
+                None,  # min
+                None,  # max
+                100.0,  # missing_value_percentage (100% when no data)
+                "WorldPop",
+                unit,
             )
+            for date_py in dates
+        ]
 
-    return results
+    # Materialize the whole time series once instead of indexing it per date
+    daily_sum, daily_mean, daily_min, daily_max = dask.compute(
+        daily_sum, daily_mean, daily_min, daily_max
+    )
+    sum_values = np.asarray(daily_sum.values, dtype=float).tolist()
+    mean_values = np.asarray(daily_mean.values, dtype=float).tolist()
+    min_values = np.asarray(daily_min.values, dtype=float).tolist()
+    max_values = np.asarray(daily_max.values, dtype=float).tolist()
+    missing_value_percentage = round(float(missing_value_percentage), 2)
+
+    return [
+        (
+            gid,
+            level,
+            date_py,
+            variable_name,
+            sum_val,
+            mean_val,
+            min_val,
+            max_val,
+            missing_value_percentage,
+            "WorldPop",
+            unit,
+        )
+        for date_py, sum_val, mean_val, min_val, max_val in zip(
+            dates, sum_values, mean_values, min_values, max_values
+        )
+    ]
 
 
 def process_batch(batch, da, var_name, level, cell_area, unit):
@@ -204,13 +224,16 @@ def process_batch(batch, da, var_name, level, cell_area, unit):
     Process a batch of geometries to calculate daily statistics and prepare data for database insertion.
 
     :param batch: GeoDataFrame with geometries
-    :param da: xarray DataArray with daily data
+    :param da: xarray DataArray with daily data, or its shared handle
     :param var_name: Variable name
     :param level: Administrative level
-    :param cell_area: xarray DataArray with cell areas
+    :param cell_area: xarray DataArray with cell areas, or its shared handle
     :param unit: Unit of the variable
     :return: List of tuples with processed data
     """
+    da = attach(da)
+    cell_area = attach(cell_area)
+
     results = []
     gid_column = f"GID_{level}"
     # Create a progress bar for this batch
@@ -238,7 +261,7 @@ def process_batch(batch, da, var_name, level, cell_area, unit):
 
 def find_files(data_directory, variable_name):
     """
-    Find all relevant files for a given variable, including those in processed folders.
+    Find all relevant files for a given variable, including those moved into processed folders by earlier versions.
 
     :param data_directory: Base directory for data files
     :param variable_name: Name of the variable to process
@@ -272,7 +295,9 @@ def find_files(data_directory, variable_name):
 
 def get_processed_level(file_path, data_directory):
     """
-    Determine the highest level at which a file has been processed.
+    Determine the highest level at which a file has been processed, from
+    the processed/level_N folder earlier versions moved it to. Progress is
+    now tracked in the processing ledger.
 
     :param file_path: Path to the file
     :param data_directory: Base directory for data files
@@ -290,27 +315,101 @@ def get_processed_level(file_path, data_directory):
     return -1
 
 
-def move_processed_file(file_path, data_directory, level):
+def process_file_tiled(
+    geopackage_path, level, file_path, var_code, var_name, db_conn, entry
+):
     """
-    Move the processed file to a nested folder structure reflecting the processed level.
+    Compute the statistics of all polygons of a level for one netCDF file
+    with the tiled engine.
 
-    :param file_path: Path to the file to be moved
-    :param data_directory: Base directory for data files
-    :param level: Administrative level that was processed
+    GDAL reads the variable as a raster with one band per time step, tile by
+    tile, so memory is bounded by the tile size instead of the global grid.
+    All time steps are reduced in the same pass.
+
+    :param geopackage_path: Path to the GeoPackage file
+    :param level: Administrative level to process
+    :param file_path: Path to the netCDF file
+    :param var_code: Name of the variable in the file
+    :param var_name: Variable name written to the database
+    :param db_conn: Database connection
+    :param entry: Processing ledger entry of the file and level; polygons it
+        lists as loaded are skipped and new rows are recorded in it
+    :return: Number of inserted rows
     """
-    processed_folder = os.path.join(
-        data_directory, "processed", f"level_{level}"
+    with xr.open_dataset(file_path) as ds:
+        dates = ds.time.values.astype("M8[ms]").astype("O").tolist()
+        unit = ds[var_code].attrs.get("units", "unknown")
+
+    gid_column = f"GID_{level}"
+    gdf = gpd.read_file(geopackage_path, layer=f"ADM_{level}")
+    gdf = gdf.to_crs("EPSG:4326")[[gid_column, "geometry"]]
+
+    # Polygons loaded by an interrupted run are skipped
+    gdf = gdf[~gdf[gid_column].isin(entry.completed_gids)]
+    print(f"total_areal_features (ADM_{level}): {len(gdf)}")
+    if gdf.empty:
+        return 0
+
+    # A worker holds one tile of every time step (data and validity masks)
+    num_processes = pool_size(
+        worker_bytes=DEFAULT_TILE_SIZE**2 * 32 * len(dates),
+    )
+    # The files carry no grid mapping, so GDAL reports no CRS
+    stats = zonal_stats_tiled(
+        f'netcdf:"{file_path}":{var_code}',
+        gdf.geometry.values,
+        processes=num_processes,
+        desc=f"Processing {var_name} - level {level}",
+        band=list(range(1, len(dates) + 1)),
+        crs="EPSG:4326",
     )
-    os.makedirs(processed_folder, exist_ok=True)
+    data_sum, data_mean, data_min, data_max = (
+        np.where(np.isnan(values), None, values).T.tolist()
+        for values in stats[:4]
+    )
+    missing = np.round(stats[4], 2).T.tolist()
+
+    # Every time step of a polygon is loaded in the same batch, so the
+    # ledger only lists complete polygons
+    results = []
+    all_results_len = 0
+    for position, gid in enumerate(gdf[gid_column].tolist()):
+        results.extend(
+            (
+                gid,
+                level,
+                date_py,
+                var_name,
+                data_sum[position][band],
+                data_mean[position][band],
+                data_min[position][band],
+                data_max[position][band],
+                missing[position][band],
+                "WorldPop",
+                unit,
+            )
+            for band, date_py in enumerate(dates)
+        )
+        if len(results) >= 10000:
+            insert_data_to_db(results, db_conn, [entry])
+            all_results_len += len(results)
+            results = []
 
-    new_file_path = os.path.join(processed_folder, os.path.basename(file_path))
-    shutil.move(file_path, new_file_path)
+    if results:
+        insert_data_to_db(results, db_conn, [entry])
+        all_results_len += len(results)
 
-    print(f"Moved processed file {file_path} to {new_file_path}")
+    return all_results_len
 
 
 def process_level(
-    geopackage_path, level, data_directory, variables, db_conn, use_dask=False
+    geopackage_path,
+    level,
+    data_directory,
+    variables,
+    db_conn,
+    use_dask=False,
+    use_tiled=True,
 ):
     """
     Process a specific administrative level to calculate daily statistics and insert data into the database.
@@ -321,12 +420,19 @@ def process_level(
     :param variables: Dictionary of variables to process
     :param db_conn: Database connection
     :param use_dask: Whether to use Dask for processing
+    :param use_tiled: Walk the files tile by tile (bounded memory) instead
+        of clipping the grid per polygon
     """
     print(f"Processing level {level}")
     all_results_len = 0
 
     for var_code, var_name in variables.items():
-        with Pool(processes=6) as pool:
+        # Size the pool from the available cores and memory
+        num_processes = pool_size()
+        # The tiled engine runs its own pool
+        with (
+            nullcontext() if use_tiled else Pool(processes=num_processes)
+        ) as pool:
             matching_files = find_files(data_directory, var_name)
 
             if not matching_files:
@@ -334,6 +440,7 @@ def process_level(
                 continue
 
             for file_path in matching_files:
+                # Files moved into processed/level_N by earlier versions
                 processed_level = get_processed_level(
                     file_path, data_directory
                 )
@@ -354,10 +461,41 @@ def process_level(
                         )
                     )
 
+                entry = start_entry(
+                    db_conn,
+                    "WorldPop",
+                    file_path,
+                    var_name,
+                    level,
+                    "all_touched",
+                )
+                if entry.done:
+                    print(
+                        f"Skipping {file_path} as {var_name} has already been processed at level {level}"
+                    )
+                    continue
+
                 print(f"Processing {var_name} from file: {file_path}")
 
                 start_time = time.time()
 
+                if use_tiled:
+                    file_results_len = process_file_tiled(
+                        geopackage_path,
+                        level,
+                        file_path,
+                        var_code,
+                        var_name,
+                        db_conn,
+                        entry,
+                    )
+                    all_results_len += file_results_len
+                    finish_entries(db_conn, [entry], time.time() - start_time)
+                    print(
+                        f"Processed {file_results_len} rows for {var_name} in {time.time() - start_time:.2f} seconds"
+                    )
+                    continue
+
                 # Open the dataset outside the loop
                 if use_dask:
                     with dask.config.set(
@@ -406,49 +544,54 @@ def process_level(
                         gid_column = f"GID_{level}"
                         gdf = gdf[[gid_column, "geometry"]]
 
-                        # Determine the optimal batch size and number of processes
-                        num_rows = len(gdf)
-                        num_processes = min(6, num_rows)
-                        batch_size = max(1, num_rows // num_processes)
+                        # Polygons loaded by an interrupted run are skipped
+                        gdf = gdf[~gdf[gid_column].isin(entry.completed_gids)]
+                        if gdf.empty:
+                            continue
 
-                        batches = [
-                            gdf.iloc[i : i + batch_size]
-                            for i in range(0, len(gdf), batch_size)
-                        ]
+                        # Most expensive polygons first, in chunks of similar
+                        # cost that idle workers pick up in turn
+                        batches = cost_ordered_batches(
+                            gdf, num_processes, da.rio.resolution()
+                        )
 
                         # Process the chunks in parallel
-                        process_batch_partial = partial(
-                            process_batch,
-                            da=da,
-                            var_name=var_name,
-                            level=level,
-                            cell_area=cell_area,
-                            unit=unit,
-                        )
+                        # Workers attach to one shared copy of the grids
+                        # instead of unpickling them for every batch
+                        with share_dataarray(da) as shared_da, share_dataarray(
+                            cell_area
+                        ) as shared_area:
+                            process_batch_partial = partial(
+                                process_batch,
+                                da=shared_da,
+                                var_name=var_name,
+                                level=level,
+                                cell_area=shared_area,
+                                unit=unit,
+                            )
 
-                        with tqdm(
-                            total=len(gdf),
-                            desc=f"Batch progress: {var_name} - level {level}",
-                        ) as batch_pbar:
-                            results = []
-                            for batch_result in pool.imap(
-                                process_batch_partial, batches
-                            ):
-                                results.extend(batch_result)
-                                batch_pbar.update(len(batch_result))
+                            with tqdm(
+                                total=len(gdf),
+                                desc=f"Batch progress: {var_name} - level {level}",
+                            ) as batch_pbar:
+                                results = []
+                                for batch_result in pool.imap_unordered(
+                                    process_batch_partial, batches
+                                ):
+                                    results.extend(batch_result)
+                                    batch_pbar.update(len(batch_result))
 
                         flat_results = [item for item in results if item]
 
                         if flat_results:
                             all_results_len += len(flat_results)
-                            insert_data_to_db(flat_results, db_conn)
+                            insert_data_to_db(flat_results, db_conn, [entry])
                             print(
                                 f"Inserted {len(flat_results)} rows for {var_name} at level {level}"
                             )
                             gc.collect()
 
-                    # Move the processed file to the nested folder structure
-                    move_processed_file(file_path, data_directory, level)
+                    finish_entries(db_conn, [entry], time.time() - start_time)
 
                 finally:
                     ds.close()
@@ -0,0 +1 @@
+"""Shared helpers for the lat/long zonal statistics scripts."""
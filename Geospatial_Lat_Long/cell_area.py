@@ -0,0 +1,61 @@
+"""
+Cell areas of regular latitude/longitude grids.
+
+On a regular lat/lon grid the area of a cell only depends on its latitude,
+so the areas are kept as one value per row and broadcast against the data
+where they are used (xarray aligns the 1-D ``latitude`` array with the
+clipped grid, NumPy callers index it with the row of each cell). A full
+``(lat, lon)`` grid of areas is never allocated.
+
+The dtype defaults to float64. ``ZONAL_CELL_AREA_DTYPE=float32`` halves the
+size of the weights and of the weighted temporaries; means then differ from
+the float64 results in the 7th significant digit.
+"""
+
+import os
+
+import numpy as np
+import xarray as xr
+
+EARTH_RADIUS = 6371000  # meters
+
+CELL_AREA_DTYPE = np.dtype(os.environ.get("ZONAL_CELL_AREA_DTYPE", "float64"))
+
+
+def latitude_areas(latitudes, res_x, res_y, dtype=None):
+    """
+    Return the area in square meters of the cells centred on ``latitudes``.
+
+    :param latitudes: Array of cell centre latitudes in degrees
+    :param res_x: Cell width in degrees
+    :param res_y: Cell height in degrees
+    :param dtype: Output dtype, ``CELL_AREA_DTYPE`` if None
+    :return: 1-D array with one area per latitude
+    """
+    area_sq_degrees = np.abs(res_x * res_y)
+    lat_radians = np.deg2rad(np.asarray(latitudes, dtype=np.float64))
+    area = (
+        area_sq_degrees
+        * (np.pi / 180) ** 2
+        * EARTH_RADIUS**2
+        * np.cos(lat_radians)
+    )
+    return area.astype(dtype or CELL_AREA_DTYPE, copy=False)
+
+
+def latitude_cell_area(da, lat_dim="latitude", dtype=None):
+    """
+    Return the cell areas of the grid of ``da`` as a 1-D DataArray along
+    ``lat_dim``, to be broadcast against the data.
+
+    :param da: xarray DataArray with spatial dims set via rioxarray
+    :param lat_dim: Name of the latitude dimension
+    :param dtype: Output dtype, ``CELL_AREA_DTYPE`` if None
+    :return: xarray DataArray with dims ``(lat_dim,)``
+    """
+    res_x, res_y = da.rio.resolution()
+    return xr.DataArray(
+        latitude_areas(da[lat_dim].values, res_x, res_y, dtype),
+        dims=(lat_dim,),
+        coords={lat_dim: da[lat_dim]},
+    )
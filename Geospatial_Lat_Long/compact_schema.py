@@ -0,0 +1,477 @@
+"""
+Compact storage schema of the ``geospatial_data_*`` tables.
+
+The original tables store every measure as ``NUMERIC``, ``admin_level`` as
+``INTEGER`` and carry an ``id SERIAL PRIMARY KEY`` next to the unique
+constraint on (gid, admin_level, date, variable). NUMERIC values of float
+results take 10 to 20 bytes each and every aggregate over them runs in
+arbitrary precision arithmetic, and the id index is a second btree every
+row is written to. The compact schema:
+
+- stores ``sum``, ``mean``, ``min``, ``max`` and ``raw_value`` as
+  ``DOUBLE PRECISION`` and ``missing_value_percentage`` as ``REAL``
+- stores ``admin_level`` as ``SMALLINT``
+- drops ``id`` and makes the natural key the primary key
+
+The values are computed in float64 by the zonal scripts, so nothing is lost
+beyond the digits NUMERIC printed from the float text. The loaders and the
+ETLs upsert with ``ON CONFLICT (gid, admin_level, date, variable)``, which
+the primary key serves like the unique constraint did.
+
+The create_table scripts create new tables with the compact schema
+(``compact = True``). Run this module to migrate existing tables in
+place, and optionally to move their texts and metadata to the dimension
+tables of ``dimensions`` (``encode_table``)::
+
+    python Geospatial_Lat_Long/compact_schema.py
+"""
+
+import os
+import re
+import sys
+from getpass import getpass
+
+import psycopg2
+from psycopg2 import sql
+
+project_root = os.environ.get(
+    "PROJECT_ROOT",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..")),
+)
+sys.path.append(project_root)
+
+from Geospatial_Lat_Long.db_loader import (  # noqa: E402
+    KEY_COLUMNS,
+    staging_table,
+)
+from Geospatial_Lat_Long.dimensions import (  # noqa: E402
+    DIMENSIONS,
+    ENCODED_COLUMNS,
+    METADATA_TABLE,
+    decode_columns,
+    encoded_storage,
+    ensure_dimension_tables,
+    id_column,
+    metadata_hash,
+    storage_table,
+    store_dimensions,
+)
+from Geospatial_Lat_Long.partitioning import partition_key  # noqa: E402
+
+# Column types of the compact schema
+COMPACT_TYPES = {
+    "admin_level": "SMALLINT",
+    "sum": "DOUBLE PRECISION",
+    "mean": "DOUBLE PRECISION",
+    "min": "DOUBLE PRECISION",
+    "max": "DOUBLE PRECISION",
+    "raw_value": "DOUBLE PRECISION",
+    "missing_value_percentage": "REAL",
+}
+
+# Tables migrated by default
+TABLES = (
+    "geospatial_data_era5",
+    "geospatial_data_gfed",
+    "geospatial_data_gleam",
+    "geospatial_data_landcover",
+    "geospatial_data_merra2",
+    "geospatial_data_nvdi",
+    "geospatial_data_worldpop",
+    "geospatial_data_worldpop_age_sex",
+    "geospatial_data_gdl",
+    "geospatial_data_idmc",
+    "geospatial_data_worldpop_pwd",
+)
+
+# Tables loaded through db_loader.copy_upsert, which can write to an encoded
+# table; the IDMC and WorldPop PWD ETLs insert into the tables directly
+ENCODABLE_TABLES = TABLES[:-2]
+
+
+def compact_columns(columns):
+    """
+    Return column definitions with the types of the compact schema.
+
+    :param columns: Column definitions, one ``name TYPE ...`` per line
+    :return: The definitions with the types of ``COMPACT_TYPES`` replaced
+    """
+    for column, column_type in COMPACT_TYPES.items():
+        columns = re.sub(
+            rf"^(\s*{column}\s+)\w+",
+            rf"\g<1>{column_type}",
+            columns,
+            flags=re.MULTILINE,
+        )
+    return columns
+
+
+def create_compact_table(cursor, table, columns):
+    """
+    Create an unpartitioned table with the natural key as primary key if it
+    does not exist.
+
+    :param cursor: psycopg2 cursor
+    :param table: Table name
+    :param columns: Column definitions of the table (SQL, without ``id``),
+        see ``compact_columns``
+    """
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            {columns.strip()},
+            PRIMARY KEY (gid, admin_level, date, variable)
+        );
+        """
+    )
+
+
+def column_types(cursor, table):
+    """
+    Return a dict of column name to (lower case) data type of a table.
+    """
+    cursor.execute(
+        """
+        SELECT column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s
+        """,
+        (table,),
+    )
+    return dict(cursor.fetchall())
+
+
+def key_constraints(cursor, table, kind):
+    """
+    Return a dict of constraint name to column tuple of the primary key
+    (``kind="p"``) or unique constraints (``kind="u"``) of a table.
+    """
+    cursor.execute(
+        """
+        SELECT c.conname, array_agg(a.attname::text ORDER BY k.ord)
+        FROM pg_constraint c
+        CROSS JOIN LATERAL unnest(c.conkey) WITH ORDINALITY AS k(attnum, ord)
+        JOIN pg_attribute a
+            ON a.attrelid = c.conrelid AND a.attnum = k.attnum
+        WHERE c.conrelid = to_regclass(%s) AND c.contype = %s
+        GROUP BY c.conname
+        """,
+        (table, kind),
+    )
+    return {name: tuple(columns) for name, columns in cursor.fetchall()}
+
+
+def dependent_views(cursor, table):
+    """
+    Return the names of the views and materialized views reading a table.
+    """
+    cursor.execute(
+        """
+        SELECT DISTINCT v.oid::regclass::text
+        FROM pg_depend d
+        JOIN pg_rewrite r ON r.oid = d.objid
+        JOIN pg_class v ON v.oid = r.ev_class
+        WHERE d.classid = 'pg_rewrite'::regclass
+            AND d.refobjid = to_regclass(%s)
+            AND v.oid <> d.refobjid
+        ORDER BY 1
+        """,
+        (table,),
+    )
+    return [name for (name,) in cursor.fetchall()]
+
+
+def table_size(cursor, table):
+    """
+    Return the size in bytes of a table, its partitions and indexes.
+    """
+    cursor.execute(
+        """
+        SELECT coalesce(sum(pg_total_relation_size(relid)), 0)
+        FROM pg_partition_tree(to_regclass(%s))
+        """,
+        (table,),
+    )
+    return int(cursor.fetchone()[0])
+
+
+def migration_steps(cursor, table):
+    """
+    Return the ``ALTER TABLE`` actions that bring a table to the compact
+    schema, an empty list if it already has it.
+
+    Columns of the partition key keep their type, which a partitioned table
+    cannot change.
+    """
+    types = column_types(cursor, table)
+    if not types:
+        raise ValueError(f"{table} does not exist")
+    key = partition_key(cursor, table) or ()
+
+    steps = []
+    for column, column_type in COMPACT_TYPES.items():
+        if column in types and column not in key:
+            if types[column] != column_type.lower():
+                steps.append(
+                    f"ALTER COLUMN {column} TYPE {column_type} "
+                    f"USING {column}::{column_type}"
+                )
+
+    primary = key_constraints(cursor, table, "p")
+    if KEY_COLUMNS not in primary.values():
+        steps.extend(f"DROP CONSTRAINT {name}" for name in primary)
+        steps.extend(
+            f"DROP CONSTRAINT {name}"
+            for name, columns in key_constraints(cursor, table, "u").items()
+            if columns == KEY_COLUMNS
+        )
+        steps.append(f"ADD PRIMARY KEY ({', '.join(KEY_COLUMNS)})")
+
+    if "id" in types:
+        steps.append("DROP COLUMN id")
+    return steps
+
+
+def migrate_table(cursor, table):
+    """
+    Convert a table to the compact schema in place, without committing.
+
+    All changes run as one ``ALTER TABLE``, so the table is rewritten and
+    its indexes rebuilt once. The staging table of the loader is dropped,
+    so that it is recreated with the new types on the next load.
+
+    :param cursor: psycopg2 cursor
+    :param table: Table to migrate
+    :return: List of the actions applied, empty if there was nothing to do
+    :raises ValueError: If the table does not exist, or views read it; they
+        have to be dropped first and recreated afterwards (see
+        ``Visualization_View_SQL/``)
+    """
+    steps = migration_steps(cursor, table)
+    if not steps:
+        return steps
+
+    views = dependent_views(cursor, table)
+    if views:
+        raise ValueError(
+            f"Drop the views reading {table} before migrating it: "
+            f"{', '.join(views)}"
+        )
+
+    cursor.execute(f"ALTER TABLE {table}\n    " + ",\n    ".join(steps))
+    cursor.execute(f"DROP TABLE IF EXISTS {staging_table(table)}")
+    cursor.execute(f"ANALYZE {table}")
+    return steps
+
+
+def ordered_columns(cursor, table):
+    """
+    Return the column names of a table in their order.
+    """
+    cursor.execute(
+        """
+        SELECT column_name
+        FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s
+        ORDER BY ordinal_position
+        """,
+        (table,),
+    )
+    return [column for (column,) in cursor.fetchall()]
+
+
+def encode_table(cursor, table):
+    """
+    Move the text columns and metadata of a table to the dimension tables,
+    without committing (see ``dimensions``).
+
+    The table is renamed to its storage table, partitions included, its
+    texts and documents are replaced by ids, and a view of the original
+    name and columns takes its place. The key constraint moves from
+    ``variable`` to ``variable_id``. The rows are updated in place, so the
+    storage table needs a ``VACUUM FULL`` afterwards to shrink.
+
+    :param cursor: psycopg2 cursor
+    :param table: Table to encode
+    :return: List of the encoded columns, empty if the table is encoded
+        already
+    :raises ValueError: If the table does not exist, or views read it
+    """
+    if encoded_storage(cursor, table) is not None:
+        return []
+    columns = ordered_columns(cursor, table)
+    if not columns:
+        raise ValueError(f"{table} does not exist")
+    views = dependent_views(cursor, table)
+    if views:
+        raise ValueError(
+            f"Drop the views reading {table} before encoding it: "
+            f"{', '.join(views)}"
+        )
+
+    encoded = [column for column in columns if column in ENCODED_COLUMNS]
+    storage = storage_table(table)
+    ensure_dimension_tables(cursor)
+    store_dimensions(cursor, table, encoded)
+
+    cursor.execute(f"ALTER TABLE {table} RENAME TO {storage}")
+    cursor.execute(
+        "SELECT relid::text FROM pg_partition_tree(%s) WHERE level > 0",
+        (storage,),
+    )
+    for (partition,) in cursor.fetchall():
+        if partition.startswith(f"{table}_"):
+            suffix = partition[len(table) + 1 :]
+            cursor.execute(
+                f"ALTER TABLE {partition} RENAME TO {storage}_{suffix}"
+            )
+
+    # Ids of the texts and documents of every row
+    additions, assignments = [], []
+    for column in encoded:
+        if column in DIMENSIONS:
+            additions.append(f"ADD COLUMN {id_column(column)} INTEGER")
+            assignments.append(
+                sql.SQL(
+                    "{id} = (SELECT {id} FROM {dimension} WHERE name = {value})"
+                ).format(
+                    id=sql.Identifier(id_column(column)),
+                    dimension=sql.Identifier(DIMENSIONS[column]),
+                    value=sql.Identifier(storage, column),
+                )
+            )
+        else:
+            additions.append(f"ADD COLUMN {id_column(column)} BIGINT")
+            assignments.append(
+                sql.SQL(
+                    "metadata_id = (SELECT metadata_id FROM {metadata_table} "
+                    "WHERE metadata_hash = {hash})"
+                ).format(
+                    metadata_table=sql.Identifier(METADATA_TABLE),
+                    hash=metadata_hash(sql.Identifier(storage, column)),
+                )
+            )
+    cursor.execute(f"ALTER TABLE {storage} " + ", ".join(additions))
+    cursor.execute(
+        sql.SQL("UPDATE {storage} SET {assignments}").format(
+            storage=sql.Identifier(storage),
+            assignments=sql.SQL(", ").join(assignments),
+        )
+    )
+
+    # Dropping variable drops the key constraint, which is recreated on
+    # variable_id
+    key = ", ".join(
+        id_column(column) if column in DIMENSIONS else column
+        for column in KEY_COLUMNS
+    )
+    constraints = [
+        f"ADD CONSTRAINT {name} PRIMARY KEY ({key})"
+        for name, key_columns in key_constraints(cursor, storage, "p").items()
+        if key_columns == KEY_COLUMNS
+    ] + [
+        f"ADD CONSTRAINT {name} UNIQUE ({key})"
+        for name, key_columns in key_constraints(cursor, storage, "u").items()
+        if key_columns == KEY_COLUMNS
+    ]
+    cursor.execute(
+        f"ALTER TABLE {storage} "
+        + ", ".join(f"DROP COLUMN {column}" for column in encoded)
+    )
+    if constraints:
+        cursor.execute(f"ALTER TABLE {storage} " + ", ".join(constraints))
+
+    select, joins = decode_columns(columns, "e")
+    cursor.execute(
+        sql.SQL(
+            "CREATE VIEW {table} AS "
+            "SELECT {select} FROM {storage} AS e {joins}"
+        ).format(
+            table=sql.Identifier(table),
+            select=select,
+            storage=sql.Identifier(storage),
+            joins=joins,
+        )
+    )
+    cursor.execute(f"DROP TABLE IF EXISTS {staging_table(table)}")
+    cursor.execute(f"ANALYZE {storage}")
+    return encoded
+
+
+def main():
+    """
+    Migrate the ``geospatial_data_*`` tables to the compact schema and
+    optionally encode their texts and metadata.
+    """
+    conn = psycopg2.connect(
+        dbname="merge",
+        user="postgres",
+        password=getpass("Enter the database password: "),
+        host=input("Enter the database host: "),
+        port="5432",
+    )
+    tables = input(
+        "Enter the tables to migrate (comma-separated, empty for all): "
+    )
+    tables = [
+        table.strip() for table in tables.split(",") if table.strip()
+    ] or TABLES
+    encode = (
+        input(
+            "Also move variable, source, unit, note and metadata to "
+            "dimension tables? [y/N]: "
+        )
+        .strip()
+        .lower()
+        == "y"
+    )
+
+    try:
+        for table in tables:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT to_regclass(%s)", (table,))
+                if cursor.fetchone()[0] is None:
+                    print(f"Skipping {table}, which does not exist")
+                    conn.rollback()
+                    continue
+                if encoded_storage(cursor, table) is not None:
+                    print(f"Skipping {table}, which is encoded already")
+                    conn.rollback()
+                    continue
+                before = table_size(cursor, table)
+                try:
+                    steps = migrate_table(cursor, table)
+                    encoded = (
+                        encode_table(cursor, table)
+                        if encode and table in ENCODABLE_TABLES
+                        else []
+                    )
+                except ValueError as error:
+                    print(error)
+                    conn.rollback()
+                    continue
+            conn.commit()
+
+            if not steps and not encoded:
+                print(f"{table} already has the compact schema")
+                continue
+            storage = storage_table(table) if encoded else table
+            if encoded:
+                # Reclaim the row versions of the update
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"VACUUM FULL {storage}")
+                conn.autocommit = False
+            with conn.cursor() as cursor:
+                after = table_size(cursor, storage)
+            conn.commit()
+            print(
+                f"{table}: {len(steps)} changes, {len(encoded)} columns "
+                f"encoded, {before / 2**20:.1f} MB -> {after / 2**20:.1f} MB"
+            )
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Bulk loading of zonal statistics into the ``geospatial_data_*`` tables.
+
+Rows are streamed with ``COPY FROM STDIN`` (CSV) into an unlogged staging
+table next to the target and merged with one set-based
+``INSERT ... SELECT ... ON CONFLICT DO UPDATE`` (one per partition of a
+partitioned table, see ``partitioning``; with the texts replaced by their
+ids for an encoded table, see ``dimensions``). Compared to ``execute_batch``
+this avoids a round trip and a plan execution per row and writes the WAL for
+the target only once.
+"""
+
+import csv
+import io
+
+from psycopg2 import sql
+
+from Geospatial_Lat_Long.dimensions import (
+    encode_columns,
+    encoded_storage,
+    store_dimensions,
+)
+from Geospatial_Lat_Long.partitioning import partition_targets
+from Geospatial_Lat_Long.pivot_tables import mark_changed
+from Geospatial_Lat_Long.temporal_rollup import mark_pending
+
+KEY_COLUMNS = ("gid", "admin_level", "date", "variable")
+NULL = r"\N"
+
+
+class RowStream(io.TextIOBase):
+    """
+    File-like object that renders an iterable of row tuples as CSV on demand,
+    so ``copy_expert`` can stream rows without building the whole payload.
+    """
+
+    def __init__(self, rows, batch_size=10000):
+        self._rows = iter(rows)
+        self._batch_size = batch_size
+        self._buffer = ""
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def _fill(self, size):
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        while size < 0 or len(self._buffer) + out.tell() < size:
+            batch = []
+            for row in self._rows:
+                batch.append([NULL if value is None else value for value in row])
+                if len(batch) >= self._batch_size:
+                    break
+            if not batch:
+                break
+            writer.writerows(batch)
+            self.count += len(batch)
+        self._buffer += out.getvalue()
+
+    def read(self, size=-1):
+        if size is None or size < 0 or len(self._buffer) < size:
+            self._fill(size if size is not None else -1)
+        if size is None or size < 0:
+            chunk, self._buffer = self._buffer, ""
+        else:
+            chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+
+def staging_table(table):
+    """
+    Return the name of the unlogged staging table used for ``table``.
+    """
+    return f"{table}_staging"
+
+
+def ensure_staging_table(cursor, table, columns):
+    """
+    Create the unlogged staging table for ``table`` if it does not exist.
+
+    The staging table only carries the loaded columns (no id, constraints or
+    indexes) so that COPY into it is as cheap as possible.
+    """
+    cursor.execute(
+        sql.SQL(
+            "CREATE UNLOGGED TABLE IF NOT EXISTS {staging} AS "
+            "SELECT {columns} FROM {table} WITH NO DATA"
+        ).format(
+            staging=sql.Identifier(staging_table(table)),
+            columns=sql.SQL(", ").join(map(sql.Identifier, columns)),
+            table=sql.Identifier(table),
+        )
+    )
+
+
+def copy_upsert(
+    conn,
+    table,
+    columns,
+    rows,
+    key_columns=KEY_COLUMNS,
+    commit=True,
+    track_periods=False,
+):
+    """
+    Load rows into ``table`` with COPY and a single upsert.
+
+    Staging, COPY and merge run in one transaction. The staging table is
+    truncated at the start, which also serializes concurrent loaders of the
+    same table. When a key occurs more than once in ``rows`` the last
+    occurrence wins, as it did with row-by-row upserts.
+
+    :param conn: psycopg2 connection
+    :param table: Target table name
+    :param columns: Column names in the order of the row tuples
+    :param rows: Iterable of row tuples (may be a generator)
+    :param key_columns: Columns of the unique constraint used for the upsert
+    :param commit: Commit the transaction. Pass False to commit the load
+        together with further statements (e.g. the processing ledger)
+    :param track_periods: Record the loaded months as pending for the
+        monthly and annual summaries (see ``temporal_rollup``). The loaded
+        (gid, admin_level, date) keys are always recorded for the pivot
+        table of ``table`` once it exists (see ``pivot_tables``)
+    :return: Number of rows streamed to the database
+    """
+    columns = list(columns)
+    staging = sql.Identifier(staging_table(table))
+    column_list = sql.SQL(", ").join(map(sql.Identifier, columns))
+    staged_keys = sql.SQL(", ").join(
+        sql.SQL("s.{column}").format(column=sql.Identifier(column))
+        for column in key_columns
+    )
+
+    stream = RowStream(rows)
+    with conn.cursor() as cursor:
+        ensure_staging_table(cursor, table, columns)
+        cursor.execute(sql.SQL("TRUNCATE {staging}").format(staging=staging))
+        cursor.copy_expert(
+            sql.SQL(
+                "COPY {staging} ({columns}) FROM STDIN "
+                "WITH (FORMAT csv, NULL {null})"
+            )
+            .format(
+                staging=staging, columns=column_list, null=sql.Literal(NULL)
+            )
+            .as_string(conn),
+            stream,
+        )
+
+        # Encoded tables store ids of the texts and metadata, see dimensions
+        storage = encoded_storage(cursor, table)
+        if storage is None:
+            storage, targets, joins = table, columns, []
+            values = [
+                sql.SQL("s.{column}").format(column=sql.Identifier(column))
+                for column in columns
+            ]
+        else:
+            store_dimensions(cursor, staging_table(table), columns)
+            targets, values, joins = encode_columns(columns, "s")
+        target_keys = [
+            targets[columns.index(column)] for column in key_columns
+        ]
+        updates = sql.SQL(", ").join(
+            sql.SQL("{column} = EXCLUDED.{column}").format(
+                column=sql.Identifier(column)
+            )
+            for column in targets
+            if column not in target_keys
+        )
+
+        # Partitioned tables are merged one partition at a time; ctid
+        # follows COPY order in the freshly truncated table
+        merged = 0
+        for target, condition in partition_targets(
+            cursor, storage, staging_table(table)
+        ):
+            cursor.execute(
+                sql.SQL(
+                    "INSERT INTO {target} ({targets}) "
+                    "SELECT DISTINCT ON ({staged_keys}) {values} "
+                    "FROM {staging} AS s {joins} "
+                    "{condition} "
+                    "ORDER BY {staged_keys}, s.ctid DESC "
+                    "ON CONFLICT ({keys}) DO UPDATE SET {updates}"
+                ).format(
+                    target=sql.Identifier(target),
+                    targets=sql.SQL(", ").join(map(sql.Identifier, targets)),
+                    staged_keys=staged_keys,
+                    values=sql.SQL(", ").join(values),
+                    staging=staging,
+                    joins=sql.SQL(" ").join(joins),
+                    condition=condition,
+                    keys=sql.SQL(", ").join(map(sql.Identifier, target_keys)),
+                    updates=updates,
+                )
+            )
+            merged += cursor.rowcount
+        if track_periods:
+            mark_pending(cursor, table, staging_table(table))
+        mark_changed(cursor, table, staging_table(table))
+        cursor.execute(sql.SQL("TRUNCATE {staging}").format(staging=staging))
+    if commit:
+        conn.commit()
+
+    print(f"Loaded {stream.count} rows into {table} ({merged} upserted).")
+    return stream.count
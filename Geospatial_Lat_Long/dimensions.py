@@ -0,0 +1,247 @@
+"""
+Dictionary-encoded text columns of the ``geospatial_data_*`` tables.
+
+Every row repeats its ``variable``, ``source``, ``unit`` and ``note`` as
+text, and some loaders write the same ``metadata`` JSON into many rows: the
+LandCover script stores the class dictionary of a polygon in each of its
+class rows, and the GDL ETLs the same region-year JSON for each of its 16
+variables. An encoded table stores ids instead:
+
+- ``geospatial_variable``, ``geospatial_source``, ``geospatial_unit`` and
+  ``geospatial_note`` map each distinct text to an integer id
+- ``geospatial_metadata`` stores each distinct JSON document once, keyed by
+  the MD5 of its normalized ``jsonb`` text
+
+The rows live in ``{table}_encoded`` with ``variable_id``, ``source_id``,
+``unit_id``, ``note_id`` and ``metadata_id`` columns, and ``{table}`` is
+replaced by a view joining the texts back in, so queries and the
+``mv_geospatial_*`` views keep their column names. ``db_loader.copy_upsert``
+detects an encoded table and adds the new texts and documents of a load to
+the dimension tables before merging the ids. ``compact_schema`` converts
+existing tables.
+"""
+
+from psycopg2 import sql
+
+# Dimension table of each encoded text column
+DIMENSIONS = {
+    "variable": "geospatial_variable",
+    "source": "geospatial_source",
+    "unit": "geospatial_unit",
+    "note": "geospatial_note",
+}
+
+METADATA_TABLE = "geospatial_metadata"
+
+# Columns stored as ids in an encoded table
+ENCODED_COLUMNS = (*DIMENSIONS, "metadata")
+
+
+def storage_table(table):
+    """
+    Return the name of the table holding the rows of an encoded table.
+    """
+    return f"{table}_encoded"
+
+
+def id_column(column):
+    """
+    Return the name of the id column of an encoded column.
+    """
+    return f"{column}_id"
+
+
+def ensure_dimension_tables(cursor):
+    """
+    Create the dimension tables and the metadata table if they do not
+    exist.
+    """
+    for column, dimension in DIMENSIONS.items():
+        cursor.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {dimension} (
+                {id_column(column)} SERIAL PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE
+            )
+            """
+        )
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {METADATA_TABLE} (
+            metadata_id BIGSERIAL PRIMARY KEY,
+            metadata_hash UUID NOT NULL UNIQUE,
+            metadata JSONB NOT NULL
+        )
+        """
+    )
+
+
+def encoded_storage(cursor, table):
+    """
+    Return the storage table of an encoded table, or None if ``table`` is
+    not encoded.
+    """
+    cursor.execute(
+        """
+        SELECT c.relkind, to_regclass(%s)
+        FROM pg_class c
+        WHERE c.oid = to_regclass(%s)
+        """,
+        (storage_table(table), table),
+    )
+    result = cursor.fetchone()
+    if result is None or result[0] != "v" or result[1] is None:
+        return None
+    return storage_table(table)
+
+
+def metadata_hash(expression):
+    """
+    Return the SQL hash of a ``jsonb`` expression used as metadata key.
+    """
+    return sql.SQL("md5(({expression})::jsonb::text)::uuid").format(
+        expression=expression
+    )
+
+
+def store_dimensions(cursor, source, columns):
+    """
+    Add the texts and metadata documents of a table that are not in the
+    dimension tables yet, without committing.
+
+    :param cursor: psycopg2 cursor
+    :param source: Table (e.g. a staging table) with the text columns
+    :param columns: Columns of ``source`` to store
+    """
+    for column in columns:
+        if column in DIMENSIONS:
+            cursor.execute(
+                sql.SQL(
+                    "INSERT INTO {dimension} (name) "
+                    "SELECT DISTINCT {column} FROM {source} "
+                    "WHERE {column} IS NOT NULL "
+                    "ON CONFLICT (name) DO NOTHING"
+                ).format(
+                    dimension=sql.Identifier(DIMENSIONS[column]),
+                    column=sql.Identifier(column),
+                    source=sql.Identifier(source),
+                )
+            )
+        elif column == "metadata":
+            cursor.execute(
+                sql.SQL(
+                    "INSERT INTO {metadata_table} (metadata_hash, metadata) "
+                    "SELECT DISTINCT {hash}, metadata::jsonb "
+                    "FROM {source} WHERE metadata IS NOT NULL "
+                    "ON CONFLICT (metadata_hash) DO NOTHING"
+                ).format(
+                    metadata_table=sql.Identifier(METADATA_TABLE),
+                    hash=metadata_hash(sql.Identifier("metadata")),
+                    source=sql.Identifier(source),
+                )
+            )
+
+
+def encode_columns(columns, alias):
+    """
+    Return how the rows of a table with text columns are written to an
+    encoded table.
+
+    :param columns: Columns of the text table
+    :param alias: Alias of the text table in the query
+    :return: Tuple of (column names of the encoded table, SQL expressions of
+        their values, SQL joins of the dimension tables the expressions
+        read)
+    """
+    alias = sql.Identifier(alias)
+    targets, values, joins = [], [], []
+    for column in columns:
+        if column in DIMENSIONS:
+            dimension = sql.Identifier(f"{column}_dimension")
+            targets.append(id_column(column))
+            values.append(
+                sql.SQL("{dimension}.{id}").format(
+                    dimension=dimension,
+                    id=sql.Identifier(id_column(column)),
+                )
+            )
+            joins.append(
+                sql.SQL(
+                    "LEFT JOIN {table} AS {dimension} "
+                    "ON {dimension}.name = {alias}.{column}"
+                ).format(
+                    table=sql.Identifier(DIMENSIONS[column]),
+                    dimension=dimension,
+                    alias=alias,
+                    column=sql.Identifier(column),
+                )
+            )
+        elif column == "metadata":
+            targets.append(id_column(column))
+            values.append(sql.SQL("metadata_dimension.metadata_id"))
+            joins.append(
+                sql.SQL(
+                    "LEFT JOIN {table} AS metadata_dimension "
+                    "ON metadata_dimension.metadata_hash = {hash}"
+                ).format(
+                    table=sql.Identifier(METADATA_TABLE),
+                    hash=metadata_hash(
+                        sql.SQL("{alias}.metadata").format(alias=alias)
+                    ),
+                )
+            )
+        else:
+            targets.append(column)
+            values.append(
+                sql.SQL("{alias}.{column}").format(
+                    alias=alias, column=sql.Identifier(column)
+                )
+            )
+    return targets, values, joins
+
+
+def decode_columns(columns, alias):
+    """
+    Return the select list and joins of a view restoring the text columns
+    of an encoded table.
+
+    :param columns: Columns of the view, in order
+    :param alias: Alias of the encoded table in the view
+    :return: Tuple of (SQL select list, SQL joins)
+    """
+    alias = sql.Identifier(alias)
+    select, joins = [], []
+    for column in columns:
+        if column in DIMENSIONS:
+            dimension = sql.Identifier(f"{column}_dimension")
+            select.append(
+                sql.SQL("{dimension}.name AS {column}").format(
+                    dimension=dimension, column=sql.Identifier(column)
+                )
+            )
+            joins.append(
+                sql.SQL(
+                    "LEFT JOIN {table} AS {dimension} "
+                    "ON {dimension}.{id} = {alias}.{id}"
+                ).format(
+                    table=sql.Identifier(DIMENSIONS[column]),
+                    dimension=dimension,
+                    id=sql.Identifier(id_column(column)),
+                    alias=alias,
+                )
+            )
+        elif column == "metadata":
+            select.append(sql.SQL("metadata_dimension.metadata"))
+            joins.append(
+                sql.SQL(
+                    "LEFT JOIN {table} AS metadata_dimension "
+                    "ON metadata_dimension.metadata_id = {alias}.metadata_id"
+                ).format(table=sql.Identifier(METADATA_TABLE), alias=alias)
+            )
+        else:
+            select.append(
+                sql.SQL("{alias}.{column}").format(
+                    alias=alias, column=sql.Identifier(column)
+                )
+            )
+    return sql.SQL(", ").join(select), sql.SQL(" ").join(joins)
@@ -0,0 +1,492 @@
+"""
+Zonal class histograms of categorical rasters from polygon label rasters.
+
+Counting the classes of every polygon by clipping the raster to it and
+running ``np.unique`` costs one clip per polygon and file. This engine
+rasterizes a GADM level once into a label raster, an int32 GeoTIFF holding
+for every cell the (1-based) position of the polygon its center falls in,
+and streams a categorical raster tile by tile against it. The polygon x
+class counts of a tile are a single ``np.bincount`` over
+``label * n_classes + class``.
+
+With ``all_touched``, a polygon also owns the cells its boundary touches
+without covering their center, and cells whose center is claimed by an
+overlapping polygon. These boundary cells are stored next to the label
+raster as a sparse polygon x cell matrix and counted per tile as well, so
+the counts equal an ``all_touched`` clip of every polygon.
+
+Label rasters live in the mask cache directory, keyed like the coverage
+matrices, and are reused by every file on the same grid. Memory is bounded
+by the tile size and the polygon x class count table, not by the raster.
+"""
+
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import rasterio
+import shapely
+from rasterio import features, windows
+from scipy import sparse
+from tqdm import tqdm
+
+from Geospatial_Lat_Long.mask_cache import (
+    DEFAULT_MAX_CACHE_BYTES,
+    cache_key,
+    evict,
+    geometry_window,
+    load_coverage,
+    save_coverage,
+)
+from Geospatial_Lat_Long.tiled_zonal import DEFAULT_TILE_SIZE, build_tile_index
+
+# Block edge length of the label GeoTIFFs
+LABEL_BLOCK_SIZE = 256
+
+# State of the worker processes, set by the pool initializers
+_worker = {}
+
+
+def tile_window(tile_row, tile_col, tile_size, shape):
+    """
+    Return the window of a tile, clamped to the raster.
+    """
+    height, width = shape
+    row_off, col_off = tile_row * tile_size, tile_col * tile_size
+    return windows.Window(
+        col_off,
+        row_off,
+        min(tile_size, width - col_off),
+        min(tile_size, height - row_off),
+    )
+
+
+def clip_to_window(geometry, window, transform):
+    """
+    Clip a geometry to a window padded by one cell, so the cells it touches
+    inside the window stay the same.
+    """
+    window_transform = windows.transform(window, transform)
+    left, top = window_transform * (-1, -1)
+    right, bottom = window_transform * (window.width + 1, window.height + 1)
+    return shapely.clip_by_rect(
+        geometry,
+        min(left, right),
+        min(top, bottom),
+        max(left, right),
+        max(top, bottom),
+    )
+
+
+def label_tile(window, positions, geometries, transform, shape):
+    """
+    Rasterize the polygons of one tile into labels and boundary cells.
+
+    :param window: Window of the tile
+    :param positions: Positions of the polygons overlapping the tile
+    :param geometries: Sequence of Shapely geometries of the level
+    :param transform: Affine transform of the raster
+    :param shape: Tuple of (height, width) of the raster
+    :return: Tuple of (labels, boundary positions, boundary flat cell
+        indices); labels are 0 where no polygon covers the cell center
+    """
+    window_transform = windows.transform(window, transform)
+    out_shape = (window.height, window.width)
+
+    clipped = {}
+    for position in positions:
+        geometry = clip_to_window(geometries[position], window, transform)
+        if not geometry.is_empty:
+            clipped[position] = geometry
+
+    empty = np.empty(0, dtype=np.int64)
+    if not clipped:
+        return np.zeros(out_shape, dtype=np.int32), empty, empty
+
+    labels = features.rasterize(
+        ((geometry, position + 1) for position, geometry in clipped.items()),
+        out_shape=out_shape,
+        transform=window_transform,
+        fill=0,
+        all_touched=False,
+        dtype="int32",
+    )
+
+    boundary_positions, boundary_cells = [empty], [empty]
+    for position, geometry in clipped.items():
+        row_start, row_stop, col_start, col_stop = geometry_window(
+            geometry, window_transform, out_shape
+        )
+        if row_start >= row_stop or col_start >= col_stop:
+            continue
+
+        sub_window = windows.Window(
+            col_start, row_start, col_stop - col_start, row_stop - row_start
+        )
+        touched = features.geometry_mask(
+            [geometry],
+            out_shape=(row_stop - row_start, col_stop - col_start),
+            transform=windows.transform(sub_window, window_transform),
+            all_touched=True,
+            invert=True,
+        )
+        # Touched cells that are not labelled with the polygon
+        touched &= labels[row_start:row_stop, col_start:col_stop] != (
+            position + 1
+        )
+        rows, cols = np.nonzero(touched)
+        boundary_positions.append(np.full(rows.size, position, np.int64))
+        boundary_cells.append(
+            (rows + row_start + window.row_off) * shape[1]
+            + cols
+            + col_start
+            + window.col_off
+        )
+
+    return (
+        labels,
+        np.concatenate(boundary_positions),
+        np.concatenate(boundary_cells),
+    )
+
+
+def _init_label_worker(geometries, transform, shape, tile_size):
+    _worker.update(
+        geometries=geometries,
+        transform=transform,
+        shape=shape,
+        tile_size=tile_size,
+    )
+
+
+def _label_task(task):
+    (tile_row, tile_col), positions = task
+    window = tile_window(
+        tile_row, tile_col, _worker["tile_size"], _worker["shape"]
+    )
+    return (window,) + label_tile(
+        window,
+        positions,
+        _worker["geometries"],
+        _worker["transform"],
+        _worker["shape"],
+    )
+
+
+def build_label_raster(
+    geometries,
+    transform,
+    shape,
+    crs,
+    path,
+    tile_size=DEFAULT_TILE_SIZE,
+    processes=1,
+):
+    """
+    Write the label raster of a level and return its boundary cells.
+
+    :param geometries: Sequence of Shapely geometries in the raster CRS
+    :param transform: Affine transform of the raster
+    :param shape: Tuple of (height, width) of the raster
+    :param crs: CRS of the raster
+    :param path: Path of the label GeoTIFF
+    :param tile_size: Tile edge length in cells
+    :param processes: Number of worker processes (1 runs in this process)
+    :return: scipy.sparse CSR matrix of shape (n_polygons, height * width)
+        holding 1 for the boundary cells of each polygon
+    """
+    geometries = list(geometries)
+    tile_index = sorted(
+        build_tile_index(geometries, transform, shape, tile_size).items()
+    )
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp.tif"
+    profile = {
+        "driver": "GTiff",
+        "height": shape[0],
+        "width": shape[1],
+        "count": 1,
+        "dtype": "int32",
+        "crs": crs,
+        "transform": transform,
+        "tiled": True,
+        "blockxsize": LABEL_BLOCK_SIZE,
+        "blockysize": LABEL_BLOCK_SIZE,
+        "compress": "deflate",
+        "predictor": 2,
+        "BIGTIFF": "IF_SAFER",
+    }
+
+    boundary_positions, boundary_cells = [], []
+    initargs = (geometries, transform, shape, tile_size)
+    if processes > 1:
+        pool = Pool(processes, _init_label_worker, initargs)
+        results = pool.imap_unordered(_label_task, tile_index)
+    else:
+        pool = None
+        _init_label_worker(*initargs)
+        results = map(_label_task, tile_index)
+
+    try:
+        # Tiles are written as they arrive; tiles without polygons stay 0
+        with rasterio.open(tmp_path, "w", **profile) as dst:
+            for window, labels, positions, cells in tqdm(
+                results, total=len(tile_index), desc="Labelling tiles"
+            ):
+                dst.write(labels, 1, window=window)
+                boundary_positions.append(positions)
+                boundary_cells.append(cells)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    os.replace(tmp_path, path)
+
+    if boundary_cells:
+        boundary_positions = np.concatenate(boundary_positions)
+        boundary_cells = np.concatenate(boundary_cells)
+    else:
+        boundary_positions = boundary_cells = np.empty(0, dtype=np.int64)
+
+    return sparse.csr_matrix(
+        (
+            np.ones(boundary_cells.size),
+            (boundary_positions, boundary_cells),
+        ),
+        shape=(len(geometries), shape[0] * shape[1]),
+    )
+
+
+def get_label_raster(
+    gdf,
+    gid_column,
+    transform,
+    shape,
+    crs,
+    geopackage_path,
+    level,
+    cache_dir,
+    tile_size=DEFAULT_TILE_SIZE,
+    processes=1,
+    max_bytes=DEFAULT_MAX_CACHE_BYTES,
+):
+    """
+    Load the label raster of a GADM level from the cache, building and
+    storing it on a miss.
+
+    :param gdf: GeoDataFrame with the level's geometries in the grid CRS
+    :param gid_column: Name of the GID column
+    :param transform: Affine transform of the grid
+    :param shape: Tuple of (height, width) of the grid
+    :param crs: CRS of the grid
+    :param geopackage_path: Path to the GADM GeoPackage
+    :param level: Administrative level
+    :param cache_dir: Cache directory
+    :param tile_size: Tile edge length in cells used to build it
+    :param processes: Number of worker processes used to build it
+    :param max_bytes: Size budget of the cache directory
+    :return: Tuple of (label GeoTIFF path, CSR boundary cell matrix)
+    """
+    key = cache_key(transform, shape, crs, geopackage_path, level, "labels")
+    labels_path = os.path.join(cache_dir, f"ADM_{level}_labels_{key}.tif")
+    boundary_path = os.path.join(cache_dir, f"ADM_{level}_labels_{key}.npz")
+    gids = gdf[gid_column].to_numpy(dtype=str)
+
+    if os.path.exists(labels_path) and os.path.exists(boundary_path):
+        boundary, cached_gids = load_coverage(boundary_path)
+        if np.array_equal(cached_gids, gids):
+            os.utime(labels_path)
+            os.utime(boundary_path)
+            return labels_path, boundary
+        print(f"Polygon ids changed, rebuilding label raster {labels_path}")
+
+    print(f"Rasterizing level {level} (labels) on grid {tuple(shape)}")
+    boundary = build_label_raster(
+        gdf.geometry.values,
+        transform,
+        shape,
+        crs,
+        labels_path,
+        tile_size=tile_size,
+        processes=processes,
+    )
+    save_coverage(boundary_path, boundary, gids)
+    evict(cache_dir, max_bytes, keep=(labels_path, boundary_path))
+    return labels_path, boundary
+
+
+def boundary_cells_by_tile(boundary, width, tile_size):
+    """
+    Group the boundary cells of a level by tile.
+
+    :return: Dictionary of (tile_row, tile_col) -> (positions, rows, cols),
+        rows and cols relative to the tile
+    """
+    boundary = boundary.tocoo()
+    rows, cols = np.divmod(boundary.col.astype(np.int64), width)
+    tile_rows, tile_cols = rows // tile_size, cols // tile_size
+
+    order = np.lexsort((tile_cols, tile_rows))
+    positions = boundary.row[order].astype(np.int64)
+    rows, cols = rows[order], cols[order]
+    tile_rows, tile_cols = tile_rows[order], tile_cols[order]
+
+    starts = np.flatnonzero(
+        np.diff(tile_rows, prepend=-1) | np.diff(tile_cols, prepend=-1)
+    )
+    stops = np.append(starts[1:], order.size)
+
+    groups = {}
+    for start, stop in zip(starts, stops):
+        tile_row, tile_col = int(tile_rows[start]), int(tile_cols[start])
+        groups[(tile_row, tile_col)] = (
+            positions[start:stop],
+            rows[start:stop] - tile_row * tile_size,
+            cols[start:stop] - tile_col * tile_size,
+        )
+    return groups
+
+
+def class_indices(values, n_classes):
+    """
+    Return the class of every cell as an int64 array and the mask of cells
+    with a valid class (not NaN and within ``0..n_classes - 1``).
+    """
+    valid = np.isfinite(values) & (values >= 0) & (values < n_classes)
+    return np.where(valid, values, 0).astype(np.int64), valid
+
+
+def _init_count_worker(
+    open_values, labels_path, n_polygons, n_classes, tile_size
+):
+    da = open_values()
+    src = rasterio.open(labels_path)
+    _worker.update(
+        values=da,
+        labels=src,
+        shape=(src.height, src.width),
+        lookup=np.zeros(n_polygons + 1, dtype=np.int64),
+        n_classes=n_classes,
+        tile_size=tile_size,
+    )
+
+
+def _count_task(task):
+    (tile_row, tile_col), positions, boundary = task
+    n_classes = _worker["n_classes"]
+    window = tile_window(
+        tile_row, tile_col, _worker["tile_size"], _worker["shape"]
+    )
+    row_slice, col_slice = window.toslices()
+
+    labels = _worker["labels"].read(1, window=window)
+    values = np.asarray(_worker["values"][row_slice, col_slice].values)
+    classes, valid = class_indices(values, n_classes)
+
+    # Polygon positions of the tile -> 1..k, 0 for unlabelled cells
+    lookup = _worker["lookup"]
+    n_local = positions.size + 1
+    lookup[positions + 1] = np.arange(1, n_local)
+    local = lookup[labels]
+
+    cell_counts = np.bincount(local.ravel(), minlength=n_local)
+    counts = np.bincount(
+        (local * n_classes + classes)[valid], minlength=n_local * n_classes
+    )
+
+    boundary_positions, boundary_rows, boundary_cols = boundary
+    if boundary_positions.size:
+        boundary_local = lookup[boundary_positions + 1]
+        boundary_classes = classes[boundary_rows, boundary_cols]
+        boundary_valid = valid[boundary_rows, boundary_cols]
+        cell_counts += np.bincount(boundary_local, minlength=n_local)
+        counts += np.bincount(
+            (boundary_local * n_classes + boundary_classes)[boundary_valid],
+            minlength=n_local * n_classes,
+        )
+
+    lookup[positions + 1] = 0
+    return (
+        positions,
+        counts.reshape(n_local, n_classes)[1:],
+        cell_counts[1:],
+    )
+
+
+def zonal_class_counts(
+    open_values,
+    labels_path,
+    boundary,
+    geometries,
+    n_classes,
+    tile_size=DEFAULT_TILE_SIZE,
+    processes=1,
+    desc=None,
+):
+    """
+    Count the classes of a categorical raster in every polygon, tile by
+    tile.
+
+    :param open_values: Picklable callable returning the raster as a lazy
+        2-D DataArray on the grid of the label raster (NaN for nodata)
+    :param labels_path: Path to the label GeoTIFF (see ``get_label_raster``)
+    :param boundary: CSR boundary cell matrix of the label raster
+    :param geometries: Sequence of Shapely geometries of the level, in the
+        order of the label raster
+    :param n_classes: Number of class values (classes are 0..n_classes - 1)
+    :param tile_size: Tile edge length in cells
+    :param processes: Number of worker processes (1 runs in this process)
+    :param desc: Progress bar description
+    :return: Tuple of (counts, cell_counts): an int64 array of shape
+        (n_polygons, n_classes) with the valid cells of each class, and the
+        number of cells touched by each polygon, valid or not
+    """
+    geometries = list(geometries)
+    n_polygons = len(geometries)
+
+    with rasterio.open(labels_path) as src:
+        transform, shape = src.transform, (src.height, src.width)
+    tile_index = build_tile_index(geometries, transform, shape, tile_size)
+    boundary_groups = boundary_cells_by_tile(boundary, shape[1], tile_size)
+
+    empty = np.empty(0, dtype=np.int64)
+    tasks = [
+        (
+            tile,
+            np.asarray(positions, dtype=np.int64),
+            boundary_groups.get(tile, (empty, empty, empty)),
+        )
+        for tile, positions in sorted(tile_index.items())
+    ]
+
+    counts = np.zeros((n_polygons, n_classes), dtype=np.int64)
+    cell_counts = np.zeros(n_polygons, dtype=np.int64)
+
+    initargs = (open_values, labels_path, n_polygons, n_classes, tile_size)
+    if processes > 1:
+        pool = Pool(processes, _init_count_worker, initargs)
+        results = pool.imap_unordered(_count_task, tasks)
+    else:
+        pool = None
+        _init_count_worker(*initargs)
+        results = map(_count_task, tasks)
+
+    try:
+        for positions, part_counts, part_cell_counts in tqdm(
+            results, total=len(tasks), desc=desc
+        ):
+            counts[positions] += part_counts
+            cell_counts[positions] += part_cell_counts
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        else:
+            _worker["labels"].close()
+
+    return counts, cell_counts
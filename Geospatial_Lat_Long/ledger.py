@@ -0,0 +1,314 @@
+"""
+Processing ledger for the lat/long zonal statistics scripts.
+
+Progress used to be tracked by moving input files into
+``processed/level_{level}`` folders, which fails on read-only mounts and
+cannot express "variable X at level 2 is done for file Y". The ledger keeps
+it in PostgreSQL instead:
+
+- ``processing_ledger`` holds one entry per unit of work, keyed by
+  (source, file checksum, variable, admin level, method), with its status,
+  row and polygon counts and the time spent on it
+- ``processing_ledger_polygons`` holds the polygons already loaded for
+  entries that are still running
+- ``processing_ledger_checksums`` remembers the checksum of every file by
+  path, size and modification time, so an unchanged file is only hashed
+  on the first run that sees it
+
+Rows and the polygons they cover are recorded in the same transaction, so
+after a crash a script skips the finished entries and, within an entry,
+only processes the polygons that were not loaded yet. Entries are keyed by
+the file content, so a renamed or moved file is still recognized and a
+re-downloaded file with new content is processed again.
+
+A file read in time windows (e.g. an annual GLEAM file read month by
+month) has one entry per window, with the window appended to the method
+(``all_touched@2019-01-01``), so an interrupted run resumes at the window
+it stopped in.
+
+A Zarr store grows with every append, so it is always read in windows and
+each window is keyed by ``window_checksum`` instead of the store content:
+appending a day only adds entries for the windows it was written to.
+"""
+
+import hashlib
+import os
+
+LEDGER_TABLE = "processing_ledger"
+POLYGON_TABLE = "processing_ledger_polygons"
+CHECKSUM_TABLE = "processing_ledger_checksums"
+
+_checksums = {}
+
+
+def file_checksum(file_path, cursor=None, chunk_size=16 * 1024**2):
+    """
+    Return the SHA-256 of a file's content.
+
+    Checksums are remembered per path, size and modification time, in the
+    process and, with a ``cursor``, in ``processing_ledger_checksums``, so
+    a file is only read when it is new or has changed since it was last
+    hashed. Zarr stores are identified per window, see
+    ``window_checksum``.
+
+    :param file_path: Path to the file
+    :param cursor: psycopg2 cursor of the ledger database, or None to only
+        remember checksums in this process
+    :param chunk_size: Read size in bytes when hashing
+    :return: Hex digest
+    """
+    stat = os.stat(file_path)
+    key = (os.path.realpath(file_path), stat.st_size, stat.st_mtime_ns)
+    if key in _checksums:
+        return _checksums[key]
+
+    if cursor is not None:
+        cursor.execute(
+            f"""
+            SELECT checksum FROM {CHECKSUM_TABLE}
+            WHERE file_path = %s AND size = %s AND mtime_ns = %s
+            """,
+            key,
+        )
+        result = cursor.fetchone()
+        if result is not None:
+            _checksums[key] = result[0]
+            return result[0]
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    _checksums[key] = digest.hexdigest()
+
+    if cursor is not None:
+        cursor.execute(
+            f"""
+            INSERT INTO {CHECKSUM_TABLE}
+                (file_path, size, mtime_ns, checksum)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (file_path)
+            DO UPDATE SET size = EXCLUDED.size,
+                mtime_ns = EXCLUDED.mtime_ns,
+                checksum = EXCLUDED.checksum
+            """,
+            (*key, _checksums[key]),
+        )
+    return _checksums[key]
+
+
+def window_checksum(file_path, times, chunk_paths):
+    """
+    Return the SHA-256 identifying a time window of a Zarr store.
+
+    The window is identified by the store path, its first and last
+    timestep and the number of timesteps, and the names and sizes of the
+    chunk files holding it. Chunks of earlier windows are not rewritten by
+    an append, so their entries stay done; the window of a partly filled
+    last chunk gets a new entry when timesteps are appended to it.
+
+    :param file_path: Path to the Zarr store
+    :param times: Time coordinate values of the window
+    :param chunk_paths: Chunk files holding the window, see
+        ``zarr_store.chunk_files``
+    :return: Hex digest
+    """
+    digest = hashlib.sha256()
+    digest.update(os.path.realpath(file_path).encode())
+    digest.update(f"|{times[0]}|{times[-1]}|{len(times)}".encode())
+    for path in sorted(chunk_paths):
+        name = os.path.relpath(path, file_path)
+        digest.update(f"|{name}:{os.path.getsize(path)}".encode())
+    return digest.hexdigest()
+
+
+def ensure_ledger(cursor):
+    """
+    Create the ledger tables if they do not exist.
+    """
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {LEDGER_TABLE} (
+            id SERIAL PRIMARY KEY,
+            source TEXT NOT NULL,
+            file_checksum TEXT NOT NULL,
+            variable TEXT NOT NULL,
+            admin_level INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            file_path TEXT,
+            status TEXT NOT NULL DEFAULT 'running',
+            row_count BIGINT NOT NULL DEFAULT 0,
+            polygon_count INTEGER NOT NULL DEFAULT 0,
+            seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+            started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ,
+            UNIQUE (source, file_checksum, variable, admin_level, method)
+        );
+
+        CREATE TABLE IF NOT EXISTS {POLYGON_TABLE} (
+            ledger_id INTEGER NOT NULL
+                REFERENCES {LEDGER_TABLE} (id) ON DELETE CASCADE,
+            gid TEXT NOT NULL,
+            PRIMARY KEY (ledger_id, gid)
+        );
+
+        CREATE TABLE IF NOT EXISTS {CHECKSUM_TABLE} (
+            file_path TEXT PRIMARY KEY,
+            size BIGINT NOT NULL,
+            mtime_ns BIGINT NOT NULL,
+            checksum TEXT NOT NULL
+        );
+        """
+    )
+
+
+class LedgerEntry:
+    """
+    One unit of work: a file, variable, admin level and method.
+
+    ``completed_gids`` holds the polygons already loaded by an earlier,
+    interrupted run.
+    """
+
+    def __init__(self, entry_id, variable, done, completed_gids):
+        self.id = entry_id
+        self.variable = variable
+        self.done = done
+        self.completed_gids = completed_gids
+
+
+def start_entry(
+    conn,
+    source,
+    file_path,
+    variable,
+    level,
+    method,
+    window=None,
+    checksum=None,
+):
+    """
+    Register a unit of work, or look up its progress if it already exists.
+
+    :param conn: psycopg2 connection
+    :param source: Data source, as in the ``source`` column of the rows
+    :param file_path: Path to the input file
+    :param variable: Variable name
+    :param level: Administrative level
+    :param method: Calculation method (e.g. ``all_touched``)
+    :param window: Label of the time window of the file, for files processed
+        one window at a time
+    :param checksum: Checksum identifying the work, e.g. the
+        ``window_checksum`` of a store window; defaults to the SHA-256 of
+        the file
+    :return: LedgerEntry
+    """
+    if window is not None:
+        method = f"{method}@{window}"
+    with conn.cursor() as cursor:
+        ensure_ledger(cursor)
+        if checksum is None:
+            checksum = file_checksum(file_path, cursor)
+        cursor.execute(
+            f"""
+            INSERT INTO {LEDGER_TABLE}
+                (source, file_checksum, variable, admin_level, method,
+                 file_path)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (source, file_checksum, variable, admin_level, method)
+            DO UPDATE SET file_path = EXCLUDED.file_path
+            RETURNING id, status
+            """,
+            (source, checksum, variable, level, method, file_path),
+        )
+        entry_id, status = cursor.fetchone()
+
+        completed_gids = set()
+        if status != "done":
+            cursor.execute(
+                f"SELECT gid FROM {POLYGON_TABLE} WHERE ledger_id = %s",
+                (entry_id,),
+            )
+            completed_gids = {gid for (gid,) in cursor.fetchall()}
+    conn.commit()
+
+    if completed_gids:
+        print(
+            f"Resuming {variable} at level {level} from {file_path}: "
+            f"{len(completed_gids)} polygons already loaded"
+        )
+    return LedgerEntry(entry_id, variable, status == "done", completed_gids)
+
+
+def record_rows(conn, entries, rows):
+    """
+    Record the polygons and row counts of loaded rows, without committing.
+
+    Call it after loading ``rows`` and before the commit of the load, so
+    the data and the progress are committed together. When several entries
+    share a load (several variables of one file), each row is attributed to
+    the entry of its variable.
+
+    :param conn: psycopg2 connection
+    :param entries: Sequence of LedgerEntry
+    :param rows: Loaded row tuples, starting with (gid, admin_level, date,
+        variable)
+    """
+    if not entries:
+        return
+
+    with conn.cursor() as cursor:
+        for entry in entries:
+            entry_rows = (
+                rows
+                if len(entries) == 1
+                else [row for row in rows if row[3] == entry.variable]
+            )
+            gids = sorted({row[0] for row in entry_rows})
+            cursor.execute(
+                f"""
+                INSERT INTO {POLYGON_TABLE} (ledger_id, gid)
+                SELECT %s, unnest(%s::text[])
+                ON CONFLICT DO NOTHING
+                """,
+                (entry.id, gids),
+            )
+            cursor.execute(
+                f"""
+                UPDATE {LEDGER_TABLE}
+                SET row_count = row_count + %s,
+                    polygon_count = polygon_count + %s
+                WHERE id = %s
+                """,
+                (len(entry_rows), cursor.rowcount, entry.id),
+            )
+
+
+def finish_entries(conn, entries, seconds):
+    """
+    Mark entries as done and drop their polygon progress.
+
+    :param conn: psycopg2 connection
+    :param entries: Sequence of LedgerEntry
+    :param seconds: Processing time of this run, added to the entries
+    """
+    ids = [entry.id for entry in entries]
+    if not ids:
+        return
+
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"""
+            UPDATE {LEDGER_TABLE}
+            SET status = 'done', finished_at = now(),
+                seconds = seconds + %s
+            WHERE id = ANY(%s)
+            """,
+            (seconds, ids),
+        )
+        cursor.execute(
+            f"DELETE FROM {POLYGON_TABLE} WHERE ledger_id = ANY(%s)", (ids,)
+        )
+    conn.commit()
+    for entry in entries:
+        entry.done = True
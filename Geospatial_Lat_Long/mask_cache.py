@@ -0,0 +1,294 @@
+"""
+Persistent cache of GADM rasterization masks and coverage fractions.
+
+Rasterizing a GADM level against a grid gives the same result for every file
+on that grid, so the scripts store it once as a sparse coverage matrix
+(polygon x cell, holding 1.0 for all_touched cells or the covered fraction in
+fractional mode). Entries are compressed ``.npz`` files keyed by grid
+transform, shape, CRS, GADM version, level and mode, so a second source on
+the same 0.25 degree grid reuses the masks of the first. The cache directory
+is bounded in size and evicts least recently used entries.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+from rasterio import features, windows
+from rasterio.transform import rowcol
+from scipy import sparse
+
+DEFAULT_MAX_CACHE_BYTES = 5 * 1024**3
+
+
+def default_cache_dir(geopackage_path):
+    """
+    Return the cache directory, ``ZONAL_CACHE_DIR`` if set, otherwise a
+    ``zonal_cache`` folder next to the GeoPackage.
+    """
+    return os.environ.get("ZONAL_CACHE_DIR") or os.path.join(
+        os.path.dirname(os.path.abspath(geopackage_path)), "zonal_cache"
+    )
+
+
+def gadm_version(geopackage_path):
+    """
+    Identify the GADM release from the GeoPackage file name and size.
+    """
+    return (
+        f"{os.path.basename(geopackage_path)}:"
+        f"{os.path.getsize(geopackage_path)}"
+    )
+
+
+def cache_key(transform, shape, crs, geopackage_path, level, mode):
+    """
+    Build the cache key for a GADM level rasterized on a grid.
+
+    :param transform: Affine transform of the grid
+    :param shape: Tuple of (height, width)
+    :param crs: CRS of the grid (anything with a string representation)
+    :param geopackage_path: Path to the GADM GeoPackage
+    :param level: Administrative level
+    :param mode: "all_touched" or "fractional"
+    :return: Hex digest identifying the entry
+    """
+    signature = {
+        "transform": [round(value, 10) for value in tuple(transform)[:6]],
+        "shape": [int(shape[0]), int(shape[1])],
+        "crs": str(crs),
+        "gadm": gadm_version(geopackage_path),
+        "level": int(level),
+        "mode": mode,
+    }
+    return hashlib.sha1(
+        json.dumps(signature, sort_keys=True).encode()
+    ).hexdigest()[:20]
+
+
+def geometry_window(geometry, transform, shape, pad=1):
+    """
+    Return the (row_start, row_stop, col_start, col_stop) cell window
+    covering the geometry bounds, padded by ``pad`` cells and clamped to the grid.
+    """
+    height, width = shape
+    minx, miny, maxx, maxy = geometry.bounds
+    rows, cols = rowcol(transform, [minx, maxx], [maxy, miny])
+
+    row_start = max(min(rows) - pad, 0)
+    row_stop = min(max(rows) + pad + 1, height)
+    col_start = max(min(cols) - pad, 0)
+    col_stop = min(max(cols) + pad + 1, width)
+
+    return row_start, row_stop, col_start, col_stop
+
+
+def rasterize_geometry(geometry, transform, shape, all_touched=True):
+    """
+    Rasterize a single geometry inside its own cell window.
+
+    :param geometry: Shapely geometry object
+    :param transform: Affine transform of the full grid
+    :param shape: Tuple of (height, width) of the full grid
+    :param all_touched: Include every cell touched by the geometry
+    :return: Tuple of (rows, cols, coverage) arrays in grid coordinates
+    """
+    row_start, row_stop, col_start, col_stop = geometry_window(
+        geometry, transform, shape
+    )
+    if row_start >= row_stop or col_start >= col_stop:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=np.float64)
+
+    window = windows.Window(
+        col_start, row_start, col_stop - col_start, row_stop - row_start
+    )
+    mask = features.geometry_mask(
+        [geometry],
+        out_shape=(row_stop - row_start, col_stop - col_start),
+        transform=windows.transform(window, transform),
+        all_touched=all_touched,
+        invert=True,
+    )
+    rows, cols = np.nonzero(mask)
+    return rows + row_start, cols + col_start, np.ones(rows.size)
+
+
+def build_coverage_matrix(geometries, transform, shape, geometry_coverage):
+    """
+    Build a sparse polygon x cell coverage matrix.
+
+    :param geometries: Sequence of Shapely geometries, one row per polygon
+    :param transform: Affine transform of the grid
+    :param shape: Tuple of (height, width) of the grid
+    :param geometry_coverage: Callable ``(geometry, transform, shape)`` returning
+        (rows, cols, coverage) arrays for one geometry
+    :return: scipy.sparse CSR matrix of shape (n_polygons, height * width)
+    """
+    height, width = shape
+
+    poly_index, cell_index, data = [], [], []
+    for i, geometry in enumerate(geometries):
+        if geometry is None or geometry.is_empty:
+            continue
+        rows, cols, coverage = geometry_coverage(geometry, transform, shape)
+        keep = coverage > 0
+        poly_index.append(np.full(keep.sum(), i, dtype=np.int64))
+        cell_index.append(rows[keep] * width + cols[keep])
+        data.append(coverage[keep])
+
+    if data:
+        poly_index = np.concatenate(poly_index)
+        cell_index = np.concatenate(cell_index)
+        data = np.concatenate(data)
+    else:
+        poly_index = cell_index = np.empty(0, dtype=np.int64)
+        data = np.empty(0, dtype=np.float64)
+
+    return sparse.csr_matrix(
+        (data, (poly_index, cell_index)),
+        shape=(len(geometries), height * width),
+    )
+
+
+def save_coverage(path, coverage, gids):
+    """
+    Persist a coverage matrix and its polygon ids as a compressed .npz file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp.npz"
+    np.savez_compressed(
+        tmp_path,
+        data=coverage.data.astype(np.float32),
+        indices=coverage.indices,
+        indptr=coverage.indptr,
+        shape=np.asarray(coverage.shape),
+        gids=np.asarray(gids, dtype=str),
+    )
+    os.replace(tmp_path, path)
+
+
+def load_coverage(path):
+    """
+    Load a coverage matrix written by ``save_coverage``.
+
+    :return: Tuple of (CSR coverage matrix, array of polygon ids)
+    """
+    with np.load(path) as stored:
+        coverage = sparse.csr_matrix(
+            (
+                stored["data"].astype(np.float64),
+                stored["indices"],
+                stored["indptr"],
+            ),
+            shape=tuple(stored["shape"]),
+        )
+        gids = stored["gids"]
+    return coverage, gids
+
+
+def evict(cache_dir, max_bytes=DEFAULT_MAX_CACHE_BYTES, keep=None):
+    """
+    Delete least recently used cache entries until the directory fits in ``max_bytes``.
+
+    :param cache_dir: Cache directory
+    :param max_bytes: Size budget for all entries
+    :param keep: Path, or paths, that must not be evicted (the entry just
+        written)
+    """
+    keep = {keep} if isinstance(keep, str) else set(keep or ())
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith((".npz", ".tif")) and os.path.isfile(path):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        os.remove(path)
+        total -= size
+        print(f"Evicted mask cache entry {path}")
+
+
+def get_coverage_matrix(
+    gdf,
+    gid_column,
+    transform,
+    shape,
+    crs,
+    geopackage_path,
+    level,
+    cache_dir,
+    mode="all_touched",
+    geometry_coverage=rasterize_geometry,
+    max_bytes=DEFAULT_MAX_CACHE_BYTES,
+):
+    """
+    Load the coverage matrix for a GADM level from the cache, building and
+    storing it on a miss.
+
+    :param gdf: GeoDataFrame with the level's geometries in the grid CRS
+    :param gid_column: Name of the GID column
+    :param transform: Affine transform of the grid
+    :param shape: Tuple of (height, width) of the grid
+    :param crs: CRS of the grid
+    :param geopackage_path: Path to the GADM GeoPackage
+    :param level: Administrative level
+    :param cache_dir: Cache directory
+    :param mode: "all_touched" or "fractional", part of the cache key
+    :param geometry_coverage: Per-geometry builder used on a cache miss
+    :param max_bytes: Size budget of the cache directory
+    :return: Tuple of (CSR coverage matrix, array of polygon ids)
+    """
+    key = cache_key(transform, shape, crs, geopackage_path, level, mode)
+    path = os.path.join(cache_dir, f"ADM_{level}_{mode}_{key}.npz")
+    gids = gdf[gid_column].to_numpy(dtype=str)
+
+    if os.path.exists(path):
+        coverage, cached_gids = load_coverage(path)
+        if np.array_equal(cached_gids, gids):
+            os.utime(path)
+            return coverage, cached_gids
+        print(f"Polygon ids changed, rebuilding mask cache entry {path}")
+
+    print(f"Rasterizing level {level} ({mode}) on grid {tuple(shape)}")
+    coverage = build_coverage_matrix(
+        gdf.geometry.values, transform, shape, geometry_coverage
+    )
+    save_coverage(path, coverage, gids)
+    evict(cache_dir, max_bytes, keep=path)
+    return coverage, gids
+
+
+def coverage_cells(coverage, index):
+    """
+    Return the flat cell indices and coverage values of one polygon.
+    """
+    start, stop = coverage.indptr[index], coverage.indptr[index + 1]
+    return coverage.indices[start:stop], coverage.data[start:stop]
+
+
+def touched_cell_count(da, geometry):
+    """
+    Return the number of cells of a DataArray's grid touched by a geometry,
+    the cells the weight matrix counts for a polygon.
+
+    :param da: xarray DataArray with spatial dims and CRS set, e.g. the
+        result of ``rio.clip``
+    :param geometry: Shapely geometry object
+    :return: Number of all_touched cells
+    """
+    mask = features.geometry_mask(
+        [geometry],
+        out_shape=da.rio.shape,
+        transform=da.rio.transform(),
+        all_touched=True,
+        invert=True,
+    )
+    return int(mask.sum())
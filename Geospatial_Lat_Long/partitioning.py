@@ -0,0 +1,172 @@
+"""
+Declarative range partitioning of the ``geospatial_data_*`` tables.
+
+A monolithic table holding decades of daily rows for every level 2 unit
+makes inserts, vacuum and view refreshes slower as it grows. The
+create_table scripts can instead create the table partitioned by year,
+optionally per admin level:
+
+- ``PARTITION BY RANGE (date)`` with one partition per year,
+  ``{table}_{year}``
+- ``PARTITION BY RANGE (admin_level, date)`` with one partition per level
+  and year, ``{table}_l{level}_{year}``
+
+The unique constraint on (gid, admin_level, date, variable) is declared on
+the parent (as primary key in the compact schema), so every partition gets
+its own unique index, and a BRIN index on ``date`` replaces the btree one.
+There is no ``id`` column, since a primary key of a partitioned table has
+to include the partition key.
+
+``db_loader.copy_upsert`` creates the partitions of the years (and levels)
+in a load and merges the staging rows into each partition directly. A
+partition can be detached, bulk-loaded or re-indexed on its own; loading
+rows of a detached partition's period raises an error instead of creating
+a new partition next to it.
+"""
+
+import re
+
+from psycopg2 import sql
+
+
+def create_partitioned_table(
+    cursor, table, columns, constraint, by_level=False, primary_key=False
+):
+    """
+    Create a partitioned ``geospatial_data_*`` table if it does not exist.
+
+    :param cursor: psycopg2 cursor
+    :param table: Table name
+    :param columns: Column definitions of the table (SQL, without ``id``)
+    :param constraint: Name of the unique constraint on the key columns
+    :param by_level: Partition by admin level and year instead of year only
+    :param primary_key: Declare the key columns as primary key
+        ``{table}_pkey`` instead of unique, as in the compact schema (see
+        ``compact_schema``)
+    """
+    key = "admin_level, date" if by_level else "date"
+    if primary_key:
+        constraint, kind = f"{table}_pkey", "PRIMARY KEY"
+    else:
+        kind = "UNIQUE"
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            {columns.strip()},
+            CONSTRAINT {constraint} {kind} (gid, admin_level, date, variable)
+        ) PARTITION BY RANGE ({key});
+
+        CREATE INDEX IF NOT EXISTS {table}_date_brin
+            ON {table} USING brin (date);
+        """
+    )
+
+
+def partition_key(cursor, table):
+    """
+    Return the partition key columns of a table, or None if it is not
+    partitioned.
+    """
+    cursor.execute("SELECT pg_get_partkeydef(to_regclass(%s))", (table,))
+    (definition,) = cursor.fetchone()
+    if definition is None:
+        return None
+    columns = re.search(r"\((.*)\)", definition).group(1)
+    return tuple(column.strip() for column in columns.split(","))
+
+
+def partition_name(table, year, level=None):
+    """
+    Return the name of the partition of a year (and level).
+    """
+    if level is None:
+        return f"{table}_{year}"
+    return f"{table}_l{level}_{year}"
+
+
+def ensure_partition(cursor, table, year, level=None):
+    """
+    Create the partition of a year (and level) if it does not exist.
+
+    :param cursor: psycopg2 cursor
+    :param table: Partitioned table
+    :param year: Year of the partition
+    :param level: Admin level, for tables partitioned by level and year
+    :return: Name of the partition
+    :raises ValueError: If a table of that name exists but is not a
+        partition of ``table`` (e.g. it has been detached)
+    """
+    name = partition_name(table, year, level)
+    if level is None:
+        bounds = sql.SQL("FROM ({start}) TO ({stop})").format(
+            start=sql.Literal(f"{year}-01-01"),
+            stop=sql.Literal(f"{year + 1}-01-01"),
+        )
+    else:
+        bounds = sql.SQL(
+            "FROM ({level}, {start}) TO ({level}, {stop})"
+        ).format(
+            level=sql.Literal(level),
+            start=sql.Literal(f"{year}-01-01"),
+            stop=sql.Literal(f"{year + 1}-01-01"),
+        )
+    cursor.execute(
+        sql.SQL(
+            "CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+            "FOR VALUES {bounds}"
+        ).format(
+            name=sql.Identifier(name),
+            table=sql.Identifier(table),
+            bounds=bounds,
+        )
+    )
+    cursor.execute(
+        """
+        SELECT 1 FROM pg_inherits
+        WHERE inhrelid = to_regclass(%s) AND inhparent = to_regclass(%s)
+        """,
+        (name, table),
+    )
+    if cursor.fetchone() is None:
+        raise ValueError(f"{name} exists but is not a partition of {table}")
+    return name
+
+
+def partition_targets(cursor, table, staging):
+    """
+    Return where the rows of a staging table go.
+
+    :param cursor: psycopg2 cursor
+    :param table: Target table
+    :param staging: Staging table holding the rows
+    :return: List of (target table, SQL condition selecting its rows); the
+        target table itself with an empty condition if it is not partitioned
+    """
+    key = partition_key(cursor, table)
+    if key is None:
+        return [(table, sql.SQL(""))]
+
+    by_level = "admin_level" in key
+    cursor.execute(
+        sql.SQL(
+            "SELECT DISTINCT extract(year FROM date)::int, {level} "
+            "FROM {staging}"
+        ).format(
+            level=sql.SQL("admin_level" if by_level else "NULL::int"),
+            staging=sql.Identifier(staging),
+        )
+    )
+
+    targets = []
+    for year, level in sorted(cursor.fetchall()):
+        name = ensure_partition(cursor, table, year, level)
+        condition = sql.SQL("WHERE date >= {start} AND date < {stop}").format(
+            start=sql.Literal(f"{year}-01-01"),
+            stop=sql.Literal(f"{year + 1}-01-01"),
+        )
+        if by_level:
+            condition = sql.SQL(
+                "{condition} AND admin_level = {level}"
+            ).format(condition=condition, level=sql.Literal(level))
+        targets.append((name, condition))
+    return targets
@@ -0,0 +1,385 @@
+"""
+Incrementally maintained pivot tables of the ``geospatial_data_*`` tables.
+
+The ``mv_geospatial_*`` materialized views of ``Visualization_View_SQL/``
+pivot a whole EAV table into one column per variable with
+``max(CASE WHEN variable = ... END)`` grouped by (gid, admin_level, date),
+so a single new day of data means a ``REFRESH MATERIALIZED VIEW`` that
+rescans every row. This module replaces each view by a table of the same
+name and columns, with (gid, admin_level, date) as primary key, that is
+kept up to date from the keys a load touched:
+
+- ``geospatial_pivot_pending`` holds the (table, gid, admin_level, date)
+  keys loaded since the last refresh; ``db_loader.copy_upsert`` records
+  them in the transaction of the load once the pivot table exists
+- ``refresh`` claims the pending keys of a table, recomputes their pivot
+  rows from the EAV rows of those keys only and upserts them, and deletes
+  the pivot rows of keys that have no EAV rows left
+
+The variables, measures and column names of a pivot are read from its
+``mv_geospatial_{source}.sql`` file, so the view definitions stay the single
+source of the layout. The IDMC and WorldPop PWD ETLs insert into their
+tables directly and record no keys; their small pivots are rebuilt on every
+run instead.
+
+Run this module to replace the views by pivot tables and to refresh them::
+
+    python Geospatial_Lat_Long/pivot_tables.py
+"""
+
+import os
+import re
+from getpass import getpass
+
+import psycopg2
+from psycopg2 import errors, sql
+
+PENDING_TABLE = "geospatial_pivot_pending"
+
+PIVOT_KEY = ("gid", "admin_level", "date")
+
+VIEW_SQL_DIR = os.path.join(
+    os.environ.get(
+        "PROJECT_ROOT",
+        os.path.abspath(os.path.join(os.path.dirname(__file__), "..")),
+    ),
+    "Visualization_View_SQL",
+)
+
+# Tables with a pivot, in the order of mv_geospatial_combined
+TABLES = (
+    "geospatial_data_era5",
+    "geospatial_data_gdl",
+    "geospatial_data_gfed",
+    "geospatial_data_gleam",
+    "geospatial_data_idmc",
+    "geospatial_data_landcover",
+    "geospatial_data_merra2",
+    "geospatial_data_nvdi",
+    "geospatial_data_worldpop",
+    "geospatial_data_worldpop_age_sex",
+    "geospatial_data_worldpop_pwd",
+)
+
+# Tables loaded without db_loader.copy_upsert, rebuilt on every refresh
+FULL_REFRESH_TABLES = (
+    "geospatial_data_idmc",
+    "geospatial_data_worldpop_pwd",
+)
+
+# One "max(CASE WHEN variable = '...' THEN measure ...) AS "column"" of a view
+PIVOT_COLUMN = re.compile(
+    r"WHEN\s+variable(?:::\w+)?\s*=\s*'((?:[^']|'')*)'(?:::\w+)?\s+"
+    r"THEN\s+(\w+)\s+ELSE\s+NULL(?:::\w+)?\s+END\)\s+"
+    r'AS\s+"((?:[^"]|"")*)"'
+)
+
+
+def pivot_table(table):
+    """
+    Return the name of the pivot of a table, that of its materialized view.
+    """
+    return table.replace("geospatial_data_", "mv_geospatial_", 1)
+
+
+def pivot_columns(table):
+    """
+    Read the pivot columns of a table from its materialized view definition.
+
+    :param table: EAV table, e.g. ``geospatial_data_era5``
+    :return: List of (variable, measure column, pivot column) tuples
+    :raises ValueError: If the definition reads another table or has no
+        pivot columns
+    """
+    path = os.path.join(VIEW_SQL_DIR, f"{pivot_table(table)}.sql")
+    with open(path) as f:
+        definition = f.read()
+
+    if not re.search(rf"\bFROM\s+{table}\b", definition):
+        raise ValueError(f"{path} does not read {table}")
+    columns = [
+        (variable.replace("''", "'"), measure, column.replace('""', '"'))
+        for variable, measure, column in PIVOT_COLUMN.findall(definition)
+    ]
+    if not columns:
+        raise ValueError(f"{path} has no pivot columns")
+    return columns
+
+
+def pivot_select(table, columns, keys=None):
+    """
+    Return the query computing the pivot rows of a table.
+
+    :param table: EAV table
+    :param columns: Pivot columns, see ``pivot_columns``
+    :param keys: Table of (gid, admin_level, date) keys to restrict the rows
+        to, all rows if None
+    :return: SQL query
+    """
+    values = [
+        sql.SQL(
+            "max(CASE WHEN d.variable = {variable} THEN d.{measure} END) "
+            "AS {column}"
+        ).format(
+            variable=sql.Literal(variable),
+            measure=sql.Identifier(measure),
+            column=sql.Identifier(column),
+        )
+        for variable, measure, column in columns
+    ]
+    if keys is None:
+        source = sql.SQL("{table} d").format(table=sql.Identifier(table))
+    else:
+        source = sql.SQL(
+            "{keys} k JOIN {table} d "
+            "ON d.gid = k.gid AND d.admin_level = k.admin_level "
+            "AND d.date = k.date"
+        ).format(keys=sql.Identifier(keys), table=sql.Identifier(table))
+    return sql.SQL(
+        "SELECT d.gid, d.admin_level, d.date, {values} FROM {source} "
+        "GROUP BY d.gid, d.admin_level, d.date"
+    ).format(values=sql.SQL(", ").join(values), source=source)
+
+
+def ensure_pending_table(cursor):
+    """
+    Create the table of pending keys if it does not exist.
+    """
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {PENDING_TABLE} (
+            table_name TEXT NOT NULL,
+            gid VARCHAR(15) NOT NULL,
+            admin_level INTEGER NOT NULL,
+            date DATE NOT NULL,
+            PRIMARY KEY (table_name, gid, admin_level, date)
+        )
+        """
+    )
+
+
+def has_pivot_table(cursor, table):
+    """
+    Return whether the pivot of a table is a table (and not still the
+    materialized view).
+    """
+    cursor.execute(
+        "SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)",
+        (pivot_table(table),),
+    )
+    result = cursor.fetchone()
+    return result is not None and result[0] == "r"
+
+
+def mark_changed(cursor, table, staging):
+    """
+    Record the keys of the rows in a staging table as pending, without
+    committing. Nothing is recorded for tables without a pivot table.
+
+    :param cursor: psycopg2 cursor of the load transaction
+    :param table: Table the rows are loaded into
+    :param staging: Staging table holding the rows
+    """
+    if not has_pivot_table(cursor, table):
+        return
+    ensure_pending_table(cursor)
+    cursor.execute(
+        sql.SQL(
+            "INSERT INTO {pending} (table_name, gid, admin_level, date) "
+            "SELECT DISTINCT %s, gid, admin_level, date FROM {staging} "
+            "ON CONFLICT DO NOTHING"
+        ).format(
+            pending=sql.Identifier(PENDING_TABLE),
+            staging=sql.Identifier(staging),
+        ),
+        (table,),
+    )
+
+
+def create_pivot_table(cursor, table):
+    """
+    Replace the materialized view of a table by its pivot table, without
+    committing. The table is created empty, see ``rebuild``.
+
+    :param cursor: psycopg2 cursor
+    :param table: EAV table
+    :return: True if the pivot table was created, False if it existed
+    :raises psycopg2.errors.DependentObjectsStillExist: If views (e.g.
+        ``mv_geospatial_combined``) read the materialized view
+    """
+    if has_pivot_table(cursor, table):
+        return False
+
+    pivot = pivot_table(table)
+    cursor.execute(
+        sql.SQL("DROP MATERIALIZED VIEW IF EXISTS {pivot}").format(
+            pivot=sql.Identifier(pivot)
+        )
+    )
+    # Column types follow the measures, as in the view
+    cursor.execute(
+        sql.SQL("CREATE TABLE {pivot} AS {select} WITH NO DATA").format(
+            pivot=sql.Identifier(pivot),
+            select=pivot_select(table, pivot_columns(table)),
+        )
+    )
+    cursor.execute(
+        sql.SQL("ALTER TABLE {pivot} ADD PRIMARY KEY ({key})").format(
+            pivot=sql.Identifier(pivot),
+            key=sql.SQL(", ").join(map(sql.Identifier, PIVOT_KEY)),
+        )
+    )
+    return True
+
+
+def rebuild(conn, table):
+    """
+    Recompute the whole pivot table of a table.
+
+    :param conn: psycopg2 connection
+    :param table: EAV table
+    :return: Number of pivot rows
+    """
+    pivot = sql.Identifier(pivot_table(table))
+    with conn.cursor() as cursor:
+        ensure_pending_table(cursor)
+        # Keys loaded before the rebuild are covered by it
+        cursor.execute(
+            f"DELETE FROM {PENDING_TABLE} WHERE table_name = %s", (table,)
+        )
+        cursor.execute(sql.SQL("TRUNCATE {pivot}").format(pivot=pivot))
+        cursor.execute(
+            sql.SQL("INSERT INTO {pivot} {select}").format(
+                pivot=pivot, select=pivot_select(table, pivot_columns(table))
+            )
+        )
+        rows = cursor.rowcount
+    conn.commit()
+
+    return rows
+
+
+def refresh(conn, table):
+    """
+    Recompute the pivot rows of the pending keys of a table.
+
+    :param conn: psycopg2 connection
+    :param table: EAV table
+    :return: Tuple of (keys claimed, pivot rows upserted, pivot rows
+        deleted)
+    """
+    pivot = sql.Identifier(pivot_table(table))
+    columns = pivot_columns(table)
+    updates = sql.SQL(", ").join(
+        sql.SQL("{column} = EXCLUDED.{column}").format(
+            column=sql.Identifier(column)
+        )
+        for _, _, column in columns
+    )
+
+    with conn.cursor() as cursor:
+        ensure_pending_table(cursor)
+
+        # Keys loaded while the refresh runs stay pending for the next one
+        cursor.execute(
+            f"""
+            CREATE TEMPORARY TABLE pivot_claimed ON COMMIT DROP AS
+            SELECT gid, admin_level, date FROM {PENDING_TABLE} WITH NO DATA;
+
+            WITH claimed AS (
+                DELETE FROM {PENDING_TABLE}
+                WHERE table_name = %s
+                RETURNING gid, admin_level, date
+            )
+            INSERT INTO pivot_claimed SELECT gid, admin_level, date
+            FROM claimed;
+
+            ANALYZE pivot_claimed;
+            """,
+            (table,),
+        )
+        cursor.execute("SELECT count(*) FROM pivot_claimed")
+        (claimed,) = cursor.fetchone()
+        if not claimed:
+            conn.commit()
+            return 0, 0, 0
+
+        cursor.execute(
+            sql.SQL(
+                "INSERT INTO {pivot} {select} "
+                "ON CONFLICT ({key}) DO UPDATE SET {updates}"
+            ).format(
+                pivot=pivot,
+                select=pivot_select(table, columns, keys="pivot_claimed"),
+                key=sql.SQL(", ").join(map(sql.Identifier, PIVOT_KEY)),
+                updates=updates,
+            )
+        )
+        upserted = cursor.rowcount
+
+        cursor.execute(
+            sql.SQL(
+                "DELETE FROM {pivot} p USING pivot_claimed k "
+                "WHERE p.gid = k.gid AND p.admin_level = k.admin_level "
+                "AND p.date = k.date AND NOT EXISTS ("
+                "SELECT 1 FROM {table} d WHERE d.gid = k.gid "
+                "AND d.admin_level = k.admin_level AND d.date = k.date)"
+            ).format(pivot=pivot, table=sql.Identifier(table))
+        )
+        deleted = cursor.rowcount
+    conn.commit()
+
+    return claimed, upserted, deleted
+
+
+def main():
+    """
+    Replace the materialized views by pivot tables and refresh them.
+    """
+    conn = psycopg2.connect(
+        dbname="merge",
+        user="postgres",
+        password=getpass("Enter the database password: "),
+        host=input("Enter the database host: "),
+        port="5432",
+    )
+    rebuild_all = (
+        input("Rebuild the pivot tables from scratch? [y/N]: ").strip().lower()
+        == "y"
+    )
+
+    try:
+        for table in TABLES:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT to_regclass(%s)", (table,))
+                if cursor.fetchone()[0] is None:
+                    print(f"Skipping {table}, which does not exist")
+                    conn.rollback()
+                    continue
+                try:
+                    created = create_pivot_table(cursor, table)
+                except errors.DependentObjectsStillExist as error:
+                    print(
+                        f"Drop the views reading {pivot_table(table)} "
+                        f"first, and recreate them afterwards: {error}"
+                    )
+                    conn.rollback()
+                    continue
+            conn.commit()
+
+            if created or rebuild_all or table in FULL_REFRESH_TABLES:
+                rows = rebuild(conn, table)
+                print(f"{pivot_table(table)}: rebuilt with {rows} rows")
+                continue
+
+            claimed, upserted, deleted = refresh(conn, table)
+            print(
+                f"{pivot_table(table)}: {claimed} pending keys, {upserted} "
+                f"rows upserted and {deleted} deleted"
+            )
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
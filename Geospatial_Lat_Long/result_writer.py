@@ -0,0 +1,133 @@
+"""
+Streaming of result rows from the worker pools to the database.
+
+The zonal scripts used to collect the rows of a whole file (every polygon
+and every day) before loading them, and the pool kept computing results the
+main process had not consumed yet. At level 2 with daily data that is tens
+of millions of tuples in memory. Rows now flow through a bounded pipeline:
+
+- ``bounded_imap_unordered`` hands tasks to the pool like
+  ``imap_unordered`` but keeps at most ``max_pending`` of them submitted and
+  not yet consumed, so results never pile up faster than they are written
+- ``ResultWriter`` loads row batches on a background thread from a bounded
+  queue; ``put`` blocks while the queue is full, which in turn stops new
+  tasks from being submitted
+
+Database I/O thus overlaps with raster work, and memory is bounded by the
+queue and the tasks in flight instead of the size of the file.
+"""
+
+import queue
+import threading
+
+# Row batches waiting for the writer thread
+DEFAULT_MAX_BATCHES = 4
+
+
+def bounded_imap_unordered(pool, func, iterable, max_pending):
+    """
+    Like ``pool.imap_unordered``, with at most ``max_pending`` tasks
+    submitted and not yet yielded.
+
+    :param pool: multiprocessing Pool
+    :param func: Function applied to every item
+    :param iterable: Task arguments
+    :param max_pending: Maximum number of tasks in flight
+    :return: Generator of results in completion order
+    """
+    done = queue.Queue()
+    pending = 0
+
+    def take():
+        succeeded, value = done.get()
+        if not succeeded:
+            raise value
+        return value
+
+    for item in iterable:
+        if pending >= max_pending:
+            yield take()
+            pending -= 1
+        pool.apply_async(
+            func,
+            (item,),
+            callback=lambda result: done.put((True, result)),
+            error_callback=lambda error: done.put((False, error)),
+        )
+        pending += 1
+
+    while pending:
+        yield take()
+        pending -= 1
+
+
+class ResultWriter:
+    """
+    Background thread that loads row batches from a bounded queue.
+
+    Use it as a context manager: batches put inside the block are written in
+    order by ``write(rows, *args)`` on the writer thread, and leaving the
+    block waits for the queue to drain. An error of the writer is raised on
+    the next ``put`` or when leaving the block; an error inside the block
+    stops the writer without loading the remaining batches.
+    """
+
+    _STOP = object()
+
+    def __init__(self, write, max_batches=DEFAULT_MAX_BATCHES):
+        """
+        :param write: Callable ``(rows, *args)`` loading one batch, e.g. the
+            ``insert_data_to_db`` of a script
+        :param max_batches: Number of batches that may wait for the writer
+            before ``put`` blocks
+        """
+        self._write = write
+        self._queue = queue.Queue(maxsize=max_batches)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._error = None
+        self.rows_written = 0
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self._stop(discard=exc_type is not None)
+        if exc_type is None:
+            self._raise_error()
+        return False
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            if self._error is not None:
+                continue
+            rows, args = item
+            try:
+                self._write(rows, *args)
+                self.rows_written += len(rows)
+            except Exception as error:
+                self._error = error
+
+    def _stop(self, discard=False):
+        if discard:
+            self._error = self._error or RuntimeError("Writer stopped")
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def put(self, rows, *args):
+        """
+        Queue a batch of rows, blocking while the queue is full.
+
+        :param rows: List of row tuples, empty batches are skipped
+        :param args: Further arguments of ``write``
+        """
+        self._raise_error()
+        if rows:
+            self._queue.put((rows, args))
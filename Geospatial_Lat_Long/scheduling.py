@@ -0,0 +1,129 @@
+"""
+Pool sizing and cost-ordered batching of polygons for the worker pools.
+
+The cost of a polygon is very skewed (Russia or Canada against a small
+island), so equal contiguous row slices leave most workers idle while one
+finishes the slice holding the largest country. ``cost_ordered_batches``
+sorts polygons by an estimated cost, puts the most expensive ones first in
+chunks of roughly equal cost, and the scripts hand these out with
+``imap_unordered`` so an idle worker always takes the next chunk.
+"""
+
+import os
+
+import numpy as np
+import psutil
+import shapely
+
+# Memory budget of one worker. Can be overridden with ZONAL_WORKER_MEMORY
+# (bytes) when the grids or the polygons are unusually large.
+WORKER_MEMORY_BYTES = 2 * 1024**3
+
+# Chunks per worker. More chunks balance better at the tail, fewer chunks
+# mean less pickling and progress bar overhead.
+CHUNKS_PER_WORKER = 4
+
+
+def available_cores():
+    """
+    Return the number of cores this process may run on.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def pool_size(n_tasks=None, worker_bytes=None):
+    """
+    Size a worker pool from the available cores and memory.
+
+    ``ZONAL_WORKERS`` overrides the computed size.
+
+    :param n_tasks: Number of tasks, the pool is never larger
+    :param worker_bytes: Estimated peak memory of one worker
+    :return: Number of processes
+    """
+    if worker_bytes is None:
+        worker_bytes = int(
+            os.environ.get("ZONAL_WORKER_MEMORY", WORKER_MEMORY_BYTES)
+        )
+
+    override = os.environ.get("ZONAL_WORKERS")
+    if override:
+        size = int(override)
+    else:
+        by_memory = psutil.virtual_memory().available // max(worker_bytes, 1)
+        size = min(available_cores(), by_memory)
+
+    if n_tasks is not None:
+        size = min(size, n_tasks)
+    return int(max(1, size))
+
+
+def geometry_cost(geometries, resolution=None):
+    """
+    Estimate the processing cost of each geometry.
+
+    :param geometries: Array of Shapely geometries
+    :param resolution: Tuple of (res_x, res_y) of the grid. If given the cost
+        is the number of cells in the bounding box, otherwise the number of
+        vertices
+    :return: Array of costs (0 for empty geometries)
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    if resolution is None:
+        return shapely.get_num_coordinates(geometries).astype(np.float64)
+
+    res_x, res_y = abs(resolution[0]), abs(resolution[1])
+    minx, miny, maxx, maxy = shapely.bounds(geometries).T
+    cells = (np.floor((maxx - minx) / res_x) + 1) * (
+        np.floor((maxy - miny) / res_y) + 1
+    )
+    return np.nan_to_num(cells, nan=0.0)
+
+
+def cost_order(geometries, resolution=None):
+    """
+    Return the positions of the geometries, most expensive first.
+    """
+    cost = geometry_cost(geometries, resolution)
+    return np.argsort(-cost, kind="stable")
+
+
+def cost_ordered_batches(
+    gdf, n_workers, resolution=None, chunks_per_worker=CHUNKS_PER_WORKER
+):
+    """
+    Split a GeoDataFrame into chunks of roughly equal estimated cost,
+    most expensive first.
+
+    Polygons costing more than a chunk's share end up alone in a chunk at
+    the head of the list; cheap polygons are grouped towards the end, which
+    keeps every worker busy until the last chunk.
+
+    :param gdf: GeoDataFrame with the level's geometries
+    :param n_workers: Number of worker processes
+    :param resolution: Tuple of (res_x, res_y) of the grid, see ``geometry_cost``
+    :param chunks_per_worker: Target number of chunks per worker
+    :return: List of GeoDataFrame chunks (original index labels kept)
+    """
+    if len(gdf) == 0:
+        return []
+
+    # Every polygon has a fixed overhead on top of its size
+    cost = geometry_cost(gdf.geometry.values, resolution) + 1.0
+    order = np.argsort(-cost, kind="stable")
+    target = cost.sum() / max(1, n_workers * chunks_per_worker)
+
+    batches = []
+    current, current_cost = [], 0.0
+    for position in order:
+        current.append(position)
+        current_cost += cost[position]
+        if current_cost >= target:
+            batches.append(gdf.iloc[current])
+            current, current_cost = [], 0.0
+    if current:
+        batches.append(gdf.iloc[current])
+    return batches
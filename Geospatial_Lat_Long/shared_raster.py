@@ -0,0 +1,175 @@
+"""
+Shared-memory handoff of rasters to multiprocessing workers.
+
+``pool.imap`` pickles its arguments for every task, so passing a global grid
+through ``functools.partial`` or an argument tuple sends a full copy of it to
+the workers per batch or per geometry. The helpers in this module copy the
+array once into ``multiprocessing.shared_memory`` and pass a small picklable
+handle instead. Workers attach to the block on first use and keep it mapped,
+so every process reads the same physical pages.
+
+Typical use in ``process_level``::
+
+    with share_dataarray(da_daily) as shared_da:
+        partial(process_batch, da_daily=shared_da, ...)
+
+and in the worker::
+
+    da_daily = attach(da_daily)
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+import dask
+import numpy as np
+import xarray as xr
+
+# Blocks a worker keeps mapped. A worker only ever needs the grids of the
+# file in progress, older ones are released when new handles arrive.
+MAX_ATTACHED = 4
+
+_attached = OrderedDict()
+
+# Start the resource tracker before any Pool is created so forked workers
+# share it with the parent. A worker forked without one starts its own on
+# the first attach and unlinks the parent's blocks when it exits.
+resource_tracker.ensure_running()
+
+
+def _open_shared_memory(name):
+    try:
+        # Python >= 3.13: the creating process owns the block
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedArray:
+    """
+    Picklable handle to a NumPy array held in shared memory.
+    """
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+
+    def attach(self):
+        """
+        Return a read-only view of the shared array, mapping the block on
+        first use in this process.
+        """
+        if self.name in _attached:
+            _attached.move_to_end(self.name)
+            return _attached[self.name][1]
+
+        shm = _open_shared_memory(self.name)
+        array = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+        array.flags.writeable = False
+        _attached[self.name] = (shm, array)
+
+        while len(_attached) > MAX_ATTACHED:
+            _, (old_shm, _) = _attached.popitem(last=False)
+            try:
+                old_shm.close()
+            except BufferError:
+                # A view is still referenced, the mapping is released
+                # when it is garbage collected
+                pass
+        return array
+
+
+class SharedDataArray:
+    """
+    Picklable handle to an xarray DataArray whose values are held in shared
+    memory. Coordinates, attributes and the rioxarray spatial dims and CRS
+    are small and travel with the handle.
+    """
+
+    def __init__(self, values, da):
+        self.values = values
+        self.dims = da.dims
+        self.name = da.name
+        self.attrs = dict(da.attrs)
+        self.coords = {
+            name: (coord.dims, coord.values, dict(coord.attrs))
+            for name, coord in da.coords.items()
+        }
+        try:
+            self.x_dim, self.y_dim = da.rio.x_dim, da.rio.y_dim
+            self.crs = da.rio.crs
+        except Exception:
+            self.x_dim = self.y_dim = self.crs = None
+
+    def attach(self):
+        """
+        Rebuild the DataArray on top of the shared values without copying.
+        """
+        da = xr.DataArray(
+            self.values.attach(),
+            dims=self.dims,
+            coords=self.coords,
+            attrs=self.attrs,
+            name=self.name,
+        )
+        if self.x_dim is not None and self.y_dim is not None:
+            da = da.rio.set_spatial_dims(x_dim=self.x_dim, y_dim=self.y_dim)
+        if self.crs is not None:
+            da = da.rio.write_crs(self.crs)
+        return da
+
+
+def attach(obj):
+    """
+    Resolve a shared handle in a worker. Plain arrays and DataArrays are
+    returned unchanged, so workers accept both.
+
+    Dask-backed DataArrays are computed with the synchronous scheduler in
+    the worker: the thread pool of the parent does not survive the fork,
+    and the pool already runs one worker per core.
+    """
+    if isinstance(obj, (SharedArray, SharedDataArray)):
+        return obj.attach()
+    if getattr(obj, "chunks", None) is not None:
+        dask.config.set(scheduler="synchronous")
+    return obj
+
+
+@contextmanager
+def shared_array(array):
+    """
+    Copy ``array`` into a new shared memory block and yield its handle.
+
+    The block is unlinked when the context exits, so all tasks using the
+    handle must have finished by then.
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    try:
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        view[...] = array
+        del view
+        yield SharedArray(shm.name, array.shape, array.dtype)
+    finally:
+        _attached.pop(shm.name, None)
+        shm.close()
+        shm.unlink()
+
+
+@contextmanager
+def share_dataarray(da):
+    """
+    Yield a shared handle for an in-memory DataArray.
+
+    Dask-backed DataArrays are yielded unchanged: they pickle as a small
+    task graph that reads from the file, and loading them here would defeat
+    the out-of-core path.
+    """
+    if da.chunks is not None:
+        yield da
+        return
+
+    with shared_array(da.values) as values:
+        yield SharedDataArray(values, da)
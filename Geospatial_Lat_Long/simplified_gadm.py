@@ -0,0 +1,285 @@
+"""
+Pre-simplified GADM geometries per grid resolution.
+
+GADM coastlines carry millions of vertices, far more detail than a 0.25 or
+0.5 degree grid can resolve, and rasterizing or clipping a polygon costs
+time proportional to its vertex count. This preprocessing stage writes a
+copy of the GeoPackage per grid resolution in which every polygon is:
+
+1. simplified with a tolerance of a small fraction of the cell size,
+   preserving its topology (``shapely.simplify(preserve_topology=True)``)
+2. grown by the tolerance, so every point of the original lies inside the
+   simplified polygon again
+3. snapped to a coordinate grid well below the tolerance
+   (``shapely.set_precision``), with the growth covering the snapping
+
+The result is checked to cover the original polygon, so its all_touched
+cell set on any grid is a superset of the original one; cells are only
+gained where the original boundary passes within the tolerance of a cell it
+does not touch. Given reference grids (a data file of each source), the
+cell sets are compared on them and a polygon whose set differs is retried
+with smaller tolerances and kept unsimplified as a last resort, so the
+masks are identical on those grids. Polygons the simplification does not
+shrink are kept as they are.
+
+Copies live in a ``gadm_simplified`` folder of the mask cache directory,
+keyed by resolution, GADM version and tolerance. ``simplified_geopackage``
+returns the copy of a resolution when it has been built and the original
+GeoPackage otherwise, so the zonal scripts pick it up without changes to
+their prompts. The mask cache key includes the GeoPackage name, so masks of
+the original and the simplified polygons never mix.
+
+Run this module to build the copy for a source::
+
+    python Geospatial_Lat_Long/simplified_gadm.py
+"""
+
+import hashlib
+import json
+import math
+import os
+import sys
+
+import geopandas as gpd
+import numpy as np
+import pyogrio
+import rasterio
+import rioxarray  # noqa: F401 - registers .rio for reference_grid
+import shapely
+import xarray as xr
+from tqdm import tqdm
+
+project_root = os.environ.get(
+    "PROJECT_ROOT",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..")),
+)
+sys.path.append(project_root)
+
+from Geospatial_Lat_Long.mask_cache import (  # noqa: E402
+    default_cache_dir,
+    gadm_version,
+    rasterize_geometry,
+)
+
+# Grid resolution (x, y) in degrees of the sources whose all_touched
+# scripts load the simplified polygons
+SOURCE_RESOLUTIONS = {
+    "ERA5": (0.25, 0.25),
+    "GFED": (0.25, 0.25),
+    "GLEAM": (0.1, 0.1),
+    "MERRA2": (0.625, 0.5),
+    "NASA_MCD43C4": (0.05, 0.05),
+}
+
+# Simplification tolerance as a fraction of the smaller cell edge
+DEFAULT_TOLERANCE_FRACTION = 0.02
+
+# Tolerance divisors tried in turn when the cell sets differ on a
+# reference grid
+TOLERANCE_STEPS = (1, 4, 16)
+
+
+def simplified_path(
+    geopackage_path,
+    resolution,
+    cache_dir=None,
+    tolerance_fraction=DEFAULT_TOLERANCE_FRACTION,
+):
+    """
+    Return the path of the simplified copy of a GeoPackage for a grid
+    resolution.
+    """
+    cache_dir = cache_dir or default_cache_dir(geopackage_path)
+    signature = {
+        "gadm": gadm_version(geopackage_path),
+        "resolution": [round(value, 10) for value in resolution],
+        "tolerance_fraction": tolerance_fraction,
+    }
+    key = hashlib.sha1(
+        json.dumps(signature, sort_keys=True).encode()
+    ).hexdigest()[:12]
+    stem = os.path.splitext(os.path.basename(geopackage_path))[0]
+    x_res, y_res = resolution
+    name = f"{stem}_{x_res:g}x{y_res:g}_{key}.gpkg"
+    return os.path.join(cache_dir, "gadm_simplified", name)
+
+
+def simplified_geopackage(geopackage_path, resolution, cache_dir=None):
+    """
+    Return the simplified copy of a GeoPackage for a grid resolution if it
+    has been built, otherwise the GeoPackage itself.
+    """
+    path = simplified_path(geopackage_path, resolution, cache_dir)
+    if os.path.exists(path):
+        print(f"Using simplified GADM geometries {path}")
+        return path
+    return geopackage_path
+
+
+def precision_grid(tolerance):
+    """
+    Return the coordinate grid size for a tolerance, a power of ten at most
+    a tenth of it.
+    """
+    return 10.0 ** math.floor(math.log10(tolerance / 10))
+
+
+def simplify_geometry(geometry, tolerance):
+    """
+    Simplify a polygon into one that covers it.
+
+    :param geometry: Shapely polygon or multipolygon
+    :param tolerance: Simplification tolerance in CRS units
+    :return: The simplified polygon, or ``geometry`` itself when the result
+        does not cover it or has no fewer vertices
+    """
+    if geometry is None or geometry.is_empty:
+        return geometry
+
+    grid_size = precision_grid(tolerance)
+    simplified = shapely.simplify(geometry, tolerance, preserve_topology=True)
+    # Snapping moves the boundary by less than grid_size
+    grown = shapely.buffer(simplified, tolerance + grid_size, quad_segs=2)
+    grown = shapely.set_precision(grown, grid_size)
+
+    if shapely.get_num_coordinates(grown) >= shapely.get_num_coordinates(
+        geometry
+    ) or not shapely.covers(grown, geometry):
+        return geometry
+    return grown
+
+
+def cell_set(geometry, transform, shape):
+    """
+    Return the sorted flat indices of the cells touched by a geometry.
+    """
+    rows, cols, _ = rasterize_geometry(geometry, transform, shape)
+    return np.sort(rows * shape[1] + cols)
+
+
+def simplify_layer(gdf, resolution, grids=(), tolerance_fraction=None):
+    """
+    Simplify the polygons of a GADM layer for a grid resolution.
+
+    :param gdf: GeoDataFrame in the grid CRS
+    :param resolution: Tuple of (x, y) cell size
+    :param grids: Reference grids as (transform, shape) tuples on which the
+        all_touched cell sets must stay identical
+    :param tolerance_fraction: Tolerance as a fraction of the smaller cell
+        edge, ``DEFAULT_TOLERANCE_FRACTION`` if None
+    :return: GeoDataFrame with the simplified geometries
+    """
+    tolerance_fraction = tolerance_fraction or DEFAULT_TOLERANCE_FRACTION
+    tolerance = min(resolution) * tolerance_fraction
+
+    geometries = []
+    for geometry in tqdm(gdf.geometry.values, desc="Simplifying"):
+        originals = [
+            cell_set(geometry, transform, shape) for transform, shape in grids
+        ]
+        result = geometry
+        for step in TOLERANCE_STEPS:
+            candidate = simplify_geometry(geometry, tolerance / step)
+            if candidate is geometry:
+                break
+            if all(
+                np.array_equal(cell_set(candidate, transform, shape), cells)
+                for (transform, shape), cells in zip(grids, originals)
+            ):
+                result = candidate
+                break
+        geometries.append(result)
+
+    return gdf.set_geometry(
+        gpd.GeoSeries(geometries, index=gdf.index, crs=gdf.crs)
+    )
+
+
+def build_simplified(
+    geopackage_path,
+    resolution,
+    grids=(),
+    cache_dir=None,
+    tolerance_fraction=DEFAULT_TOLERANCE_FRACTION,
+):
+    """
+    Write the simplified copy of every ``ADM_{n}`` layer of a GeoPackage for
+    a grid resolution.
+
+    The copy is written to a temporary file and moved into place once all
+    layers are done, so the scripts never read a partial copy.
+
+    :param geopackage_path: Path to the GADM GeoPackage
+    :param resolution: Tuple of (x, y) cell size in degrees
+    :param grids: Reference grids as (transform, shape) tuples
+    :param cache_dir: Mask cache directory
+    :param tolerance_fraction: Tolerance as a fraction of the smaller cell
+        edge
+    :return: Path of the simplified GeoPackage
+    """
+    path = simplified_path(
+        geopackage_path, resolution, cache_dir, tolerance_fraction
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp.gpkg"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    layers = [
+        name
+        for name, _ in pyogrio.list_layers(geopackage_path)
+        if name.startswith("ADM_")
+    ]
+    for layer in sorted(layers):
+        gdf = gpd.read_file(geopackage_path, layer=layer).to_crs("EPSG:4326")
+        simplified = simplify_layer(gdf, resolution, grids, tolerance_fraction)
+
+        before = shapely.get_num_coordinates(gdf.geometry.values).sum()
+        after = shapely.get_num_coordinates(simplified.geometry.values).sum()
+        print(f"{layer}: {before} -> {after} vertices")
+
+        simplified.to_file(tmp_path, layer=layer, driver="GPKG")
+
+    os.replace(tmp_path, path)
+    return path
+
+
+def reference_grid(file_path):
+    """
+    Return the (transform, shape) of the grid of a NetCDF or GeoTIFF file.
+    """
+    if file_path.endswith(".nc"):
+        with xr.open_dataset(file_path) as ds:
+            da = ds[list(ds.data_vars)[0]]
+            return da.rio.transform(), (da.rio.height, da.rio.width)
+
+    with rasterio.open(file_path) as src:
+        return src.transform, src.shape
+
+
+def main():
+    """
+    Build the simplified GADM geometries for the grid of a source.
+    """
+    source = input(
+        f"Enter the source ({', '.join(SOURCE_RESOLUTIONS)}): "
+    ).strip()
+    geopackage_file_path = input("Enter the path to the GeoPackage file: ")
+    reference_files = input(
+        "Enter data files of the source to keep the masks identical on "
+        "(comma-separated, empty for none): "
+    )
+
+    grids = [
+        reference_grid(file_path.strip())
+        for file_path in reference_files.split(",")
+        if file_path.strip()
+    ]
+    path = build_simplified(
+        geopackage_file_path, SOURCE_RESOLUTIONS[source], grids
+    )
+    print(f"Wrote simplified GADM geometries to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""
+Monthly and annual summaries of the daily ``geospatial_data_*`` tables.
+
+Daily rows carry, next to their mean, the sufficient statistics it was
+computed from: the weight sum (area of the valid cells), the weighted sum,
+the weighted sum of squares and the valid cell count. Sums of these are
+exact over any period, so the summaries give the area-weighted mean and
+standard deviation of all valid cell-days of a month or year without going
+back to the rasters:
+
+- ``{table}_monthly`` and ``{table}_annual`` hold one row per
+  (gid, admin_level, period start, variable) with the summed statistics,
+  their mean and standard deviation, the min and max of the daily min and
+  max, and the number of days they cover
+- ``geospatial_rollup_pending`` holds the (table, variable, month) of every
+  load that has not been rolled up yet; ``db_loader.copy_upsert`` records
+  it in the transaction of the load
+
+``refresh`` claims the pending months of a table, recomputes their monthly
+rows from the daily table and then the annual rows of their years from the
+monthly table, in one transaction, so only the periods that received new
+data are read. Rows loaded before the statistics columns existed have no
+weight sum and are left out of the sums.
+
+Run this module to add the statistics columns to existing tables, create
+the summary tables and refresh them::
+
+    python Geospatial_Lat_Long/temporal_rollup.py
+"""
+
+from getpass import getpass
+
+import psycopg2
+
+PENDING_TABLE = "geospatial_rollup_pending"
+
+# Daily tables with sufficient statistics
+TABLES = (
+    "geospatial_data_era5",
+    "geospatial_data_gfed",
+    "geospatial_data_gleam",
+    "geospatial_data_merra2",
+    "geospatial_data_nvdi",
+)
+
+STAT_COLUMNS = ("weight_sum", "weighted_sum", "sum_sq", "valid_count")
+
+
+def summary_table(table, period):
+    """
+    Return the name of the ``"monthly"`` or ``"annual"`` summary of a table.
+    """
+    return f"{table}_{period}"
+
+
+def ensure_stat_columns(cursor, table):
+    """
+    Add the statistics columns to a daily table created before they existed.
+
+    The staging table of the loader is dropped, so that it is recreated with
+    the new columns on the next load. Tables that have them are left alone,
+    which includes the views of encoded tables (see ``dimensions``).
+    """
+    cursor.execute(
+        """
+        SELECT count(*)
+        FROM information_schema.columns
+        WHERE table_schema = current_schema()
+            AND table_name = %s AND column_name = ANY(%s)
+        """,
+        (table, list(STAT_COLUMNS)),
+    )
+    if cursor.fetchone()[0] == len(STAT_COLUMNS):
+        return
+
+    cursor.execute(
+        f"""
+        ALTER TABLE {table}
+            ADD COLUMN IF NOT EXISTS weight_sum DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS weighted_sum DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS sum_sq DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS valid_count INTEGER;
+
+        DROP TABLE IF EXISTS {table}_staging;
+        """
+    )
+
+
+def ensure_pending_table(cursor):
+    """
+    Create the table of pending months if it does not exist.
+    """
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {PENDING_TABLE} (
+            table_name TEXT NOT NULL,
+            variable TEXT NOT NULL,
+            month DATE NOT NULL,
+            PRIMARY KEY (table_name, variable, month)
+        )
+        """
+    )
+
+
+def ensure_summary_tables(cursor, table):
+    """
+    Create the monthly and annual summary tables of a daily table.
+    """
+    for period in ("monthly", "annual"):
+        cursor.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {summary_table(table, period)} (
+                gid VARCHAR(15) NOT NULL,
+                admin_level INTEGER NOT NULL,
+                date DATE NOT NULL,
+                variable TEXT NOT NULL,
+                mean DOUBLE PRECISION,
+                std DOUBLE PRECISION,
+                min DOUBLE PRECISION,
+                max DOUBLE PRECISION,
+                weight_sum DOUBLE PRECISION,
+                weighted_sum DOUBLE PRECISION,
+                sum_sq DOUBLE PRECISION,
+                valid_count BIGINT,
+                day_count INTEGER,
+                source TEXT,
+                unit TEXT,
+                PRIMARY KEY (gid, admin_level, date, variable)
+            )
+            """
+        )
+
+
+def mark_pending(cursor, table, staging):
+    """
+    Record the months of the rows in a staging table as pending, without
+    committing.
+
+    :param cursor: psycopg2 cursor of the load transaction
+    :param table: Daily table the rows are loaded into
+    :param staging: Staging table holding the rows
+    """
+    ensure_pending_table(cursor)
+    cursor.execute(
+        f"""
+        INSERT INTO {PENDING_TABLE} (table_name, variable, month)
+        SELECT DISTINCT %s, variable, date_trunc('month', date)::date
+        FROM {staging}
+        ON CONFLICT DO NOTHING
+        """,
+        (table,),
+    )
+
+
+def mark_all_pending(cursor, table):
+    """
+    Mark every month of a daily table as pending, e.g. after adding the
+    statistics columns and reloading.
+    """
+    ensure_pending_table(cursor)
+    cursor.execute(
+        f"""
+        INSERT INTO {PENDING_TABLE} (table_name, variable, month)
+        SELECT DISTINCT %s, variable, date_trunc('month', date)::date
+        FROM {table}
+        ON CONFLICT DO NOTHING
+        """,
+        (table,),
+    )
+
+
+# Mean and standard deviation of the summed statistics of a period
+SUMMARY_SELECT = """
+    sum(weighted_sum) / nullif(sum(weight_sum), 0),
+    sqrt(greatest(
+        sum(sum_sq) / nullif(sum(weight_sum), 0)
+        - (sum(weighted_sum) / nullif(sum(weight_sum), 0)) ^ 2,
+        0
+    )),
+    min(min)::double precision,
+    max(max)::double precision,
+    sum(weight_sum),
+    sum(weighted_sum),
+    sum(sum_sq),
+    sum(valid_count)"""
+
+SUMMARY_UPDATE = """
+    mean = EXCLUDED.mean,
+    std = EXCLUDED.std,
+    min = EXCLUDED.min,
+    max = EXCLUDED.max,
+    weight_sum = EXCLUDED.weight_sum,
+    weighted_sum = EXCLUDED.weighted_sum,
+    sum_sq = EXCLUDED.sum_sq,
+    valid_count = EXCLUDED.valid_count,
+    day_count = EXCLUDED.day_count,
+    source = EXCLUDED.source,
+    unit = EXCLUDED.unit"""
+
+
+def refresh(conn, table):
+    """
+    Recompute the monthly and annual rows of the pending months of a table.
+
+    :param conn: psycopg2 connection
+    :param table: Daily table
+    :return: Tuple of (months claimed, monthly rows, annual rows)
+    """
+    monthly = summary_table(table, "monthly")
+    annual = summary_table(table, "annual")
+
+    with conn.cursor() as cursor:
+        ensure_pending_table(cursor)
+        ensure_summary_tables(cursor, table)
+
+        # Months loaded while the refresh runs stay pending for the next one
+        cursor.execute(
+            f"""
+            CREATE TEMPORARY TABLE rollup_claimed ON COMMIT DROP AS
+            SELECT variable, month FROM {PENDING_TABLE} WITH NO DATA;
+
+            WITH claimed AS (
+                DELETE FROM {PENDING_TABLE}
+                WHERE table_name = %s
+                RETURNING variable, month
+            )
+            INSERT INTO rollup_claimed SELECT variable, month FROM claimed;
+            """,
+            (table,),
+        )
+        cursor.execute("SELECT count(*) FROM rollup_claimed")
+        (claimed,) = cursor.fetchone()
+        if not claimed:
+            conn.commit()
+            return 0, 0, 0
+
+        cursor.execute(
+            f"""
+            INSERT INTO {monthly} (
+                gid, admin_level, date, variable,
+                mean, std, min, max,
+                weight_sum, weighted_sum, sum_sq, valid_count,
+                day_count, source, unit
+            )
+            SELECT
+                d.gid, d.admin_level, c.month, d.variable,
+                {SUMMARY_SELECT},
+                count(d.weight_sum), max(d.source), max(d.unit)
+            FROM rollup_claimed c
+            JOIN {table} d
+                ON d.variable = c.variable
+                AND d.date >= c.month
+                AND d.date < c.month + interval '1 month'
+            WHERE d.weight_sum IS NOT NULL
+            GROUP BY d.gid, d.admin_level, c.month, d.variable
+            ON CONFLICT (gid, admin_level, date, variable) DO UPDATE SET
+            {SUMMARY_UPDATE}
+            """
+        )
+        monthly_rows = cursor.rowcount
+
+        cursor.execute(
+            f"""
+            INSERT INTO {annual} (
+                gid, admin_level, date, variable,
+                mean, std, min, max,
+                weight_sum, weighted_sum, sum_sq, valid_count,
+                day_count, source, unit
+            )
+            SELECT
+                m.gid, m.admin_level, y.year, m.variable,
+                {SUMMARY_SELECT},
+                sum(m.day_count), max(m.source), max(m.unit)
+            FROM (
+                SELECT DISTINCT variable, date_trunc('year', month)::date AS year
+                FROM rollup_claimed
+            ) y
+            JOIN {monthly} m
+                ON m.variable = y.variable
+                AND m.date >= y.year
+                AND m.date < y.year + interval '1 year'
+            GROUP BY m.gid, m.admin_level, y.year, m.variable
+            ON CONFLICT (gid, admin_level, date, variable) DO UPDATE SET
+            {SUMMARY_UPDATE}
+            """
+        )
+        annual_rows = cursor.rowcount
+    conn.commit()
+
+    return claimed, monthly_rows, annual_rows
+
+
+def main():
+    """
+    Add the statistics columns to the daily tables and refresh their
+    summaries.
+    """
+    conn = psycopg2.connect(
+        dbname="merge",
+        user="postgres",
+        password=getpass("Enter the database password: "),
+        host=input("Enter the database host: "),
+        port="5432",
+    )
+    rebuild = (
+        input("Rebuild the summaries of all months? [y/N]: ").strip().lower()
+        == "y"
+    )
+
+    try:
+        for table in TABLES:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT to_regclass(%s)", (table,))
+                if cursor.fetchone()[0] is None:
+                    print(f"Skipping {table}, which does not exist")
+                    conn.rollback()
+                    continue
+                ensure_stat_columns(cursor, table)
+                if rebuild:
+                    mark_all_pending(cursor, table)
+            conn.commit()
+
+            claimed, monthly_rows, annual_rows = refresh(conn, table)
+            print(
+                f"{table}: {claimed} pending months, {monthly_rows} monthly "
+                f"and {annual_rows} annual rows refreshed"
+            )
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+"""
+Tiled, out-of-core zonal statistics for large GeoTIFFs.
+
+Global 100 m WorldPop rasters do not fit in memory, and neither does a
+full-raster cell area grid. The engine in this module walks the raster in
+square tiles with windowed reads. A tile -> polygon index built from the
+polygon bounding boxes tells which polygons to rasterize inside each tile,
+and every polygon accumulates sum, area-weighted sum, area, min, max, valid
+and touched cell counts over the tiles it overlaps. Memory is bounded by the
+tile size and the number of polygons, not by the raster size. Several bands
+(the time steps of a NetCDF variable) can be reduced in the same pass, so
+each polygon is rasterized once per tile instead of once per band.
+
+Tiles can be spread over a worker pool; each task returns partial
+accumulators that are merged in the parent.
+"""
+
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import rasterio
+import shapely
+from rasterio import features, windows
+from rasterio.crs import CRS
+from tqdm import tqdm
+
+from Geospatial_Lat_Long.cell_area import CELL_AREA_DTYPE, latitude_areas
+from Geospatial_Lat_Long.mask_cache import geometry_window
+
+DEFAULT_TILE_SIZE = 2048
+
+
+def empty_accumulators(n_polygons, n_bands=1):
+    """
+    Return zeroed accumulators for ``n_polygons`` polygons, with one row per
+    band.
+    """
+    shape = (n_bands, n_polygons)
+    acc = {
+        name: np.zeros(shape) for name in ("sum", "weighted_sum", "weight_sum")
+    }
+    acc["min"] = np.full(shape, np.inf)
+    acc["max"] = np.full(shape, -np.inf)
+    acc["valid_count"] = np.zeros(shape, dtype=np.int64)
+    acc["cell_count"] = np.zeros(shape, dtype=np.int64)
+    return acc
+
+
+def merge_accumulators(total, part):
+    """
+    Merge the partial accumulators ``part`` into ``total`` in place.
+    """
+    for name in (
+        "sum",
+        "weighted_sum",
+        "weight_sum",
+        "valid_count",
+        "cell_count",
+    ):
+        total[name] += part[name]
+    np.minimum(total["min"], part["min"], out=total["min"])
+    np.maximum(total["max"], part["max"], out=total["max"])
+    return total
+
+
+def build_tile_index(geometries, transform, shape, tile_size):
+    """
+    Map every tile to the polygons whose bounding box overlaps it.
+
+    :param geometries: Sequence of Shapely geometries in the raster CRS
+    :param transform: Affine transform of the raster
+    :param shape: Tuple of (height, width) of the raster
+    :param tile_size: Tile edge length in cells
+    :return: Dictionary of (tile_row, tile_col) -> list of polygon positions
+    """
+    index = {}
+    for position, geometry in enumerate(geometries):
+        if geometry is None or geometry.is_empty:
+            continue
+        row_start, row_stop, col_start, col_stop = geometry_window(
+            geometry, transform, shape
+        )
+        if row_start >= row_stop or col_start >= col_stop:
+            continue
+        for tile_row in range(
+            row_start // tile_size, (row_stop - 1) // tile_size + 1
+        ):
+            for tile_col in range(
+                col_start // tile_size, (col_stop - 1) // tile_size + 1
+            ):
+                index.setdefault((tile_row, tile_col), []).append(position)
+    return index
+
+
+def row_cell_areas(transform, crs, row_start, row_stop):
+    """
+    Return the area in square meters of the cells of rows
+    ``row_start:row_stop``, one value per row.
+
+    Only the rows of the current tile are computed, the cell area is never
+    materialized for the full raster.
+    """
+    res_x, res_y = abs(transform.a), abs(transform.e)
+    n_rows = row_stop - row_start
+    if crs is None or not crs.is_geographic:
+        return np.full(n_rows, res_x * res_y, dtype=CELL_AREA_DTYPE)
+
+    rows = np.arange(row_start, row_stop) + 0.5
+    return latitude_areas(transform.f + rows * transform.e, res_x, res_y)
+
+
+def accumulate_tiles(
+    tiles,
+    geometries,
+    path,
+    n_polygons,
+    tile_size,
+    all_touched=True,
+    bands=(1,),
+    crs=None,
+):
+    """
+    Accumulate the statistics of the polygons over a list of tiles.
+
+    :param tiles: List of ((tile_row, tile_col), polygon positions)
+    :param geometries: Dictionary of polygon position -> Shapely geometry
+    :param path: Path to the raster
+    :param n_polygons: Number of polygons of the level
+    :param tile_size: Tile edge length in cells
+    :param all_touched: Include every cell touched by a polygon
+    :param bands: Band indexes (1-based) to reduce
+    :param crs: CRS of the raster, if the file does not record one
+    :return: Accumulators (see ``empty_accumulators``)
+    """
+    bands = list(bands)
+    acc = empty_accumulators(n_polygons, len(bands))
+
+    with rasterio.open(path) as src:
+        transform, shape = src.transform, (src.height, src.width)
+        crs = src.crs or (CRS.from_user_input(crs) if crs else None)
+        for (tile_row, tile_col), positions in tiles:
+            row_off, col_off = tile_row * tile_size, tile_col * tile_size
+            tile = windows.Window(
+                col_off,
+                row_off,
+                min(tile_size, src.width - col_off),
+                min(tile_size, src.height - row_off),
+            )
+            data = src.read(bands, window=tile, masked=True)
+            valid = ~np.ma.getmaskarray(data)
+            values = np.ma.getdata(data).astype(np.float64)
+            valid &= np.isfinite(values)
+
+            areas = row_cell_areas(
+                transform, crs, row_off, row_off + tile.height
+            )
+
+            for position in positions:
+                geometry = geometries[position]
+                row_start, row_stop, col_start, col_stop = geometry_window(
+                    geometry, transform, shape
+                )
+                # Polygon window relative to the tile
+                r0 = max(row_start - row_off, 0)
+                r1 = min(row_stop - row_off, tile.height)
+                c0 = max(col_start - col_off, 0)
+                c1 = min(col_stop - col_off, tile.width)
+                if r0 >= r1 or c0 >= c1:
+                    continue
+
+                sub_window = windows.Window(
+                    col_off + c0, row_off + r0, c1 - c0, r1 - r0
+                )
+                sub_transform = windows.transform(sub_window, transform)
+
+                # Clip large polygons to the window (padded by one cell, so
+                # all_touched edges stay the same) before rasterizing
+                left, top = sub_transform * (-1, -1)
+                right, bottom = sub_transform * (c1 - c0 + 1, r1 - r0 + 1)
+                clipped = shapely.clip_by_rect(
+                    geometry,
+                    min(left, right),
+                    min(top, bottom),
+                    max(left, right),
+                    max(top, bottom),
+                )
+                if clipped.is_empty:
+                    continue
+
+                inside = features.geometry_mask(
+                    [clipped],
+                    out_shape=(r1 - r0, c1 - c0),
+                    transform=sub_transform,
+                    all_touched=all_touched,
+                    invert=True,
+                )
+                n_cells = int(inside.sum())
+                if n_cells == 0:
+                    continue
+                acc["cell_count"][:, position] += n_cells
+
+                # The polygon mask is shared by all bands
+                for b in range(len(bands)):
+                    cells = inside & valid[b, r0:r1, c0:c1]
+                    if not cells.any():
+                        continue
+
+                    cell_rows, cell_cols = np.nonzero(cells)
+                    cell_values = values[b, r0:r1, c0:c1][cell_rows, cell_cols]
+                    cell_areas = areas[r0:r1][cell_rows]
+
+                    acc["sum"][b, position] += cell_values.sum()
+                    acc["weighted_sum"][b, position] += (
+                        cell_values * cell_areas
+                    ).sum()
+                    acc["weight_sum"][b, position] += cell_areas.sum()
+                    acc["valid_count"][b, position] += cell_values.size
+                    acc["min"][b, position] = min(
+                        acc["min"][b, position], cell_values.min()
+                    )
+                    acc["max"][b, position] = max(
+                        acc["max"][b, position], cell_values.max()
+                    )
+
+    return acc
+
+
+def finalize_accumulators(acc):
+    """
+    Turn accumulators into statistics.
+
+    :return: Tuple of (sum, mean, min, max, missing_value_percentage) arrays;
+        sum, mean, min and max are NaN for polygons without valid cells
+    """
+    has_data = acc["valid_count"] > 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(
+            acc["weight_sum"] > 0,
+            acc["weighted_sum"] / acc["weight_sum"],
+            np.nan,
+        )
+        missing = np.where(
+            acc["cell_count"] > 0,
+            100.0 * (1.0 - acc["valid_count"] / acc["cell_count"]),
+            100.0,
+        )
+    return (
+        np.where(has_data, acc["sum"], np.nan),
+        np.where(has_data, mean, np.nan),
+        np.where(has_data, acc["min"], np.nan),
+        np.where(has_data, acc["max"], np.nan),
+        missing,
+    )
+
+
+def zonal_stats_tiled(
+    path,
+    geometries,
+    tile_size=DEFAULT_TILE_SIZE,
+    processes=1,
+    all_touched=True,
+    desc=None,
+    band=1,
+    crs=None,
+):
+    """
+    Compute zonal statistics of a raster tile by tile.
+
+    :param path: Path to the raster, or a GDAL dataset name such as
+        ``netcdf:"file.nc":variable``
+    :param geometries: Sequence of Shapely geometries in the raster CRS
+    :param tile_size: Tile edge length in cells
+    :param processes: Number of worker processes (1 runs in this process)
+    :param all_touched: Include every cell touched by a polygon
+    :param desc: Progress bar description
+    :param band: Band index (1-based), or a list of band indexes reduced in
+        the same pass
+    :param crs: CRS of the raster, if the file does not record one (cell
+        areas are only latitude dependent for a geographic CRS)
+    :return: Tuple of (sum, mean, min, max, missing_value_percentage) arrays,
+        one value per polygon, or one row per band if ``band`` is a list
+    """
+    geometries = list(geometries)
+    n_polygons = len(geometries)
+    bands = [band] if np.isscalar(band) else list(band)
+
+    with rasterio.open(path) as src:
+        transform, shape = src.transform, (src.height, src.width)
+    tile_index = sorted(
+        build_tile_index(geometries, transform, shape, tile_size).items()
+    )
+
+    # A few tasks per worker, each carrying only the geometries it needs
+    n_tasks = max(1, min(len(tile_index), processes * 4))
+    tasks = [tile_index[i::n_tasks] for i in range(n_tasks)]
+    task_geometries = [
+        {
+            position: geometries[position]
+            for _, positions in task
+            for position in positions
+        }
+        for task in tasks
+    ]
+
+    accumulate = partial(
+        _accumulate_task,
+        path=path,
+        n_polygons=n_polygons,
+        tile_size=tile_size,
+        all_touched=all_touched,
+        bands=bands,
+        crs=crs,
+    )
+
+    total = empty_accumulators(n_polygons, len(bands))
+    if processes > 1:
+        with Pool(processes=processes) as pool:
+            for part in tqdm(
+                pool.imap_unordered(accumulate, zip(tasks, task_geometries)),
+                total=len(tasks),
+                desc=desc,
+            ):
+                merge_accumulators(total, part)
+    else:
+        for task in tqdm(
+            zip(tasks, task_geometries), total=len(tasks), desc=desc
+        ):
+            merge_accumulators(total, accumulate(task))
+
+    stats = finalize_accumulators(total)
+    if np.isscalar(band):
+        return tuple(values[0] for values in stats)
+    return stats
+
+
+def _accumulate_task(
+    task, path, n_polygons, tile_size, all_touched, bands, crs
+):
+    tiles, geometries = task
+    return accumulate_tiles(
+        tiles,
+        geometries,
+        path,
+        n_polygons,
+        tile_size,
+        all_touched,
+        bands,
+        crs,
+    )
@@ -0,0 +1,503 @@
+"""
+Sparse polygon-to-cell weight matrices for zonal statistics.
+
+The all_touched scripts clip every GADM polygon against every file, although
+the grid and the polygons never change between daily files. The helpers in
+this module turn the cached rasterization of a GADM level (``mask_cache``)
+into a sparse matrix ``W`` (polygon x cell) holding ``cell_area * coverage``
+and compute mean, min, max and missing value percentage for all polygons
+and all timesteps with one sparse-dense product over the ``(time, lat * lon)``
+array.
+
+The products give mergeable sufficient statistics (weighted sum, weight sum,
+weighted sum of squares, valid and touched cell counts, min and max). They
+are stored next to the means, so monthly and annual aggregates can be
+computed exactly in SQL (``temporal_rollup``). A coarser GADM level can also
+be derived from a finer one through the GID hierarchy instead of being
+computed, and its files read, again: ``get_level_weights`` builds the
+roll-ups and ``level_zonal_stats`` yields the statistics of every level from
+one pass over the finest one.
+"""
+
+from itertools import repeat
+
+import geopandas as gpd
+import numpy as np
+from scipy import sparse
+
+from Geospatial_Lat_Long.mask_cache import (
+    build_coverage_matrix,
+    get_coverage_matrix,
+    rasterize_geometry,
+)
+
+# Rows per batch handed to the database writer
+DEFAULT_BATCH_ROWS = 100000
+
+
+def get_weight_matrix(
+    gdf, gid_column, da, cell_area, cache_dir, geopackage_path, level
+):
+    """
+    Build the weight matrix for a GADM level on the grid of ``da`` from the
+    cached all_touched coverage matrix.
+
+    :param gdf: GeoDataFrame with the level's geometries in the grid CRS
+    :param gid_column: Name of the GID column
+    :param da: xarray DataArray with spatial dims and CRS set via rioxarray
+    :param cell_area: Array of cell areas, one per row or broadcastable to
+        the grid shape
+    :param cache_dir: Mask cache directory
+    :param geopackage_path: Path to the GADM GeoPackage
+    :param level: Administrative level
+    :return: Tuple of (CSR weight matrix, array of polygon ids)
+    """
+    shape = (da.rio.height, da.rio.width)
+    coverage, gids = get_coverage_matrix(
+        gdf,
+        gid_column,
+        da.rio.transform(),
+        shape,
+        da.rio.crs,
+        geopackage_path,
+        level,
+        cache_dir,
+    )
+
+    return area_weights(coverage, cell_area, shape), gids
+
+
+def area_weights(coverage, cell_area, shape):
+    """
+    Multiply a coverage matrix by the area of its cells.
+
+    :param coverage: CSR coverage matrix of shape (n_polygons, n_cells)
+    :param cell_area: Array of cell areas, one per row or broadcastable to
+        the grid shape
+    :param shape: Tuple of (height, width) of the grid
+    :return: CSR weight matrix
+    """
+    cell_area = np.asarray(cell_area, dtype=np.float64)
+    weights = coverage.copy()
+    if cell_area.ndim == 1:
+        # One area per row: the row of a cell is its flat index // width
+        weights.data *= cell_area[weights.indices // shape[1]]
+    else:
+        cell_area = np.broadcast_to(cell_area, shape)
+        weights.data *= cell_area.ravel()[weights.indices]
+    return weights
+
+
+def grid_values(da):
+    """
+    Return the values of ``da`` as a (time, lat * lon) array in grid order.
+    """
+    da = da.transpose("time", da.rio.y_dim, da.rio.x_dim)
+    return da.values.reshape(da.sizes["time"], -1)
+
+
+def weighted_zonal_stats(weights, values, time_chunk=32):
+    """
+    Compute area-weighted statistics for all polygons and timesteps.
+
+    The mean is ``W @ x / W @ valid`` so that missing cells drop out of both
+    the numerator and the denominator, which matches the per-polygon
+    ``cell_area.where(clipped.notnull())`` weighting. Min and max are taken
+    over the touched cells of each polygon with NaN-skipping reductions.
+    The missing value percentage is the share of touched cells that are NaN
+    at each timestep.
+
+    :param weights: CSR weight matrix of shape (n_polygons, n_cells)
+    :param values: Array of shape (n_time, n_cells)
+    :param time_chunk: Number of timesteps processed per matrix product
+    :return: Tuple of (mean, min, max, missing_value_percentage, weight_sum,
+        weighted_sum, sum_sq, valid_count) arrays, each of shape
+        (n_polygons, n_time)
+    """
+    return finalize_stats(sufficient_stats(weights, values, time_chunk))
+
+
+def sufficient_stats(weights, values, time_chunk=32):
+    """
+    Compute the mergeable statistics of all polygons and timesteps.
+
+    :param weights: CSR weight matrix of shape (n_polygons, n_cells)
+    :param values: Array of shape (n_time, n_cells)
+    :param time_chunk: Number of timesteps processed per matrix product
+    :return: Dictionary of ``weighted_sum``, ``weight_sum``, ``sum_sq``
+        (weighted sum of squares), ``valid_count``, ``min`` and ``max``
+        arrays of shape (n_polygons, n_time), and ``cell_count``, the number
+        of touched cells of each polygon
+    """
+    n_polygons = weights.shape[0]
+    n_time = values.shape[0]
+
+    touched = weights.copy()
+    touched.data[:] = 1.0
+
+    nonempty = np.diff(weights.indptr) > 0
+    starts = weights.indptr[:-1][nonempty]
+
+    stats = {
+        "weighted_sum": np.zeros((n_polygons, n_time)),
+        "weight_sum": np.zeros((n_polygons, n_time)),
+        "sum_sq": np.zeros((n_polygons, n_time)),
+        "valid_count": np.zeros((n_polygons, n_time)),
+        "cell_count": np.asarray(touched.sum(axis=1)).ravel(),
+        "min": np.full((n_polygons, n_time), np.nan),
+        "max": np.full((n_polygons, n_time), np.nan),
+    }
+
+    for t0 in range(0, n_time, time_chunk):
+        block = np.asarray(values[t0 : t0 + time_chunk], dtype=np.float64)
+        window = slice(t0, t0 + block.shape[0])
+
+        valid = ~np.isnan(block)
+        filled = np.where(valid, block, 0.0)
+
+        stats["weighted_sum"][:, window] = weights @ filled.T
+        stats["weight_sum"][:, window] = weights @ valid.T.astype(np.float64)
+        stats["sum_sq"][:, window] = weights @ (filled * filled).T
+        stats["valid_count"][:, window] = touched @ valid.T.astype(np.float64)
+
+        if starts.size:
+            gathered = block[:, weights.indices]
+            stats["min"][nonempty, window] = np.fmin.reduceat(
+                gathered, starts, axis=1
+            ).T
+            stats["max"][nonempty, window] = np.fmax.reduceat(
+                gathered, starts, axis=1
+            ).T
+
+    return stats
+
+
+def finalize_stats(stats):
+    """
+    Turn sufficient statistics into mean, min, max and missing value
+    percentage, followed by the sums they are computed from.
+
+    :param stats: Dictionary returned by ``sufficient_stats``
+    :return: Tuple of (mean, min, max, missing_value_percentage, weight_sum,
+        weighted_sum, sum_sq, valid_count) arrays
+    """
+    weight_sum = stats["weight_sum"]
+    cell_count = stats["cell_count"]
+    nonempty = cell_count > 0
+
+    missing = np.full(weight_sum.shape, 100.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(
+            weight_sum > 0, stats["weighted_sum"] / weight_sum, np.nan
+        )
+        missing[nonempty] = 100.0 * (
+            1.0 - stats["valid_count"][nonempty] / cell_count[nonempty, None]
+        )
+
+    return (
+        mean,
+        stats["min"],
+        stats["max"],
+        missing,
+        weight_sum,
+        stats["weighted_sum"],
+        stats["sum_sq"],
+        stats["valid_count"],
+    )
+
+
+def rollup_matrices(weights, parent_gids):
+    """
+    Build the matrices that derive the statistics of a coarser level from
+    those of a finer one.
+
+    Sibling polygons share the cells their common boundary touches, so the
+    sum of their statistics counts these cells more than once. A cell
+    touched by ``m`` siblings is subtracted ``m - 1`` times, through sparse
+    overlap matrices over the shared cells only, which makes the result
+    equal to the all_touched statistics of the parent polygon.
+
+    :param weights: CSR all_touched weight matrix of the finer level
+    :param parent_gids: Parent GID of every polygon of the finer level
+    :return: Dictionary with the parent ``gids``, the ``aggregation`` matrix
+        (parent x polygon), the ``overlap_weights`` and ``overlap_counts``
+        matrices over the shared ``overlap_cells``, and the ``order`` and
+        ``starts`` of the polygons grouped by parent
+    """
+    n_polygons = weights.shape[0]
+    gids, parent_index = np.unique(
+        np.asarray(parent_gids, dtype=str), return_inverse=True
+    )
+    aggregation = sparse.csr_matrix(
+        (np.ones(n_polygons), (parent_index, np.arange(n_polygons))),
+        shape=(gids.size, n_polygons),
+    )
+
+    touched = weights.copy()
+    touched.data[:] = 1.0
+    multiplicity = (aggregation @ touched).tocsr()
+    summed = (aggregation @ weights).tocsr()
+
+    # Cells touched by several siblings, counted m - 1 times
+    overlap_counts = (multiplicity - multiplicity.sign()).tocsr()
+    overlap_weights = (
+        summed - summed.multiply(multiplicity.power(-1))
+    ).tocsr()
+    overlap_counts.eliminate_zeros()
+    overlap_weights.eliminate_zeros()
+
+    overlap_cells = np.unique(overlap_counts.indices)
+    order = np.argsort(parent_index, kind="stable")
+
+    return {
+        "gids": gids,
+        "aggregation": aggregation,
+        "overlap_cells": overlap_cells,
+        "overlap_weights": overlap_weights[:, overlap_cells],
+        "overlap_counts": overlap_counts[:, overlap_cells],
+        "order": order,
+        "starts": np.searchsorted(parent_index[order], np.arange(gids.size)),
+    }
+
+
+def rollup_stats(stats, rollup, values):
+    """
+    Derive the sufficient statistics of the parent level.
+
+    :param stats: Sufficient statistics of the finer level
+    :param rollup: Dictionary returned by ``rollup_matrices``
+    :param values: Array of shape (n_time, n_cells) the statistics were
+        computed from; only the shared cells are read
+    :return: Sufficient statistics of the parent level
+    """
+    aggregation = rollup["aggregation"]
+    parent = {
+        name: aggregation @ stats[name]
+        for name in (
+            "weighted_sum",
+            "weight_sum",
+            "sum_sq",
+            "valid_count",
+            "cell_count",
+        )
+    }
+
+    if rollup["overlap_cells"].size:
+        block = np.asarray(
+            values[:, rollup["overlap_cells"]], dtype=np.float64
+        )
+        valid = ~np.isnan(block)
+        filled = np.where(valid, block, 0.0)
+        valid = valid.astype(np.float64)
+
+        overlap_weights = rollup["overlap_weights"]
+        overlap_counts = rollup["overlap_counts"]
+        parent["weighted_sum"] -= overlap_weights @ filled.T
+        parent["weight_sum"] -= overlap_weights @ valid.T
+        parent["sum_sq"] -= overlap_weights @ (filled * filled).T
+        parent["valid_count"] -= overlap_counts @ valid.T
+        parent["cell_count"] -= np.asarray(overlap_counts.sum(axis=1)).ravel()
+
+    # The extremes of a union are the extremes of its parts
+    order, starts = rollup["order"], rollup["starts"]
+    parent["min"] = np.fmin.reduceat(stats["min"][order], starts, axis=0)
+    parent["max"] = np.fmax.reduceat(stats["max"][order], starts, axis=0)
+    return parent
+
+
+def get_level_weights(
+    gdf,
+    gid_column,
+    da,
+    cell_area,
+    cache_dir,
+    geopackage_path,
+    level,
+    output_levels=None,
+    plans=None,
+):
+    """
+    Build the weight matrix of a GADM level and the roll-ups that derive
+    coarser ``output_levels`` from it.
+
+    Parent units without polygons at ``level`` (e.g. countries without
+    level 2 subdivisions) are rasterized on their own and computed directly.
+    Building a plan reads the parent layers and rasterizes these units, so
+    callers pass a ``plans`` dict kept across their files to build it once
+    per grid.
+
+    :param gdf: GeoDataFrame with the level's geometries in the grid CRS and
+        the ``GID_{n}`` columns of the output levels
+    :param output_levels: Levels to compute, ``level`` and coarser ones;
+        defaults to ``[level]``
+    :param plans: Dictionary of plans already built, keyed by grid and
+        levels; the plan is looked up in and added to it
+    :return: Dictionary with the ``weights`` and ``gids`` of ``level`` and
+        the ``outputs``, a list of (output level, roll-up or None, direct
+        weights and gids or None)
+    """
+    output_levels = output_levels or [level]
+    key = (
+        tuple(da.rio.transform()),
+        (da.rio.height, da.rio.width),
+        str(da.rio.crs),
+        level,
+        tuple(output_levels),
+    )
+    if plans is not None and key in plans:
+        return plans[key]
+
+    weights, gids = get_weight_matrix(
+        gdf, gid_column, da, cell_area, cache_dir, geopackage_path, level
+    )
+    plan = {"weights": weights, "gids": gids, "outputs": []}
+
+    for output_level in output_levels:
+        if output_level == level:
+            plan["outputs"].append((output_level, None, None))
+            continue
+        if output_level > level:
+            raise ValueError(
+                f"Level {output_level} cannot be derived from level {level}"
+            )
+
+        parent_column = f"GID_{output_level}"
+        rollup = rollup_matrices(weights, gdf[parent_column])
+
+        parent_gdf = gpd.read_file(
+            geopackage_path, layer=f"ADM_{output_level}"
+        ).to_crs(da.rio.crs)
+        unmatched = ~parent_gdf[parent_column].isin(rollup["gids"]).values
+
+        direct = None
+        if unmatched.any():
+            shape = (da.rio.height, da.rio.width)
+            coverage = build_coverage_matrix(
+                parent_gdf.geometry.values[unmatched],
+                da.rio.transform(),
+                shape,
+                rasterize_geometry,
+            )
+            direct = (
+                area_weights(coverage, cell_area, shape),
+                parent_gdf[parent_column].to_numpy(dtype=str)[unmatched],
+            )
+        plan["outputs"].append((output_level, rollup, direct))
+
+    if plans is not None:
+        plans[key] = plan
+    return plan
+
+
+def level_zonal_stats(plan, values, time_chunk=32):
+    """
+    Compute the statistics of every output level of a plan from one pass
+    over the values.
+
+    :param plan: Dictionary returned by ``get_level_weights``
+    :param values: Array of shape (n_time, n_cells)
+    :param time_chunk: Number of timesteps processed per matrix product
+    :return: Iterator of (level, gids, statistics) with the statistics of
+        ``finalize_stats``
+    """
+    stats = sufficient_stats(plan["weights"], values, time_chunk)
+
+    for output_level, rollup, direct in plan["outputs"]:
+        if rollup is None:
+            yield output_level, plan["gids"], finalize_stats(stats)
+            continue
+
+        gids = rollup["gids"]
+        level_stats = finalize_stats(rollup_stats(stats, rollup, values))
+        if direct is not None:
+            direct_weights, direct_gids = direct
+            gids = np.concatenate([gids, direct_gids])
+            level_stats = tuple(
+                np.concatenate([rolled, computed])
+                for rolled, computed in zip(
+                    level_stats,
+                    weighted_zonal_stats(direct_weights, values, time_chunk),
+                )
+            )
+        yield output_level, gids, level_stats
+
+
+def stats_to_rows(gids, level, dates, variable_name, stats, source, unit):
+    """
+    Turn the (n_polygons, n_time) statistic arrays into database rows.
+
+    The columns are assembled as whole arrays and zipped into tuples, so the
+    cost per row is a tuple allocation rather than per-element indexing.
+
+    :return: List of tuples matching the ``geospatial_data_*`` insert order
+    """
+    (
+        mean,
+        minimum,
+        maximum,
+        missing,
+        weight_sum,
+        weighted_sum,
+        sum_sq,
+        valid_count,
+    ) = stats
+    n_polygons = len(gids)
+    dates_py = np.asarray(dates).astype("M8[ms]").astype("O").tolist()
+
+    valid = ~np.isnan(mean)
+    mean_col = np.where(valid, mean, None).ravel().tolist()
+    min_col = np.where(valid, minimum, None).ravel().tolist()
+    max_col = np.where(valid, maximum, None).ravel().tolist()
+    missing_col = np.where(valid, np.round(missing, 2), 100.0).ravel().tolist()
+    gid_col = np.repeat(np.asarray(gids, dtype=object), len(dates_py)).tolist()
+    weight_sum_col = weight_sum.ravel().tolist()
+    weighted_sum_col = weighted_sum.ravel().tolist()
+    sum_sq_col = sum_sq.ravel().tolist()
+    valid_count_col = np.rint(valid_count).astype(np.int64).ravel().tolist()
+
+    return list(
+        zip(
+            gid_col,
+            repeat(level),
+            dates_py * n_polygons,
+            repeat(variable_name),
+            mean_col,
+            min_col,
+            max_col,
+            missing_col,
+            repeat(source),
+            repeat(unit),
+            weight_sum_col,
+            weighted_sum_col,
+            sum_sq_col,
+            valid_count_col,
+        )
+    )
+
+
+def stats_row_batches(
+    gids,
+    level,
+    dates,
+    variable_name,
+    stats,
+    source,
+    unit,
+    batch_rows=DEFAULT_BATCH_ROWS,
+):
+    """
+    Yield the rows of ``stats_to_rows`` in batches of whole polygons with
+    about ``batch_rows`` rows each, so that only one batch of tuples exists
+    at a time.
+    """
+    step = max(1, batch_rows // max(len(dates), 1))
+    for start in range(0, len(gids), step):
+        yield stats_to_rows(
+            gids[start : start + step],
+            level,
+            dates,
+            variable_name,
+            tuple(stat[start : start + step] for stat in stats),
+            source,
+            unit,
+        )
@@ -0,0 +1,340 @@
+"""
+Time-chunked Zarr stores of the daily gridded inputs.
+
+The zonal scripts used to open every daily NetCDF file (one per year, per
+month or per variable) once per level and per variable, and read whole
+global fields from it. This conversion stage appends the files of a source
+into one consolidated Zarr store per variable, chunked in spatial tiles and
+long time chunks:
+
+- a polygon window across many years is read with a handful of chunk reads
+  instead of one file open per period
+- the weight matrix path walks a store one time chunk at a time
+
+Stores are named ``{source}_{variable}.zarr`` and live in ``ZONAL_ZARR_DIR``
+or a ``zarr`` folder of the data directory. The zonal scripts read the store
+of a variable when it exists and fall back to the NetCDF files otherwise.
+They process a store one time chunk at a time (``store_windows``), each
+chunk with its own processing ledger entry, so appending new days only
+processes the chunks they were written to.
+
+Run this module to convert (or extend) the stores of a source::
+
+    python Geospatial_Lat_Long/zarr_store.py
+"""
+
+import glob
+import os
+import sys
+
+import numpy as np
+import xarray as xr
+from tqdm import tqdm
+
+project_root = os.environ.get(
+    "PROJECT_ROOT",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..")),
+)
+sys.path.append(project_root)
+
+from Geospatial_Lat_Long.ledger import window_checksum  # noqa: E402
+
+DEFAULT_TIME_CHUNK = 365
+DEFAULT_SPATIAL_CHUNK = 128
+
+# File pattern and spatial dims of the daily files of each source, and the
+# variables processed by its zonal script (variable code -> file name part)
+SOURCES = {
+    "ERA5": {
+        "pattern": "*_{variable}_daily_aggregated*.nc",
+        "x_dim": "longitude",
+        "y_dim": "latitude",
+        "variables": {
+            "tp": "total_precipitation",
+            "e": "evaporation",
+            "t2m": "2m_temperature",
+            "mx2t": "maximum_2m_temperature_since_previous_post_processing",
+            "mn2t": "minimum_2m_temperature_since_previous_post_processing",
+            "ssr": "surface_net_solar_radiation",
+        },
+    },
+    "GLEAM": {
+        "pattern": "*{variable}*.nc",
+        "x_dim": "lon",
+        "y_dim": "lat",
+        "variables": {"SMrz": "SMrz"},
+    },
+    "MERRA2": {
+        "pattern": "MERRA2*{variable}*daily*.nc",
+        "x_dim": "lon",
+        "y_dim": "lat",
+        "variables": {
+            "BCSMASS": "BCSMASS",
+            "DUSMASS25": "DUSMASS25",
+            "OCSMASS": "OCSMASS",
+        },
+    },
+}
+
+
+def default_zarr_dir(data_directory):
+    """
+    Return the Zarr directory, ``ZONAL_ZARR_DIR`` if set, otherwise a
+    ``zarr`` folder in the data directory.
+    """
+    return os.environ.get("ZONAL_ZARR_DIR") or os.path.join(
+        data_directory, "zarr"
+    )
+
+
+def store_path(zarr_directory, source, variable):
+    """
+    Return the path of the store of a source variable.
+    """
+    return os.path.join(zarr_directory, f"{source}_{variable}.zarr")
+
+
+def find_store(zarr_directory, source, variable):
+    """
+    Return the path of the store of a source variable, or None if it has
+    not been converted.
+    """
+    if not zarr_directory:
+        return None
+    path = store_path(zarr_directory, source, variable)
+    return path if os.path.isdir(path) else None
+
+
+def aligned_time_chunks(size, offset, time_chunk):
+    """
+    Split ``size`` timesteps written at ``offset`` into chunks that never
+    span two store chunks, so appends can be written chunk by chunk.
+
+    :param size: Number of timesteps to write
+    :param offset: Number of timesteps already in the store
+    :param time_chunk: Time chunk length of the store
+    :return: Tuple of chunk lengths
+    """
+    chunks = []
+    first = min(size, (time_chunk - offset % time_chunk) % time_chunk)
+    if first:
+        chunks.append(first)
+    remaining = size - first
+    while remaining > 0:
+        chunks.append(min(time_chunk, remaining))
+        remaining -= chunks[-1]
+    return tuple(chunks)
+
+
+def append_file(
+    file_path,
+    store,
+    var_code,
+    x_dim,
+    y_dim,
+    time_chunk=DEFAULT_TIME_CHUNK,
+    spatial_chunk=DEFAULT_SPATIAL_CHUNK,
+):
+    """
+    Append one variable of a NetCDF file to a Zarr store, creating it on
+    the first file.
+
+    Timesteps up to the last one already in the store are skipped, so
+    converting a directory again only appends the new files.
+
+    :param file_path: Path to the NetCDF file
+    :param store: Path to the Zarr store
+    :param var_code: Name of the variable in the file
+    :param x_dim: Name of the longitude dimension
+    :param y_dim: Name of the latitude dimension
+    :param time_chunk: Number of timesteps per chunk of a new store
+    :param spatial_chunk: Tile edge length in cells of a new store
+    :return: Number of timesteps appended
+    """
+    offset = 0
+    last_time = None
+    if os.path.isdir(store):
+        with xr.open_zarr(store, consolidated=True) as stored:
+            offset = stored.sizes["time"]
+            last_time = stored["time"].values[-1]
+            time_chunk = stored[var_code].encoding["chunks"][
+                stored[var_code].dims.index("time")
+            ]
+
+    with xr.open_dataset(file_path) as ds:
+        da = ds[var_code].sortby("time").reset_coords(drop=True)
+        if last_time is not None:
+            da = da.isel(time=np.flatnonzero(da["time"].values > last_time))
+        if da.sizes["time"] == 0:
+            return 0
+
+        chunks = {
+            "time": aligned_time_chunks(da.sizes["time"], offset, time_chunk),
+            y_dim: spatial_chunk,
+            x_dim: spatial_chunk,
+        }
+        ds_out = da.chunk(chunks).to_dataset(name=var_code)
+
+        if last_time is None:
+            encoding = {
+                var_code: {
+                    "chunks": tuple(
+                        time_chunk if dim == "time" else spatial_chunk
+                        for dim in da.dims
+                    )
+                }
+            }
+            ds_out.to_zarr(
+                store, mode="w-", consolidated=True, encoding=encoding
+            )
+        else:
+            ds_out.to_zarr(store, append_dim="time", consolidated=True)
+
+        return da.sizes["time"]
+
+
+def convert_files(
+    files,
+    store,
+    var_code,
+    x_dim,
+    y_dim,
+    time_chunk=DEFAULT_TIME_CHUNK,
+    spatial_chunk=DEFAULT_SPATIAL_CHUNK,
+):
+    """
+    Append NetCDF files to a Zarr store in time order.
+
+    :return: Number of timesteps appended
+    """
+
+    def first_time(file_path):
+        with xr.open_dataset(file_path) as ds:
+            return ds["time"].values.min()
+
+    appended = 0
+    for file_path in tqdm(
+        sorted(files, key=first_time), desc=os.path.basename(store)
+    ):
+        appended += append_file(
+            file_path,
+            store,
+            var_code,
+            x_dim,
+            y_dim,
+            time_chunk=time_chunk,
+            spatial_chunk=spatial_chunk,
+        )
+    return appended
+
+
+def open_store(store):
+    """
+    Open a Zarr store lazily, in the chunks it was written with.
+    """
+    return xr.open_zarr(store, consolidated=True)
+
+
+def time_blocks(da):
+    """
+    Yield a chunked DataArray one time chunk at a time, loaded into memory,
+    so every block is a single read per spatial tile. In-memory DataArrays
+    are yielded whole.
+    """
+    if da.chunks is None:
+        yield da
+        return
+
+    start = 0
+    for size in da.chunksizes["time"]:
+        yield da.isel(time=slice(start, start + size)).load()
+        start += size
+
+
+def chunk_files(store, da, start, stop):
+    """
+    Return the chunk files of a store variable holding timesteps ``start``
+    to ``stop``.
+
+    :param store: Path to the Zarr store
+    :param da: The variable, as opened by ``open_store``
+    :param start: First timestep
+    :param stop: Timestep after the last one
+    :return: Sorted list of chunk file paths
+    """
+    time_axis = da.dims.index("time")
+    time_chunk = da.encoding["chunks"][time_axis]
+
+    paths = set()
+    for index in range(start // time_chunk, (stop - 1) // time_chunk + 1):
+        parts = ["*"] * da.ndim
+        parts[time_axis] = str(index)
+        # Chunk keys of Zarr v2 ("0.0.0" or "0/0/0") and v3 ("c/0/0/0")
+        for key in (".".join(parts), "/".join(parts), "c/" + "/".join(parts)):
+            paths.update(glob.glob(os.path.join(store, da.name, key)))
+    return sorted(paths)
+
+
+def store_windows(store, var_code):
+    """
+    Return the windows a store variable is processed in, one per time chunk.
+
+    :param store: Path to the Zarr store
+    :param var_code: Name of the variable in the store
+    :return: List of (label, time slice, checksum) tuples; the label is the
+        first date of the chunk and the checksum identifies its timesteps
+        and chunk files (see ``ledger.window_checksum``)
+    """
+    windows = []
+    with open_store(store) as ds:
+        da = ds[var_code]
+        times = da["time"].values
+        start = 0
+        for size in da.chunksizes["time"]:
+            stop = start + size
+            windows.append(
+                (
+                    str(np.datetime_as_string(times[start], unit="D")),
+                    slice(start, stop),
+                    window_checksum(
+                        store,
+                        times[start:stop],
+                        chunk_files(store, da, start, stop),
+                    ),
+                )
+            )
+            start = stop
+    return windows
+
+
+def main():
+    """
+    Convert the daily NetCDF files of a source into its Zarr stores.
+    """
+    source = input(f"Enter the source ({', '.join(SOURCES)}): ").strip()
+    data_directory = input(
+        "Enter the path to the directory containing the netCDF files: "
+    )
+    zarr_directory = default_zarr_dir(data_directory)
+    os.makedirs(zarr_directory, exist_ok=True)
+
+    settings = SOURCES[source]
+    for var_code, var_name in settings["variables"].items():
+        files = glob.glob(
+            os.path.join(
+                data_directory, settings["pattern"].format(variable=var_name)
+            )
+        )
+        if not files:
+            print(f"No file found for {var_name}")
+            continue
+
+        store = store_path(zarr_directory, source, var_name)
+        appended = convert_files(
+            files, store, var_code, settings["x_dim"], settings["y_dim"]
+        )
+        print(f"Appended {appended} timesteps of {var_name} to {store}")
+
+
+if __name__ == "__main__":
+    main()